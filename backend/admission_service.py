@@ -0,0 +1,236 @@
+"""
+Admission control: per-class concurrency limits with priority and shedding.
+
+Requests are sorted into classes, highest priority first:
+
+    checkin  face verification and attendance marking
+    admin    dashboard reads and management calls
+    export   exports, bulk enrollment and video uploads
+
+Each class has its own concurrency limit and queue-time budget. A queued
+request is only admitted while no higher class has requests waiting, so a
+burst of exports can't delay check-ins. Requests that would wait longer than
+their budget, or that arrive to an already overlong queue, get 503 with
+Retry-After instead of tying up a worker until the client times out.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import deque
+
+from response_service import FastJSONResponse
+
+CLASSES = ("checkin", "admin", "export")
+ADMISSION_ENABLED = os.environ.get("ADMISSION_CONTROL", "1").lower() not in ("0", "false", "no")
+
+# Check-ins must get a slot well inside FACE_TIMEOUT_SECONDS to be useful.
+DEFAULT_LIMITS = {"checkin": 64, "admin": 16, "export": 2}
+DEFAULT_MAX_WAIT = {"checkin": 1.0, "admin": 5.0, "export": 10.0}
+# Shed on arrival once this many are already queued per slot.
+QUEUE_PER_SLOT = 4
+
+_EXEMPT_PREFIXES = ("/health", "/api/v1/health", "/docs", "/openapi.json", "/redoc")
+_CHECKIN_MARKERS = ("mark_attendance", "mark-attendance", "verify_face", "verify-face")
+_EXPORT_MARKERS = ("/export", "/enroll", "/stream")
+
+
+def _env_map(name, defaults, cast):
+    # e.g. ADMISSION_LIMITS="checkin=32,admin=8,export=1"
+    values = dict(defaults)
+    for item in os.environ.get(name, "").split(","):
+        key, _, value = item.partition("=")
+        if key.strip() in values and value.strip():
+            values[key.strip()] = cast(value)
+    return values
+
+
+def classify(method, path):
+    """
+    Returns the priority class for a request, or None if it bypasses
+    admission control (health checks, docs, CORS preflights).
+    """
+    if method == "OPTIONS" or path.startswith(_EXEMPT_PREFIXES):
+        return None
+    if any(marker in path for marker in _EXPORT_MARKERS):
+        return "export"
+    if any(marker in path for marker in _CHECKIN_MARKERS):
+        return "checkin"
+    return "admin"
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__("overloaded")
+        self.retry_after = retry_after
+
+
+class _ClassState:
+    def __init__(self, limit, max_wait):
+        self.limit = limit
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.shed = 0
+        self.queue_wait_ms = 0.0  # EWMA
+        self.service_ms = 0.0  # EWMA
+
+
+class AdmissionController:
+    def __init__(self, limits=None, max_wait=None):
+        limits = limits or _env_map("ADMISSION_LIMITS", DEFAULT_LIMITS, int)
+        max_wait = max_wait or _env_map("ADMISSION_MAX_WAIT", DEFAULT_MAX_WAIT, float)
+        self.classes = {name: _ClassState(max(1, limits[name]), max_wait[name]) for name in CLASSES}
+        self._cpu_sample = (time.monotonic(), time.process_time())
+        self._cpu_percent = 0.0
+
+    def _higher_waiting(self, name):
+        for other in CLASSES:
+            if other == name:
+                return False
+            if self.classes[other].waiters:
+                return True
+        return False
+
+    def _can_admit(self, name):
+        state = self.classes[name]
+        return state.in_flight < state.limit and not self._higher_waiting(name)
+
+    def _retry_after(self, state):
+        # Rough time for the queue ahead to drain, in whole seconds.
+        per_slot = len(state.waiters) / state.limit + 1
+        return max(1, min(30, math.ceil(per_slot * max(state.service_ms, 100.0) / 1000.0)))
+
+    async def acquire(self, name):
+        state = self.classes[name]
+        if self._can_admit(name) and not state.waiters:
+            state.in_flight += 1
+            state.admitted += 1
+            state.queue_wait_ms *= 0.9
+            return time.monotonic()
+
+        if len(state.waiters) >= state.limit * QUEUE_PER_SLOT:
+            state.shed += 1
+            raise Overloaded(self._retry_after(state))
+
+        queued_at = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        state.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=state.max_wait)
+        except asyncio.TimeoutError:
+            # A slot handed over just as the budget ran out is still used.
+            if not waiter.done() or waiter.cancelled():
+                waiter.cancel()
+                self._discard(state, waiter)
+                state.shed += 1
+                # Lower classes may have been held back only by this waiter.
+                self._dispatch()
+                raise Overloaded(self._retry_after(state))
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._return_slot(state)
+            self._discard(state, waiter)
+            raise
+
+        waited_ms = (time.monotonic() - queued_at) * 1000
+        state.queue_wait_ms = 0.9 * state.queue_wait_ms + 0.1 * waited_ms
+        state.admitted += 1
+        return time.monotonic()
+
+    @staticmethod
+    def _discard(state, waiter):
+        try:
+            state.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def _return_slot(self, state):
+        state.in_flight -= 1
+        self._dispatch()
+
+    def release(self, name, started):
+        state = self.classes[name]
+        state.service_ms = 0.9 * state.service_ms + 0.1 * (time.monotonic() - started) * 1000
+        self._return_slot(state)
+
+    def _dispatch(self):
+        for name in CLASSES:
+            state = self.classes[name]
+            while state.waiters and state.in_flight < state.limit:
+                waiter = state.waiters.popleft()
+                if waiter.done():
+                    continue
+                state.in_flight += 1
+                waiter.set_result(True)
+            if state.waiters:
+                # Lower classes wait while this one still has a queue.
+                return
+
+    def cpu_percent(self):
+        now, cpu = time.monotonic(), time.process_time()
+        last_now, last_cpu = self._cpu_sample
+        if now - last_now >= 1.0:
+            self._cpu_percent = (cpu - last_cpu) * 100.0 / (now - last_now)
+            self._cpu_sample = (now, cpu)
+        return round(self._cpu_percent, 1)
+
+    def stats(self):
+        load = os.getloadavg()[0] if hasattr(os, "getloadavg") else None
+        return {
+            "process_cpu_percent": self.cpu_percent(),
+            "load_average_1m": round(load, 2) if load is not None else None,
+            "classes": {
+                name: {
+                    "limit": state.limit,
+                    "in_flight": state.in_flight,
+                    "queued": len(state.waiters),
+                    "admitted": state.admitted,
+                    "shed": state.shed,
+                    "queue_wait_ms": round(state.queue_wait_ms, 1),
+                    "service_ms": round(state.service_ms, 1),
+                }
+                for name, state in self.classes.items()
+            },
+        }
+
+
+_controller = AdmissionController()
+
+
+def get_admission_controller():
+    return _controller
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller=None):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        name = classify(scope.get("method", ""), scope.get("path", "")) if scope["type"] == "http" else None
+        if name is None or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        controller = self.controller or get_admission_controller()
+        try:
+            started = await controller.acquire(name)
+        except Overloaded as exc:
+            response = FastJSONResponse(
+                status_code=503,
+                content={
+                    "success": False,
+                    "error_code": "SERVICE_OVERLOADED",
+                    "message": "Server is busy. Please retry shortly.",
+                },
+                headers={"Retry-After": str(exc.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.release(name, started)
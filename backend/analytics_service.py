@@ -0,0 +1,212 @@
+"""
+Attendance analytics over a compact columnar frame.
+
+An admin's attendance rows are loaded once into integer-coded NumPy columns
+(student, day, subject), and every statistic is a group-by over those codes
+(bincount, unique on packed keys, a students x days presence matrix), so
+the cost is a few passes over flat arrays rather than a Python loop per row.
+"""
+import os
+
+import numpy as np
+
+from gallery_service import fetch_all_rows
+
+AT_RISK_PERCENT = float(os.environ.get("ANALYTICS_AT_RISK_PERCENT", 75))
+
+
+class AttendanceFrame:
+    """
+    Columnar view of one admin's attendance.
+
+    ``student`` indexes ``student_ids``, ``day`` indexes the sorted ``days``
+    (datetime64[D]) and ``subject`` indexes ``subjects`` (-1 for none). Rows
+    for unknown students or unparseable dates are dropped.
+    """
+
+    def __init__(self, student_ids, days, subjects, student, day, subject):
+        self.student_ids = list(student_ids)
+        self.days = days
+        self.subjects = list(subjects)
+        self.student = student
+        self.day = day
+        self.subject = subject
+
+    def __len__(self):
+        return len(self.student)
+
+    @classmethod
+    def from_rows(cls, rows, student_ids, date_from=None, date_to=None):
+        n = len(rows)
+        student_index = {sid: i for i, sid in enumerate(student_ids)}
+        student = np.fromiter((student_index.get(r.get("student_id"), -1) for r in rows), dtype=np.int32, count=n)
+
+        dates = _parse_days([r.get("date") or "NaT" for r in rows])
+
+        subject_index = {}
+        subject = np.fromiter(
+            (subject_index.setdefault(r.get("subject"), len(subject_index)) if r.get("subject") else -1 for r in rows),
+            dtype=np.int32,
+            count=n,
+        )
+
+        keep = (student >= 0) & ~np.isnat(dates)
+        if date_from is not None:
+            keep &= dates >= np.datetime64(date_from, "D")
+        if date_to is not None:
+            keep &= dates <= np.datetime64(date_to, "D")
+        student, dates, subject = student[keep], dates[keep], subject[keep]
+
+        day_numbers = dates.astype(np.int64)
+        days = _distinct(day_numbers)
+        day = np.searchsorted(days, day_numbers).astype(np.int32)
+        return cls(student_ids, days.astype("datetime64[D]"), list(subject_index), student, day, subject)
+
+    def presence(self):
+        """
+        Boolean students x days matrix: present at least once that day.
+        """
+        matrix = np.zeros((len(self.student_ids), len(self.days)), dtype=bool)
+        matrix[self.student, self.day] = True
+        return matrix
+
+
+def _parse_days(values):
+    """
+    datetime64[D] array of iso dates; unparseable ones become NaT.
+    """
+    try:
+        return np.array(values, dtype="datetime64[D]")
+    except (TypeError, ValueError):
+        pass
+    # Something in there is malformed; parse row by row.
+    days = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[D]")
+    for i, value in enumerate(values):
+        try:
+            days[i] = np.datetime64(value, "D")
+        except (TypeError, ValueError):
+            pass
+    return days
+
+
+def _distinct(keys):
+    # Sort-based unique; cheaper than np.unique's hashing on large int64 keys.
+    if keys.size == 0:
+        return keys
+    keys = np.sort(keys)
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+
+def _streaks(presence):
+    """
+    (current, longest) run of consecutive session days present, per student.
+    """
+    n_students, n_days = presence.shape
+    if n_days == 0:
+        zeros = np.zeros(n_students, dtype=np.int64)
+        return zeros, zeros
+
+    padded = np.zeros((n_students, n_days + 2), dtype=np.int8)
+    padded[:, 1:-1] = presence
+    edges = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    _, end_cols = np.nonzero(edges == -1)
+    # Starts and ends pair up in row-major order.
+    lengths = end_cols - start_cols
+    longest = np.zeros(n_students, dtype=np.int64)
+    np.maximum.at(longest, start_rows, lengths)
+
+    absent = ~presence[:, ::-1]
+    trailing = np.argmax(absent, axis=1)
+    current = np.where(absent.any(axis=1), trailing, n_days)
+    return current, longest
+
+
+def compute_analytics(frame, students=None, at_risk_percent=AT_RISK_PERCENT):
+    """
+    Rates are percentages of session days, where a session day is any day
+    with at least one attendance mark for this admin. ``students`` maps
+    student id -> {"name", "roll_number"} for labelling.
+    """
+    students = students or {}
+    n_students, n_days = len(frame.student_ids), len(frame.days)
+    presence = frame.presence()
+
+    days_present = presence.sum(axis=1)
+    student_rate = days_present * 100.0 / n_days if n_days else np.zeros(n_students)
+    present_per_day = presence.sum(axis=0)
+    day_rate = present_per_day * 100.0 / n_students if n_students else np.zeros(n_days)
+    current_streak, longest_streak = _streaks(presence)
+
+    # Subjects: a subject's sessions are the days it was marked at all.
+    # Pack (subject, day[, student]) into one int64 key and count uniques.
+    with_subject = frame.subject >= 0
+    n_subjects = len(frame.subjects)
+    day_span, student_span = max(n_days, 1), max(n_students, 1)
+    subject_day = frame.subject[with_subject].astype(np.int64) * day_span + frame.day[with_subject]
+    sessions = np.bincount(_distinct(subject_day) // day_span, minlength=n_subjects)
+    marked = _distinct(subject_day * student_span + frame.student[with_subject])
+    marks = np.bincount(marked // (day_span * student_span), minlength=n_subjects)
+    expected = sessions * n_students
+    subject_rate = np.divide(marks * 100.0, expected, out=np.zeros(n_subjects), where=expected > 0)
+
+    per_student = []
+    for i in np.argsort(-student_rate, kind="stable").tolist():
+        sid = frame.student_ids[i]
+        info = students.get(sid, {})
+        per_student.append(
+            {
+                "student_id": sid,
+                "name": info.get("name", "N/A"),
+                "roll_number": info.get("roll_number", "N/A"),
+                "days_present": int(days_present[i]),
+                "attendance_rate": round(float(student_rate[i]), 2),
+                "current_streak": int(current_streak[i]),
+                "longest_streak": int(longest_streak[i]),
+            }
+        )
+
+    at_risk = sorted(
+        (entry for entry in per_student if entry["attendance_rate"] < at_risk_percent),
+        key=lambda entry: (entry["attendance_rate"], entry["student_id"]),
+    )
+
+    total_possible = n_students * n_days
+    return {
+        "total_students": n_students,
+        "total_days": n_days,
+        "total_records": len(frame),
+        "overall_attendance_rate": (
+            round(float(days_present.sum()) * 100.0 / total_possible, 2) if total_possible else 0.0
+        ),
+        "at_risk_threshold": at_risk_percent,
+        "per_student": per_student,
+        "per_day": [
+            {"date": day, "present": count, "attendance_rate": round(rate, 2)}
+            for day, count, rate in zip(frame.days.astype(str).tolist(), present_per_day.tolist(), day_rate.tolist())
+        ],
+        "per_subject": [
+            {
+                "subject": name,
+                "sessions": int(sessions[i]),
+                "marks": int(marks[i]),
+                "attendance_rate": round(float(subject_rate[i]), 2),
+            }
+            for i, name in enumerate(frame.subjects)
+        ],
+        "at_risk_students": at_risk,
+    }
+
+
+def load_admin_analytics(client, admin_id, date_from=None, date_to=None, at_risk_percent=AT_RISK_PERCENT):
+    students = fetch_all_rows(client, "students", "id, name, roll_number", [("admin_id", admin_id)])
+    students_by_id = {row["id"]: row for row in students if row.get("id")}
+    # Only the requested range leaves the database; from_rows still clips it.
+    filters = [("admin_id", admin_id)]
+    if date_from is not None:
+        filters.append(("date", "gte", str(date_from)))
+    if date_to is not None:
+        filters.append(("date", "lte", str(date_to)))
+    rows = fetch_all_rows(client, "attendance", "student_id, date, subject", filters)
+    frame = AttendanceFrame.from_rows(rows, sorted(students_by_id), date_from, date_to)
+    return compute_analytics(frame, students_by_id, at_risk_percent)
@@ -1,34 +1,88 @@
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import tempfile
 import threading
+import zipfile
 import time
-from concurrent.futures import ThreadPoolExecutor
-from concurrent.futures import TimeoutError as FuturesTimeoutError
-from datetime import datetime, timezone
-from typing import Optional, Tuple
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
 
-from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi import Depends, FastAPI, File, Form, HTTPException, Query, Request, Response, UploadFile
 from fastapi.exceptions import RequestValidationError
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
-from attendance_service import mark_student_attendance
+from admission_service import AdmissionMiddleware, get_admission_controller
+from analytics_service import AT_RISK_PERCENT, load_admin_analytics
+from audit_service import close_audit_log, get_audit_log, record_event
+from attendance_service import (
+    HISTORY_FIELDS,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    close_write_buffer,
+    get_write_buffer,
+    mark_attendance_bulk,
+    mark_student_attendance,
+    query_attendance,
+)
 from auth_service import require_admin, require_auth
+from body_limit_service import BodyLimitMiddleware, get_body_limiter
+from cache_service import bump_data_version, get_response_cache
 from database_service import get_supabase_client
+from enrollment_service import close_enroll_pool, enroll_images, iter_zip_images
 from export_service import generate_attendance_csv, generate_attendance_pdf
-from face_service import delete_student_face, register_student_face, verify_student_face
+from face_service import (
+    BATCH_MAX_FRAMES,
+    admin_of_student,
+    cached_admin_of_student,
+    delete_student_face,
+    frame_hash,
+    get_quality_stats,
+    get_replay_cache,
+    get_warmup_state,
+    identify_faces,
+    lookup_replayed_verification,
+    match_rule,
+    register_student_face,
+    replay_cache_enabled,
+    verify_student_face,
+    warm_up,
+)
+from gallery_service import get_gallery, load_gallery, run_refresher as run_gallery_refresher
+from local_store_service import close_local_store, get_local_store
+from response_service import CompressionMiddleware, FastJSONResponse, ReleasingStreamingResponse
+from roster_service import ROSTER_MATERIALIZE, load_roster, run_materializer
+from schedule_service import get_schedule
+from stream_service import (
+    FRAME_TIMEOUT_SECONDS,
+    ClipTooLarge,
+    FrameTooLarge,
+    MjpegSplitter,
+    StreamAttendanceSession,
+    iter_clip_frames,
+    save_clip,
+)
+from tenant_service import QuotaExceeded, get_tenant_scheduler
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("AttendX")
 
-app = FastAPI(title="AttendX Backend", version="2.2")
+app = FastAPI(title="AttendX Backend", version="2.2", default_response_class=FastJSONResponse)
 
 default_origins = ["http://localhost:3000", "http://127.0.0.1:3000"]
 origins_env = os.environ.get("FRONTEND_ORIGINS", "")
 allow_origins = [origin.strip() for origin in origins_env.split(",") if origin.strip()] or default_origins
 
+# Added before CORS so that shed (503) and oversized-body (413) responses
+# still carry CORS headers. Body limits sit outside admission control so an
+# upload refused on its Content-Length never takes a slot.
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(BodyLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allow_origins,
@@ -36,12 +90,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
 
 FACE_TIMEOUT_SECONDS = 2.0
+FACE_BATCH_TIMEOUT_SECONDS = 10.0
 RATE_LIMIT_ATTEMPTS = 3
 RATE_LIMIT_WINDOW_SECONDS = 60
 _ATTEMPT_LOG = {}
 _ATTEMPT_LOCK = threading.Lock()
+FACE_WARMUP_ENABLED = os.environ.get("FACE_WARMUP", "1").lower() not in ("0", "false", "no")
+FACE_GALLERY_PRELOAD = os.environ.get("FACE_GALLERY_PRELOAD", "0").lower() in ("1", "true", "yes")
+_gallery_stop = threading.Event()
+_roster_stop = threading.Event()
 
 
 class RegisterFaceRequest(BaseModel):
@@ -52,12 +112,21 @@ class RegisterFaceRequest(BaseModel):
 class VerifyFaceRequest(BaseModel):
     student_id: Optional[str] = None
     image: Optional[str] = None
+    # Extra frames from the same capture, for the liveness blink/motion check.
+    burst: Optional[List[str]] = None
 
 
 class MarkAttendanceRequest(BaseModel):
     student_id: Optional[str] = None
     image: Optional[str] = None
     subject: Optional[str] = None
+    burst: Optional[List[str]] = None
+
+
+class BatchAttendanceRequest(BaseModel):
+    images: Optional[List[str]] = None
+    image: Optional[str] = None
+    subject: Optional[str] = None
 
 
 class DeleteFaceRequest(BaseModel):
@@ -67,6 +136,7 @@ class DeleteFaceRequest(BaseModel):
 
 class ExportRequest(BaseModel):
     format: str = "csv"
+    include_absent: bool = False
 
 
 def _now_iso() -> str:
@@ -84,10 +154,11 @@ def _success(message: str, confidence: float = 0.0, **extra):
     return payload
 
 
-def _error(status_code: int, error_code: str, message: str):
+def _error(status_code: int, error_code: str, message: str, headers=None):
     raise HTTPException(
         status_code=status_code,
         detail={"success": False, "error_code": error_code, "message": message},
+        headers=headers,
     )
 
 
@@ -97,6 +168,20 @@ def _error_payload(error_code: str, message: str):
 
 def _map_face_failure(message: str) -> Tuple[int, str, str]:
     text = (message or "").lower()
+    if "image too large" in text:
+        return 413, "IMAGE_TOO_LARGE", "Image exceeds the allowed size."
+    if "invalid image" in text:
+        return 400, "INVALID_IMAGE", "Image could not be decoded."
+    if "liveness check failed" in text:
+        return 400, "LIVENESS_FAILED", "Liveness check failed. Look at the camera and blink."
+    if "face too small" in text:
+        return 400, "FACE_TOO_SMALL", "Face too small. Please move closer to the camera."
+    if "too blurry" in text:
+        return 400, "FACE_BLURRY", "Image is blurry. Please hold still."
+    if "poor lighting" in text:
+        return 400, "POOR_LIGHTING", "Lighting is too dark or too bright."
+    if "not facing camera" in text:
+        return 400, "FACE_POSE", "Please face the camera directly."
     if "found 0 faces" in text or "no face" in text:
         return 400, "NO_FACE_DETECTED", "No face detected. Please look at the camera."
     if "found " in text and "faces" in text and "found 1 faces" not in text:
@@ -108,24 +193,160 @@ def _map_face_failure(message: str) -> Tuple[int, str, str]:
     return 400, "FACE_MISMATCH", "Face does not match registered student."
 
 
-def _verify_face_with_timeout(student_id: str, image: str):
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(verify_student_face, student_id, image)
-        try:
-            return future.result(timeout=FACE_TIMEOUT_SECONDS)
-        except FuturesTimeoutError:
-            future.cancel()
-            _error(503, "FACE_TIMEOUT", "Face recognition service timeout.")
+def _raise_quota_exceeded(exc: QuotaExceeded):
+    _error(
+        429,
+        "TENANT_QUOTA_EXCEEDED",
+        "Your account has reached its processing limit. Try again shortly.",
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+async def _run_face_job(admin_id, kind: str, fn, *args, timeout=None, enforce_quota=True):
+    """
+    Runs ``fn`` on the shared face pool in ``admin_id``'s queue. The timeout
+    covers queueing as well as the work itself.
+    """
+    try:
+        future = get_tenant_scheduler().submit(admin_id, fn, *args, kind=kind, enforce_quota=enforce_quota)
+    except QuotaExceeded as exc:
+        _raise_quota_exceeded(exc)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        future.cancel()
+        _error(503, "FACE_TIMEOUT", "Face recognition service timeout.")
+
+
+async def _student_tenant(student_id: str):
+    # Gallery or cached lookups answer inline; only a miss goes to the
+    # kiosk mirror / Supabase, off the event loop.
+    admin_id = cached_admin_of_student(student_id)
+    if admin_id is None:
+        admin_id = await run_in_threadpool(admin_of_student, student_id)
+    return admin_id
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+
+def _audit_verification(source, student_id, admin_id, started, result=None, error_code=None, replayed=False):
+    """
+    Verification outcome for the audit log. ``distance`` is only set when
+    the face was actually compared with the stored encoding.
+    """
+    match, confidence, message, liveness = result or (False, None, None, None)
+    compared = message in ("Match found", "Face does not match")
+    if error_code is None:
+        error_code = None if match else _map_face_failure(message)[1]
+    record_event(
+        "verify",
+        source=source,
+        student_id=student_id,
+        admin_id=admin_id,
+        match=bool(match),
+        confidence=confidence,
+        distance=round(1.0 - confidence / 100.0, 4) if compared else None,
+        threshold=match_rule(admin_id)[0],
+        error_code=error_code,
+        live=liveness.get("live") if liveness else None,
+        replayed=replayed or None,
+        duration_ms=_elapsed_ms(started),
+    )
 
 
-def _register_face_with_timeout(student_id: str, image: str):
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(register_student_face, student_id, image)
+async def _verify_face_with_timeout(
+    student_id: str, image: str, burst: Optional[List[str]] = None, source: str = "verify", phash=None
+):
+    admin_id = await _student_tenant(student_id)
+    started = time.perf_counter()
+    try:
+        result = await _run_face_job(
+            admin_id,
+            "checkin",
+            verify_student_face,
+            student_id,
+            image,
+            burst,
+            phash,
+            admin_id,
+            timeout=FACE_TIMEOUT_SECONDS,
+            enforce_quota=False,
+        )
+    except HTTPException as exc:
+        _audit_verification(source, student_id, admin_id, started, error_code=exc.detail["error_code"])
+        raise
+    _audit_verification(source, student_id, admin_id, started, result)
+    return result
+
+
+async def _register_face_with_timeout(student_id: str, image: str, admin_id: str):
+    started = time.perf_counter()
+    error_code = None
+    try:
+        success, message = await _run_face_job(
+            admin_id, "register", register_student_face, student_id, image, admin_id, timeout=FACE_TIMEOUT_SECONDS
+        )
+        if not success:
+            error_code = _map_face_failure(message)[1]
+        return success, message
+    except HTTPException as exc:
+        error_code = exc.detail["error_code"]
+        raise
+    finally:
+        record_event(
+            "register",
+            student_id=student_id,
+            admin_id=admin_id,
+            success=error_code is None,
+            error_code=error_code,
+            duration_ms=_elapsed_ms(started),
+        )
+
+
+async def _identify_faces_with_timeout(admin_id: str, images: List[str]):
+    started = time.perf_counter()
+    try:
+        matches, stats = await _run_face_job(
+            admin_id, "identify", identify_faces, admin_id, images, timeout=FACE_BATCH_TIMEOUT_SECONDS
+        )
+    except HTTPException as exc:
+        record_event(
+            "identify", admin_id=admin_id, error_code=exc.detail["error_code"], duration_ms=_elapsed_ms(started)
+        )
+        raise
+    record_event(
+        "identify",
+        admin_id=admin_id,
+        frames=len(images),
+        matches=matches,
+        faces_detected=stats["faces_detected"] if matches is not None else None,
+        error_code=_map_face_failure(stats)[1] if matches is None else None,
+        duration_ms=_elapsed_ms(started),
+    )
+    return matches, stats
+
+
+def _in_tenant_slot(admin_id: str, kind: str, build):
+    def run():
         try:
-            return future.result(timeout=FACE_TIMEOUT_SECONDS)
-        except FuturesTimeoutError:
-            future.cancel()
-            _error(503, "FACE_TIMEOUT", "Face recognition service timeout.")
+            with get_tenant_scheduler().slot(admin_id, kind):
+                return build()
+        except QuotaExceeded as exc:
+            _raise_quota_exceeded(exc)
+
+    return run
+
+
+def _raise_attendance_failure(result_code: str):
+    if result_code == "DUPLICATE_ATTENDANCE":
+        _error(400, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today.")
+    if result_code == "OUTSIDE_TIME_WINDOW":
+        _error(403, "OUTSIDE_TIME_WINDOW", "Attendance allowed only during lecture time.")
+    if result_code == "INVALID_PAYLOAD":
+        _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
+    _error(500, "INTERNAL_ERROR", "Internal server error.")
 
 
 def _check_rate_limit(student_id: str):
@@ -141,6 +362,8 @@ def _check_rate_limit(student_id: str):
 
 
 def _resolve_admin_context(user) -> Tuple[object, str]:
+    # Blocking Supabase call: async handlers go through run_in_threadpool;
+    # plain def handlers already run in the threadpool.
     client = get_supabase_client()
     user_id = getattr(user, "id", None)
     if not user_id:
@@ -194,42 +417,81 @@ def _get_admin_attendance_records(client, admin_id: str):
 
 
 def _build_csv_response(records):
-    csv_content = generate_attendance_csv(records)
-    return Response(
-        content=csv_content,
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=attendance_report.csv"},
-        status_code=200,
+    return (
+        generate_attendance_csv(records).encode("utf-8"),
+        "text/csv",
+        {"Content-Disposition": "attachment; filename=attendance_report.csv"},
     )
 
 
 def _build_pdf_response(records):
-    pdf_content = generate_attendance_pdf(records)
-    return Response(
-        content=pdf_content,
-        media_type="application/pdf",
-        headers={"Content-Disposition": "attachment; filename=attendance_report.pdf"},
-        status_code=200,
+    return (
+        generate_attendance_pdf(records),
+        "application/pdf",
+        {"Content-Disposition": "attachment; filename=attendance_report.pdf"},
     )
 
 
+def _etag_for(payload) -> str:
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match", "")
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+def _cached_response(request: Request, admin_id: str, endpoint: str, params, build):
+    """
+    Serve ``build()`` -> (body, media_type, headers) through the response
+    cache, answering 304 when the client already has the current version.
+    ``build`` runs inline, so only call this from plain def handlers.
+    """
+    cache = get_response_cache()
+    key = cache.key(admin_id, endpoint, params)
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache.put(key, *build())
+    headers = {"ETag": entry.etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type=entry.media_type, headers={**entry.headers, **headers})
+
+
+def _build_export(client, admin_id: str, export_format: str, include_absent: bool = False):
+    records = _get_admin_attendance_records(client, admin_id)
+    if not records:
+        _error(404, "NO_DATA", "No attendance records found.")
+    if include_absent:
+        first_day = date.fromisoformat(min(str(row.get("date")) for row in records if row.get("date")))
+        roster = load_roster(client, admin_id, first_day, _local_today(admin_id))
+        records = sorted(
+            records + roster.absent_records(),
+            key=lambda row: (str(row.get("date")), str(row["students"].get("name", ""))),
+        )
+    if export_format == "pdf":
+        return _build_pdf_response(records)
+    return _build_csv_response(records)
+
+
 @app.exception_handler(StarletteHTTPException)
 async def starlette_http_exception_handler(_, exc: StarletteHTTPException):
     if exc.status_code == 405:
-        return JSONResponse(
+        return FastJSONResponse(
             status_code=405,
             content=_error_payload("METHOD_NOT_ALLOWED", "Method not allowed."),
         )
     if isinstance(exc, HTTPException):
         return await http_exception_handler(_, exc)
-    return JSONResponse(status_code=exc.status_code, content=_error_payload("INTERNAL_ERROR", "Internal server error."))
+    return FastJSONResponse(status_code=exc.status_code, content=_error_payload("INTERNAL_ERROR", "Internal server error."))
 
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(_, exc: HTTPException):
     detail = exc.detail
     if isinstance(detail, dict) and detail.get("error_code") and detail.get("message"):
-        return JSONResponse(status_code=exc.status_code, content=detail)
+        return FastJSONResponse(status_code=exc.status_code, content=detail, headers=exc.headers)
 
     code_map = {
         400: ("INVALID_PAYLOAD", "Missing required parameters."),
@@ -239,12 +501,12 @@ async def http_exception_handler(_, exc: HTTPException):
         405: ("METHOD_NOT_ALLOWED", "Method not allowed."),
     }
     error_code, message = code_map.get(exc.status_code, ("INTERNAL_ERROR", "Internal server error."))
-    return JSONResponse(status_code=exc.status_code, content=_error_payload(error_code, message))
+    return FastJSONResponse(status_code=exc.status_code, content=_error_payload(error_code, message))
 
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(_, __: RequestValidationError):
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=400,
         content=_error_payload("INVALID_PAYLOAD", "Missing required parameters."),
     )
@@ -253,7 +515,7 @@ async def validation_exception_handler(_, __: RequestValidationError):
 @app.exception_handler(Exception)
 async def unhandled_exception_handler(_, exc: Exception):
     logger.exception("Unhandled exception: %s", exc)
-    return JSONResponse(
+    return FastJSONResponse(
         status_code=500,
         content=_error_payload("INTERNAL_ERROR", "Internal server error."),
     )
@@ -264,12 +526,115 @@ async def on_startup():
     port = int(os.environ.get("PORT", 5000))
     logger.info("Attend-X backend listening on http://0.0.0.0:%s", port)
     logger.info("Health check: http://0.0.0.0:%s/api/v1/health", port)
+    if FACE_WARMUP_ENABLED:
+        # Warm in the background so liveness answers immediately while the
+        # face models load; readiness flips once warm_up() finishes.
+        threading.Thread(target=warm_up, name="face-warmup", daemon=True).start()
+    if FACE_GALLERY_PRELOAD or get_gallery() is not None:
+        # Maps the on-disk snapshot (unless the prefork parent already did),
+        # then keeps it in sync with registrations made by other workers.
+        _gallery_stop.clear()
+        threading.Thread(target=_run_gallery, name="gallery-sync", daemon=True).start()
+    if ROSTER_MATERIALIZE:
+        _roster_stop.clear()
+        threading.Thread(
+            target=run_materializer, kwargs={"stop_event": _roster_stop}, name="roster-materializer", daemon=True
+        ).start()
+    # Start mirroring students/encodings right away on kiosks (LOCAL_STORE=1).
+    get_local_store()
+    # Open the write-behind buffer now, so rows a crashed worker left
+    # unflushed go out without waiting for the next check-in.
+    get_write_buffer()
+
+
+def _run_gallery():
+    if get_gallery() is None:
+        try:
+            load_gallery()
+        except Exception as exc:
+            logger.error("Face gallery preload failed: %s", exc)
+            return
+    run_gallery_refresher(stop_event=_gallery_stop)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Push any buffered attendance rows and audit events out before the worker exits.
+    close_write_buffer()
+    close_audit_log()
+    close_local_store()
+    close_enroll_pool()
+    _gallery_stop.set()
+    _roster_stop.set()
+
+
+def _readiness() -> str:
+    if not FACE_WARMUP_ENABLED:
+        return "ready"
+    status = get_warmup_state()["status"]
+    return "ready" if status == "ready" else ("failed" if status == "failed" else "warming")
 
 
 @app.get("/health")
 @app.get("/api/v1/health")
 async def health():
-    return _success("Service healthy.", confidence=0.0, status="healthy", service="AttendX Backend", version="2.2")
+    warmup = get_warmup_state()
+    return _success(
+        "Service healthy.",
+        confidence=0.0,
+        status="healthy",
+        service="AttendX Backend",
+        version="2.2",
+        live=True,
+        ready=_readiness() == "ready",
+        readiness=_readiness(),
+        face_warmup_ms=warmup["duration_ms"],
+    )
+
+
+@app.get("/health/ready")
+@app.get("/api/v1/health/ready")
+async def health_ready():
+    readiness = _readiness()
+    if readiness == "failed":
+        return FastJSONResponse(
+            status_code=503,
+            content=_error_payload("SERVICE_UNAVAILABLE", "Face recognition models failed to load."),
+        )
+    if readiness != "ready":
+        return FastJSONResponse(
+            status_code=503,
+            content=_error_payload("SERVICE_WARMING", "Face recognition models are still loading."),
+            headers={"Retry-After": "5"},
+        )
+    return _success("Service ready.", confidence=0.0, status="ready")
+
+
+@app.get("/api/v1/metrics")
+async def metrics():
+    replay_cache = get_replay_cache()
+    write_buffer = get_write_buffer()
+    local_store = get_local_store()
+    audit_log = get_audit_log()
+    return _success(
+        "Metrics collected.",
+        confidence=0.0,
+        face_quality=get_quality_stats(),
+        replay_cache={"hits": replay_cache.hits, "misses": replay_cache.misses},
+        response_cache={"hits": get_response_cache().hits, "misses": get_response_cache().misses},
+        attendance_buffer_pending=write_buffer.pending_count() if write_buffer is not None else None,
+        local_store=local_store.status() if local_store is not None else None,
+        admission=get_admission_controller().stats(),
+        tenants=get_tenant_scheduler().totals(),
+        audit_log=audit_log.stats() if audit_log is not None else None,
+        body_limits=get_body_limiter().stats(),
+    )
+
+
+@app.get("/api/v1/usage")
+def get_usage(user=Depends(require_admin)):
+    _, admin_id = _resolve_admin_context(user)
+    return _success("Usage collected.", confidence=0.0, **get_tenant_scheduler().usage(admin_id)[admin_id])
 
 
 @app.post("/register_face")
@@ -280,10 +645,10 @@ async def register_face(request: RegisterFaceRequest, user=Depends(require_admin
     if not request.student_id or not request.image:
         _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
 
-    client, admin_id = _resolve_admin_context(user)
-    _assert_student_scope(client, admin_id, request.student_id)
+    client, admin_id = await run_in_threadpool(_resolve_admin_context, user)
+    await run_in_threadpool(_assert_student_scope, client, admin_id, request.student_id)
 
-    success, message = _register_face_with_timeout(request.student_id, request.image)
+    success, message = await _register_face_with_timeout(request.student_id, request.image, admin_id)
     if not success:
         status, error_code, std_message = _map_face_failure(message)
         _error(status, error_code, std_message)
@@ -299,12 +664,14 @@ async def verify_face(request: VerifyFaceRequest):
     if not request.student_id or not request.image:
         _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
 
-    match, confidence, message = _verify_face_with_timeout(request.student_id, request.image)
+    match, confidence, message, liveness = await _verify_face_with_timeout(
+        request.student_id, request.image, request.burst
+    )
     if not match:
         status, error_code, std_message = _map_face_failure(message)
         _error(status, error_code, std_message)
 
-    return _success("Attendance marked successfully.", confidence=confidence, match=True)
+    return _success("Attendance marked successfully.", confidence=confidence, match=True, liveness=liveness)
 
 
 @app.post("/mark_attendance")
@@ -315,24 +682,132 @@ async def mark_attendance(request: MarkAttendanceRequest):
     if not request.student_id or not request.image:
         _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
 
+    # Replays spend rate-limit budget too; a frame rejected moments ago gets
+    # the same rejection without another verification.
     _check_rate_limit(request.student_id)
-    match, confidence, message = _verify_face_with_timeout(request.student_id, request.image)
+    phash = await run_in_threadpool(frame_hash, request.image) if replay_cache_enabled() else None
+    replayed = lookup_replayed_verification(request.student_id, phash)
+    if replayed is not None:
+        match, confidence, message, liveness = replayed
+        _audit_verification(
+            "mark_attendance",
+            request.student_id,
+            await _student_tenant(request.student_id),
+            time.perf_counter(),
+            replayed,
+            replayed=True,
+        )
+    else:
+        match, confidence, message, liveness = await _verify_face_with_timeout(
+            request.student_id, request.image, request.burst, source="mark_attendance", phash=phash
+        )
 
     if not match:
         status, error_code, std_message = _map_face_failure(message)
         _error(status, error_code, std_message)
 
-    marked, result_code, result_message = mark_student_attendance(request.student_id, confidence, request.subject)
+    marked, result_code, result_message = await run_in_threadpool(
+        mark_student_attendance, request.student_id, confidence, request.subject
+    )
     if not marked:
-        if result_code == "DUPLICATE_ATTENDANCE":
-            _error(400, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today.")
-        if result_code == "OUTSIDE_TIME_WINDOW":
-            _error(403, "OUTSIDE_TIME_WINDOW", "Attendance allowed only during lecture time.")
-        if result_code == "INVALID_PAYLOAD":
-            _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
-        _error(500, "INTERNAL_ERROR", "Internal server error.")
+        _raise_attendance_failure(result_code)
+
+    return _success("Attendance marked successfully.", confidence=confidence, liveness=liveness)
+
+
+@app.post("/api/v1/mark_attendance/batch")
+@app.post("/api/v1/mark-attendance/batch")
+async def mark_attendance_batch(request: BatchAttendanceRequest, user=Depends(require_admin)):
+    images = list(request.images or [])
+    if request.image:
+        images.append(request.image)
+    if not images or len(images) > BATCH_MAX_FRAMES or not all(images):
+        _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
+
+    _, admin_id = await run_in_threadpool(_resolve_admin_context, user)
+    matches, stats = await _identify_faces_with_timeout(admin_id, images)
+    if matches is None:
+        status, error_code, std_message = _map_face_failure(stats)
+        _error(status, error_code, std_message)
+
+    ok, results, _ = await run_in_threadpool(mark_attendance_bulk, admin_id, matches, request.subject)
+    if not ok:
+        _raise_attendance_failure(results)
+
+    students = [
+        {"student_id": student_id, "marked": marked, "result_code": code, "confidence": matches[student_id]}
+        for student_id, (marked, code, _) in results.items()
+    ]
+    average_confidence = round(sum(matches.values()) / len(matches), 2) if matches else 0.0
+    return _success(
+        "Attendance marked successfully.",
+        confidence=average_confidence,
+        faces_detected=stats["faces_detected"],
+        students_matched=stats["students_matched"],
+        marked_count=sum(1 for row in students if row["marked"]),
+        duplicate_count=sum(1 for row in students if row["result_code"] == "DUPLICATE_ATTENDANCE"),
+        students=students,
+    )
+
 
-    return _success("Attendance marked successfully.", confidence=confidence)
+@app.post("/api/v1/mark_attendance/stream")
+@app.post("/api/v1/mark-attendance/stream")
+async def mark_attendance_stream(
+    clip: UploadFile = File(...),
+    subject: Optional[str] = Form(None),
+    user=Depends(require_admin),
+):
+    _, admin_id = await run_in_threadpool(_resolve_admin_context, user)
+    # VideoCapture needs a real file to demux H.264/MJPEG containers.
+    suffix = os.path.splitext(clip.filename or "")[1] or ".mp4"
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        try:
+            await run_in_threadpool(save_clip, clip.file, tmp)
+        except ClipTooLarge:
+            _error(413, "PAYLOAD_TOO_LARGE", "Video clip exceeds the allowed size or duration.")
+        session = await run_in_threadpool(StreamAttendanceSession, admin_id, subject)
+        frames = iter_clip_frames(tmp.name)
+        started = time.perf_counter()
+        try:
+            # One face-pool job per frame, so the clip shares workers with
+            # other tenants instead of holding one until it ends.
+            while (frame := await run_in_threadpool(next, frames, None)) is not None:
+                await _run_face_job(admin_id, "stream", session.process_frame, frame, timeout=FRAME_TIMEOUT_SECONDS)
+        except FrameTooLarge:
+            _error(413, "IMAGE_TOO_LARGE", "Image exceeds the allowed size.")
+        except ClipTooLarge:
+            _error(413, "PAYLOAD_TOO_LARGE", "Video clip exceeds the allowed size or duration.")
+        except ValueError:
+            _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
+        finally:
+            frames.close()
+
+    summary = session.summary()
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return _success("Attendance marked successfully.", confidence=0.0, **summary)
+
+
+@app.post("/api/v1/mark_attendance/stream/mjpeg")
+@app.post("/api/v1/mark-attendance/stream/mjpeg")
+async def mark_attendance_mjpeg(request: Request, subject: Optional[str] = None, user=Depends(require_admin)):
+    _, admin_id = await run_in_threadpool(_resolve_admin_context, user)
+    session = await run_in_threadpool(StreamAttendanceSession, admin_id, subject)
+    splitter = MjpegSplitter()
+    started = time.perf_counter()
+    try:
+        async for chunk in request.stream():
+            # Decoding is CPU work; keep it off the event loop.
+            for frame in await run_in_threadpool(splitter.feed, chunk):
+                await _run_face_job(admin_id, "stream", session.process_frame, frame, timeout=FRAME_TIMEOUT_SECONDS)
+            if splitter.exhausted:
+                break
+    except FrameTooLarge:
+        _error(413, "IMAGE_TOO_LARGE", "Image exceeds the allowed size.")
+
+    summary = session.summary()
+    summary["frames_rejected"] = splitter.rejected
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return _success("Attendance marked successfully.", confidence=0.0, **summary)
 
 
 @app.post("/delete_face")
@@ -341,56 +816,157 @@ async def mark_attendance(request: MarkAttendanceRequest):
 @app.post("/api/v1/delete_face")
 @app.post("/api/v1/delete-face")
 @app.post("/api/v1/delete_student_data")
-async def delete_face(request: DeleteFaceRequest, user=Depends(require_admin)):
+def delete_face(request: DeleteFaceRequest, user=Depends(require_admin)):
     if not request.student_id:
         _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
 
     client, admin_id = _resolve_admin_context(user)
     _assert_student_scope(client, admin_id, request.student_id)
 
-    success, _ = delete_student_face(request.student_id)
+    success, _ = delete_student_face(request.student_id, admin_id)
+    record_event("delete", student_id=request.student_id, admin_id=admin_id, success=bool(success))
     if not success:
         _error(500, "INTERNAL_ERROR", "Internal server error.")
+    bump_data_version(admin_id)
     return _success("Attendance marked successfully.", confidence=100.0)
 
 
+@app.post("/api/v1/students/enroll/bulk")
+@app.post("/api/v1/students/enroll-bulk")
+def bulk_enroll_faces(archive: UploadFile = File(...), user=Depends(require_admin)):
+    client, admin_id = _resolve_admin_context(user)
+    if not zipfile.is_zipfile(archive.file):
+        _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
+    archive.file.seek(0)
+    try:
+        slot = get_tenant_scheduler().acquire_slot(admin_id, "enroll")
+    except QuotaExceeded as exc:
+        _raise_quota_exceeded(exc)
+
+    def report():
+        for entry in enroll_images(admin_id, iter_zip_images(archive.file), client=client):
+            if entry.get("error") and not entry.get("error_code"):
+                entry["error_code"] = _map_face_failure(entry["error"])[1]
+            if not entry.get("summary"):
+                record_event(
+                    "register",
+                    source="bulk",
+                    student_id=entry.get("student_id"),
+                    admin_id=admin_id,
+                    file=entry.get("file"),
+                    success=entry.get("success"),
+                    error_code=entry.get("error_code"),
+                )
+            yield json.dumps(entry) + "\n"
+
+    # Released by the response, which runs even if the client disconnects
+    # before the generator is first resumed.
+    return ReleasingStreamingResponse(
+        report(), lambda: get_tenant_scheduler().release_slot(slot), media_type="application/x-ndjson"
+    )
+
+
 @app.get("/api/v1/export/csv")
-async def export_attendance_csv(user=Depends(require_admin)):
+def export_attendance_csv(request: Request, include_absent: bool = False, user=Depends(require_admin)):
     client, admin_id = _resolve_admin_context(user)
-    records = _get_admin_attendance_records(client, admin_id)
-    if not records:
-        _error(404, "NO_DATA", "No attendance records found.")
-    return _build_csv_response(records)
+    record_event("export", admin_id=admin_id, format="csv", include_absent=include_absent)
+    build = _in_tenant_slot(admin_id, "export", lambda: _build_export(client, admin_id, "csv", include_absent))
+    return _cached_response(request, admin_id, "export", ("csv", include_absent), build)
 
 
 @app.get("/api/v1/export/pdf")
-async def export_attendance_pdf(user=Depends(require_admin)):
+def export_attendance_pdf(request: Request, include_absent: bool = False, user=Depends(require_admin)):
     client, admin_id = _resolve_admin_context(user)
-    records = _get_admin_attendance_records(client, admin_id)
-    if not records:
-        _error(404, "NO_DATA", "No attendance records found.")
-    return _build_pdf_response(records)
+    record_event("export", admin_id=admin_id, format="pdf", include_absent=include_absent)
+    build = _in_tenant_slot(admin_id, "export", lambda: _build_export(client, admin_id, "pdf", include_absent))
+    return _cached_response(request, admin_id, "export", ("pdf", include_absent), build)
 
 
 @app.post("/export_attendance")
 @app.post("/api/v1/export")
-async def export_attendance(request: ExportRequest, user=Depends(require_admin)):
+def export_attendance(request: ExportRequest, http_request: Request, user=Depends(require_admin)):
     export_format = request.format.lower()
+    if export_format not in ("csv", "pdf"):
+        _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
     client, admin_id = _resolve_admin_context(user)
-    records = _get_admin_attendance_records(client, admin_id)
-    if not records:
-        _error(404, "NO_DATA", "No attendance records found.")
 
-    if export_format == "csv":
-        return _build_csv_response(records)
-    if export_format == "pdf":
-        return _build_pdf_response(records)
+    record_event("export", admin_id=admin_id, format=export_format, include_absent=request.include_absent)
+    return _cached_response(
+        http_request,
+        admin_id,
+        "export",
+        (export_format, request.include_absent),
+        _in_tenant_slot(
+            admin_id, "export", lambda: _build_export(client, admin_id, export_format, request.include_absent)
+        ),
+    )
 
-    _error(400, "INVALID_PAYLOAD", "Missing required parameters.")
+
+def _parse_date_param(value: Optional[str]) -> Optional[str]:
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        _error(400, "INVALID_PAYLOAD", "Dates must be YYYY-MM-DD.")
+
+
+def _local_today(admin_id: str) -> date:
+    # "Today" in the admin's timetable timezone, not the server's.
+    return get_schedule().timetable(admin_id).today()
+
+
+@app.get("/api/v1/attendance")
+def list_attendance(
+    request: Request,
+    student_id: Optional[str] = None,
+    subject: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    fields: Optional[str] = None,
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    user=Depends(require_admin),
+):
+    client, admin_id = _resolve_admin_context(user)
+    selected = None
+    if fields:
+        selected = [f.strip() for f in fields.split(",") if f.strip()]
+        if not selected or any(f not in HISTORY_FIELDS for f in selected):
+            _error(400, "INVALID_PAYLOAD", f"fields must be a subset of: {', '.join(HISTORY_FIELDS)}.")
+
+    try:
+        rows, next_cursor = query_attendance(
+            client,
+            admin_id=admin_id,
+            student_id=student_id,
+            subject=subject,
+            date_from=_parse_date_param(date_from),
+            date_to=_parse_date_param(date_to),
+            fields=selected,
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError:
+        _error(400, "INVALID_CURSOR", "Pagination cursor is invalid.")
+
+    etag = _etag_for([rows, next_cursor])
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse(
+        content=_success(
+            "Attendance records retrieved.",
+            records=rows,
+            count=len(rows),
+            next_cursor=next_cursor,
+        ),
+        headers=headers,
+    )
 
 
 @app.post("/api/v1/repair")
-async def repair_attendance(user=Depends(require_admin)):
+def repair_attendance(user=Depends(require_admin)):
     client, admin_id = _resolve_admin_context(user)
     attendance_res = (
         client.table("attendance")
@@ -415,6 +991,8 @@ async def repair_attendance(user=Depends(require_admin)):
     for row_id in duplicate_ids:
         client.table("attendance").delete().eq("id", row_id).execute()
         removed += 1
+    if removed:
+        bump_data_version(admin_id)
 
     return _success(
         "Attendance marked successfully.",
@@ -425,9 +1003,12 @@ async def repair_attendance(user=Depends(require_admin)):
 
 
 @app.get("/api/v1/statistics")
-async def get_statistics(user=Depends(require_admin)):
+def get_statistics(request: Request, user=Depends(require_admin)):
     client, admin_id = _resolve_admin_context(user)
+    return _cached_response(request, admin_id, "statistics", (), lambda: _build_statistics(client, admin_id))
+
 
+def _build_statistics(client, admin_id: str):
     students_res = client.table("students").select("id, name, roll_number").eq("admin_id", admin_id).execute()
     students = students_res.data or []
     student_map = {row["id"]: row for row in students if row.get("id")}
@@ -473,7 +1054,7 @@ async def get_statistics(user=Depends(require_admin)):
         else 0.0
     )
 
-    return _success(
+    payload = _success(
         "Attendance marked successfully.",
         confidence=avg_confidence,
         total_students=total_students,
@@ -483,6 +1064,71 @@ async def get_statistics(user=Depends(require_admin)):
         overall_attendance_rate=overall_rate,
         most_regular_student=most_regular,
     )
+    return FastJSONResponse(content=payload).body, "application/json", {}
+
+
+@app.get("/api/v1/analytics")
+def get_analytics(
+    request: Request,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    at_risk_below: float = Query(AT_RISK_PERCENT, ge=0, le=100),
+    user=Depends(require_admin),
+):
+    client, admin_id = _resolve_admin_context(user)
+    date_from, date_to = _parse_date_param(date_from), _parse_date_param(date_to)
+
+    def build():
+        analytics = load_admin_analytics(client, admin_id, date_from, date_to, at_risk_below)
+        payload = _success("Attendance analytics computed.", **analytics)
+        return FastJSONResponse(content=payload).body, "application/json", {}
+
+    return _cached_response(request, admin_id, "analytics", (date_from, date_to, at_risk_below), build)
+
+
+@app.get("/api/v1/absentees")
+def get_absentees(request: Request, day: Optional[str] = Query(None, alias="date"), user=Depends(require_admin)):
+    client, admin_id = _resolve_admin_context(user)
+    day = _parse_date_param(day) or _local_today(admin_id).isoformat()
+
+    def build():
+        roster = load_roster(client, admin_id, date.fromisoformat(day), date.fromisoformat(day))
+        absentees = roster.absentees(day)
+        enrolled = int(roster.enrolled[:, 0].sum()) if roster.days else 0
+        payload = _success(
+            "Absentees computed.",
+            date=day,
+            session=bool(roster.days),
+            total_students=enrolled,
+            present_count=enrolled - len(absentees),
+            absent_count=len(absentees),
+            absentees=absentees,
+        )
+        return FastJSONResponse(content=payload).body, "application/json", {}
+
+    return _cached_response(request, admin_id, "absentees", (day,), build)
+
+
+@app.get("/api/v1/register")
+def get_monthly_register(request: Request, month: Optional[str] = None, user=Depends(require_admin)):
+    client, admin_id = _resolve_admin_context(user)
+    try:
+        first = date.fromisoformat(f"{month}-01") if month else _local_today(admin_id).replace(day=1)
+    except ValueError:
+        _error(400, "INVALID_PAYLOAD", "month must be YYYY-MM.")
+    last = (first.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+    def build():
+        roster = load_roster(client, admin_id, first, last)
+        payload = _success(
+            "Attendance register computed.",
+            month=first.strftime("%Y-%m"),
+            days=roster.days,
+            students=roster.register(),
+        )
+        return FastJSONResponse(content=payload).body, "application/json", {}
+
+    return _cached_response(request, admin_id, "register", (first.isoformat(),), build)
 
 
 if __name__ == "__main__":
@@ -1,45 +1,380 @@
+import base64
+import binascii
+import json
+import logging
 import os
-from datetime import datetime
-from typing import Optional
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from typing import Dict, List, Optional
 
+from cache_service import bump_data_version
 from database_service import get_supabase_client
+from gallery_service import fetch_all_rows
+from local_store_service import LOCAL_STORE_ENABLED, get_local_store
+from schedule_service import get_schedule
 
+logger = logging.getLogger(__name__)
 
-def _within_lecture_window(now: Optional[datetime] = None) -> bool:
-    now = now or datetime.now()
-    start_hour = int(os.environ.get("ATTENDANCE_START_HOUR", "0"))
-    end_hour = int(os.environ.get("ATTENDANCE_END_HOUR", "23"))
-    current_hour = now.hour
-    return start_hour <= current_hour <= end_hour
+# Optional write-behind buffer: attendance rows are committed to a local
+# SQLite (WAL) file, acknowledged, and flushed to Supabase in multi-row
+# inserts by a background thread.
+# LOCAL_STORE (offline kiosks) always queues attendance writes locally.
+WRITE_BEHIND_ENABLED = (
+    os.environ.get("ATTENDANCE_WRITE_BEHIND", "0").lower() in ("1", "true", "yes") or LOCAL_STORE_ENABLED
+)
+WRITE_BEHIND_PATH = os.environ.get(
+    "ATTENDANCE_BUFFER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".attendance_buffer.db"),
+)
+FLUSH_INTERVAL_MS = int(os.environ.get("ATTENDANCE_FLUSH_MS", 500))
+FLUSH_MAX_ROWS = int(os.environ.get("ATTENDANCE_FLUSH_ROWS", 200))
+# Rows claimed by a flusher that died are handed out again after this long.
+CLAIM_TIMEOUT_SECONDS = 60
+# How often the buffer pulls today's remote rows so local duplicate checks
+# also see marks made on other nodes.
+REMOTE_SYNC_SECONDS = int(os.environ.get("ATTENDANCE_REMOTE_SYNC_SECONDS", 30))
+
+_PENDING, _IN_FLIGHT, _FLUSHED = 0, 1, 2
+
+
+def is_lecture_day(day: date, admin_id: Optional[str] = None) -> bool:
+    """
+    Whether ``day`` is a lecture day on ``admin_id``'s timetable (one of its
+    lecture weekdays and not a holiday). Absentee reports only count students
+    absent on these days.
+    """
+    return get_schedule().timetable(admin_id).is_lecture_day(day)
+
+
+class AttendanceWriteBuffer:
+    """
+    Durable local queue of attendance rows.
+
+    enqueue() returns only after the row is committed with synchronous=FULL,
+    so an acknowledged mark survives a crash; unflushed rows are picked up
+    again on the next start. Delivery to Supabase is at-least-once: a crash
+    between the remote insert and the local commit can re-send a batch,
+    which /api/v1/repair cleans up.
+    """
+
+    def __init__(
+        self,
+        path=WRITE_BEHIND_PATH,
+        client_factory=get_supabase_client,
+        flush_interval_ms=FLUSH_INTERVAL_MS,
+        flush_max_rows=FLUSH_MAX_ROWS,
+    ):
+        self.path = path
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_max_rows = flush_max_rows
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.conflicts_dropped = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS attendance_buffer (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT NOT NULL,
+                date TEXT NOT NULL,
+                subject TEXT NOT NULL DEFAULT '',
+                payload TEXT NOT NULL,
+                state INTEGER NOT NULL DEFAULT 0,
+                claimed_at REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_buffer_lookup ON attendance_buffer (student_id, date, subject)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS attendance_buffer_state ON attendance_buffer (state, id)")
+
+    def _is_duplicate(self, student_id, date, subject):
+        # Same rule as the remote check: without a subject any row that day
+        # counts, with a subject only a row for that subject does.
+        if subject:
+            sql = "SELECT 1 FROM attendance_buffer WHERE student_id = ? AND date = ? AND subject = ? LIMIT 1"
+            args = (student_id, date, subject)
+        else:
+            sql = "SELECT 1 FROM attendance_buffer WHERE student_id = ? AND date = ? LIMIT 1"
+            args = (student_id, date)
+        return self._conn.execute(sql, args).fetchone() is not None
+
+    def contains(self, student_id, date, subject=None):
+        with self._lock:
+            return self._is_duplicate(student_id, date, subject or "")
+
+    def enqueue_many(self, payloads: List[dict]):
+        """
+        Durably queue rows. Returns one bool per payload: False for a duplicate.
+        """
+        accepted = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for payload in payloads:
+                    subject = payload.get("subject") or ""
+                    if self._is_duplicate(payload["student_id"], payload["date"], subject):
+                        accepted.append(False)
+                        continue
+                    self._conn.execute(
+                        "INSERT INTO attendance_buffer (student_id, date, subject, payload) VALUES (?, ?, ?, ?)",
+                        (payload["student_id"], payload["date"], subject, json.dumps(payload)),
+                    )
+                    accepted.append(True)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            backlog = self._conn.execute(
+                "SELECT COUNT(*) FROM attendance_buffer WHERE state = ?", (_PENDING,)
+            ).fetchone()[0]
+        if backlog >= self.flush_max_rows:
+            self._wake.set()
+        return accepted
+
+    def enqueue(self, payload: dict):
+        return self.enqueue_many([payload])[0]
+
+    def _claim(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE attendance_buffer SET state = ?, claimed_at = NULL WHERE state = ? AND claimed_at < ?",
+                    (_PENDING, _IN_FLIGHT, time.time() - CLAIM_TIMEOUT_SECONDS),
+                )
+                rows = self._conn.execute(
+                    "SELECT id, payload FROM attendance_buffer WHERE state = ? ORDER BY id LIMIT ?",
+                    (_PENDING, self.flush_max_rows),
+                ).fetchall()
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE attendance_buffer SET state = ?, claimed_at = ? WHERE id = ?",
+                        [(_IN_FLIGHT, time.time(), row_id) for row_id, _ in rows],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def _set_state(self, ids, state):
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE attendance_buffer SET state = ?, claimed_at = NULL WHERE id = ?",
+                [(state, row_id) for row_id in ids],
+            )
+
+    def _remote_conflicts(self, client, payloads):
+        """
+        Indexes of payloads that already exist remotely under the
+        (student_id, date, subject) duplicate rule, e.g. marked on another
+        kiosk while this one was offline.
+        """
+        student_ids = sorted({p["student_id"] for p in payloads})
+        dates = sorted({p["date"] for p in payloads})
+        res = (
+            client.table("attendance")
+            .select("student_id, date, subject")
+            .in_("student_id", student_ids)
+            .in_("date", dates)
+            .execute()
+        )
+        remote_days = set()
+        remote_subjects = set()
+        for row in res.data or []:
+            remote_days.add((row.get("student_id"), row.get("date")))
+            remote_subjects.add((row.get("student_id"), row.get("date"), row.get("subject") or ""))
+
+        conflicts = []
+        for i, payload in enumerate(payloads):
+            subject = payload.get("subject") or ""
+            day = (payload["student_id"], payload["date"])
+            if (subject and day + (subject,) in remote_subjects) or (not subject and day in remote_days):
+                conflicts.append(i)
+        return conflicts
+
+    def flush(self):
+        """
+        Send pending rows to Supabase in multi-row inserts. Returns rows sent.
+        Rows that turn out to be duplicates of remote rows are dropped.
+        """
+        sent = 0
+        while True:
+            rows = self._claim()
+            if not rows:
+                break
+            ids = [row_id for row_id, _ in rows]
+            payloads = [json.loads(p) for _, p in rows]
+            try:
+                client = self._client_factory()
+                conflicts = set(self._remote_conflicts(client, payloads))
+                fresh = [p for i, p in enumerate(payloads) if i not in conflicts]
+                if fresh:
+                    client.table("attendance").insert(fresh).execute()
+            except Exception as e:
+                logger.warning(f"Attendance flush of {len(rows)} rows failed, will retry: {e}")
+                self._set_state(ids, _PENDING)
+                break
+            if conflicts:
+                self.conflicts_dropped += len(conflicts)
+                logger.info(f"Dropped {len(conflicts)} buffered attendance rows already recorded remotely")
+            self._set_state(ids, _FLUSHED)
+            sent += len(fresh)
+            if len(rows) < self.flush_max_rows:
+                break
+
+        # Flushed rows only matter for today's duplicate checks.
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM attendance_buffer WHERE state = ? AND date < ?",
+                (_FLUSHED, datetime.now().date().isoformat()),
+            )
+        return sent
+
+    def sync_remote_today(self):
+        """
+        Copy today's remote attendance into the buffer as already-flushed rows,
+        so duplicate checks can be answered locally.
+        """
+        today = datetime.now().date().isoformat()
+        rows = fetch_all_rows(self._client_factory(), "attendance", "student_id, date, subject", [("date", today)])
+        seeded = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    subject = row.get("subject") or ""
+                    exists = self._conn.execute(
+                        "SELECT 1 FROM attendance_buffer WHERE student_id = ? AND date = ? AND subject = ? LIMIT 1",
+                        (row.get("student_id"), today, subject),
+                    ).fetchone()
+                    if exists or not row.get("student_id"):
+                        continue
+                    self._conn.execute(
+                        "INSERT INTO attendance_buffer (student_id, date, subject, payload, state) VALUES (?, ?, ?, ?, ?)",
+                        (row["student_id"], today, subject, json.dumps(row), _FLUSHED),
+                    )
+                    seeded += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return seeded
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM attendance_buffer WHERE state != ?", (_FLUSHED,)
+            ).fetchone()[0]
+
+    def _run(self):
+        last_remote_sync = 0.0
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if LOCAL_STORE_ENABLED and time.monotonic() - last_remote_sync >= REMOTE_SYNC_SECONDS:
+                    self.sync_remote_today()
+                    last_remote_sync = time.monotonic()
+            except Exception as e:
+                logger.error(f"Attendance flusher error: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="attendance-flusher", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        try:
+            self.flush()
+        finally:
+            self._conn.close()
+
+
+_write_buffer = None
+_write_buffer_lock = threading.Lock()
+
+
+def get_write_buffer():
+    """
+    Returns the process's write-behind buffer, or None when it is disabled.
+    """
+    global _write_buffer
+    if not WRITE_BEHIND_ENABLED:
+        return None
+    if _write_buffer is None:
+        with _write_buffer_lock:
+            if _write_buffer is None:
+                _write_buffer = AttendanceWriteBuffer().start()
+    return _write_buffer
+
+
+def close_write_buffer():
+    global _write_buffer
+    with _write_buffer_lock:
+        if _write_buffer is not None:
+            _write_buffer.close()
+            _write_buffer = None
 
 
 def mark_student_attendance(student_id: str, confidence: float, subject: Optional[str] = None):
     """
-    Mark attendance with duplicate prevention and optional subject support.
+    Mark attendance with duplicate prevention. The student's admin timetable
+    decides whether a session is in progress and, when ``subject`` isn't
+    given, which subject it is.
     Returns:
       (True, "ATTENDANCE_MARKED", "Attendance marked successfully.")
       (False, "<ERROR_CODE>", "<MESSAGE>")
     """
     client = get_supabase_client()
     now = datetime.now()
-    today = now.date().isoformat()
 
     try:
-        if not _within_lecture_window(now):
+        buffer = get_write_buffer()
+        store = get_local_store()
+        student = store.get_student(student_id) if store is not None else None
+        # Offline-tolerant path: the buffer holds today's remote rows and the
+        # mirror knows the student, so no remote round trip is needed.
+        offline = student is not None and buffer is not None
+        if offline:
+            admin_id = student.get("admin_id")
+        else:
+            student_res = client.table("students").select("admin_id").eq("id", student_id).execute()
+            if not student_res.data:
+                return False, "INVALID_PAYLOAD", "Missing required parameters."
+            admin_id = student_res.data[0].get("admin_id")
+
+        in_session, subject, session_date = get_schedule().resolve(admin_id, subject)
+        if not in_session:
             return False, "OUTSIDE_TIME_WINDOW", "Attendance allowed only during lecture time."
+        today = session_date.isoformat()
 
-        query = client.table("attendance").select("id").eq("student_id", student_id).eq("date", today)
-        if subject:
-            query = query.eq("subject", subject)
-        existing = query.execute()
-        if existing.data:
+        if buffer is not None and buffer.contains(student_id, today, subject):
             return False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today."
+        if not offline:
+            query = client.table("attendance").select("id").eq("student_id", student_id).eq("date", today)
+            if subject:
+                query = query.eq("subject", subject)
+            existing = query.execute()
+            if existing.data:
+                return False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today."
 
-        student_res = client.table("students").select("admin_id").eq("id", student_id).execute()
-        if not student_res.data:
-            return False, "INVALID_PAYLOAD", "Missing required parameters."
-
-        admin_id = student_res.data[0].get("admin_id")
         payload = {
             "student_id": student_id,
             "admin_id": admin_id,
@@ -52,20 +387,156 @@ def mark_student_attendance(student_id: str, confidence: float, subject: Optiona
         if subject:
             payload["subject"] = subject
 
-        client.table("attendance").insert(payload).execute()
+        if buffer is not None:
+            if not buffer.enqueue(payload):
+                return False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today."
+        else:
+            client.table("attendance").insert(payload).execute()
+        bump_data_version(admin_id)
         return True, "ATTENDANCE_MARKED", "Attendance marked successfully."
     except Exception:
         return False, "INTERNAL_ERROR", "Internal server error."
 
 
-def get_attendance_history(student_id: str):
+def mark_attendance_bulk(admin_id: str, confidences: Dict[str, float], subject: Optional[str] = None):
+    """
+    Mark attendance for many of one admin's students with a single duplicate
+    check and a single multi-row insert.
+    Returns:
+      (True, {student_id: (marked, code, message)}, "")
+      (False, "<ERROR_CODE>", "<MESSAGE>")
+    """
+    client = get_supabase_client()
+    now = datetime.now()
+
+    try:
+        in_session, subject, session_date = get_schedule().resolve(admin_id, subject)
+        if not in_session:
+            return False, "OUTSIDE_TIME_WINDOW", "Attendance allowed only during lecture time."
+        today = session_date.isoformat()
+        if not confidences:
+            return True, {}, ""
+
+        query = (
+            client.table("attendance")
+            .select("student_id")
+            .eq("admin_id", admin_id)
+            .eq("date", today)
+            .in_("student_id", list(confidences))
+        )
+        if subject:
+            query = query.eq("subject", subject)
+        already_marked = {row.get("student_id") for row in (query.execute().data or [])}
+
+        results = {}
+        payloads = []
+        for student_id, confidence in confidences.items():
+            if student_id in already_marked:
+                results[student_id] = (False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today.")
+                continue
+            payload = {
+                "student_id": student_id,
+                "admin_id": admin_id,
+                "date": today,
+                "status": "present",
+                "verified": True,
+                "confidence": float(confidence),
+                "created_at": now.isoformat(),
+            }
+            if subject:
+                payload["subject"] = subject
+            payloads.append(payload)
+            results[student_id] = (True, "ATTENDANCE_MARKED", "Attendance marked successfully.")
+
+        buffer = get_write_buffer()
+        if payloads and buffer is not None:
+            for payload, accepted in zip(payloads, buffer.enqueue_many(payloads)):
+                if not accepted:
+                    results[payload["student_id"]] = (
+                        False,
+                        "DUPLICATE_ATTENDANCE",
+                        "Attendance already recorded for today.",
+                    )
+        elif payloads:
+            client.table("attendance").insert(payloads).execute()
+        if payloads:
+            bump_data_version(admin_id)
+        return True, results, ""
+    except Exception:
+        return False, "INTERNAL_ERROR", "Internal server error."
+
+
+HISTORY_FIELDS = ("id", "student_id", "admin_id", "date", "subject", "status", "verified", "confidence", "created_at")
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+
+def encode_history_cursor(row) -> str:
+    raw = json.dumps([row["date"], row["id"]], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_history_cursor(cursor: str):
+    """
+    Returns the (date, id) a page ended on. Raises ValueError for anything
+    that isn't a cursor we issued.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        last_date, last_id = json.loads(raw)
+        date.fromisoformat(last_date)
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    # Ids are bigints or UUIDs; anything else could smuggle filter syntax.
+    if isinstance(last_id, bool) or not isinstance(last_id, (int, str)):
+        raise ValueError("Invalid cursor id")
+    if not str(last_id).replace("-", "").isalnum():
+        raise ValueError("Invalid cursor id")
+    return last_date, last_id
+
+
+def query_attendance(
+    client,
+    admin_id: Optional[str] = None,
+    student_id: Optional[str] = None,
+    subject: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    fields=None,
+    limit: int = HISTORY_PAGE_SIZE,
+    cursor: Optional[str] = None,
+):
+    """
+    One page of attendance, newest first, keyset-paginated on (date, id) so
+    deep pages cost the same as the first one with the
+    attendance(admin_id, date, id) index.
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    # The cursor columns are always selected.
+    columns = ["date", "id"] + [f for f in (fields or HISTORY_FIELDS) if f not in ("date", "id")]
+    query = client.table("attendance").select(", ".join(columns))
+    if admin_id:
+        query = query.eq("admin_id", admin_id)
+    if student_id:
+        query = query.eq("student_id", student_id)
+    if subject:
+        query = query.eq("subject", subject)
+    if date_from:
+        query = query.gte("date", date_from)
+    if date_to:
+        query = query.lte("date", date_to)
+    if cursor:
+        last_date, last_id = decode_history_cursor(cursor)
+        query = query.or_(f"date.lt.{last_date},and(date.eq.{last_date},id.lt.{last_id})")
+
+    limit = max(1, min(int(limit), HISTORY_MAX_PAGE_SIZE))
+    res = query.order("date", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    rows = res.data or []
+    next_cursor = encode_history_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def get_attendance_history(student_id: str, limit: int = 20):
     client = get_supabase_client()
-    res = (
-        client.table("attendance")
-        .select("*")
-        .eq("student_id", student_id)
-        .order("date", ascending=False)
-        .limit(20)
-        .execute()
-    )
-    return res.data
+    rows, _ = query_attendance(client, student_id=student_id, limit=limit)
+    return rows
@@ -0,0 +1,291 @@
+"""
+Append-only audit log of face verifications, registrations, deletions and
+exports.
+
+record() only appends to an in-memory queue; a background thread writes the
+queue out in batches (every AUDIT_FLUSH_MS, or sooner once AUDIT_FLUSH_ROWS
+are waiting) as JSON lines in AUDIT_DIR/audit-YYYY-MM-DD.jsonl. Each batch is
+a single O_APPEND write, so workers sharing the directory don't interleave
+lines. Files older than AUDIT_KEEP_DAYS are removed when the day rolls over.
+If the writer falls behind by AUDIT_MAX_BUFFERED events the oldest are
+dropped and counted rather than slowing requests down.
+
+Verification events carry the face distance, so FACE_MATCH_THRESHOLD can be
+tuned from real traffic: reviewers label events as genuine or impostor (more
+events in the same log) and far_frr() turns the labelled distances into
+FAR/FRR curves.
+
+Command line:
+    python audit_service.py label <event_id> genuine|impostor
+    python audit_service.py far-frr <date_from> <date_to> [admin_id]
+"""
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+AUDIT_ENABLED = os.environ.get("AUDIT_LOG", "1").lower() not in ("0", "false", "no")
+AUDIT_DIR = os.environ.get("AUDIT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".audit"))
+AUDIT_FLUSH_MS = int(os.environ.get("AUDIT_FLUSH_MS", 1000))
+AUDIT_FLUSH_ROWS = int(os.environ.get("AUDIT_FLUSH_ROWS", 500))
+AUDIT_MAX_BUFFERED = int(os.environ.get("AUDIT_MAX_BUFFERED", 50000))
+AUDIT_KEEP_DAYS = int(os.environ.get("AUDIT_KEEP_DAYS", 180))
+
+
+def _dumps(event):
+    if orjson is not None:
+        return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(event, separators=(",", ":"), default=float).encode("utf-8")
+
+
+def _file_for(directory, day):
+    return os.path.join(directory, f"audit-{day.isoformat()}.jsonl")
+
+
+class AuditLog:
+    def __init__(
+        self,
+        directory=AUDIT_DIR,
+        flush_interval_ms=AUDIT_FLUSH_MS,
+        flush_max_rows=AUDIT_FLUSH_ROWS,
+        max_buffered=AUDIT_MAX_BUFFERED,
+        keep_days=AUDIT_KEEP_DAYS,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_max_rows = flush_max_rows
+        self.keep_days = keep_days
+        self._queue = deque(maxlen=max_buffered)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._day = None
+        self.written = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, event, **fields):
+        """
+        Queue one event and return its id. Never blocks on I/O.
+        """
+        now = datetime.now(timezone.utc)
+        entry = {"id": secrets.token_hex(8), "ts": now.isoformat(), "event": event}
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self.dropped += 1
+            self._queue.append(entry)
+            backlog = len(self._queue)
+        if backlog >= self.flush_max_rows:
+            self._wake.set()
+        return entry["id"]
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._queue)
+
+    def flush(self):
+        """
+        Write out everything queued so far. Returns the number of events written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch = list(self._queue)
+                self._queue.clear()
+            if not batch:
+                return 0
+            by_day = {}
+            for entry in batch:
+                by_day.setdefault(entry["ts"][:10], []).append(_dumps(entry) + b"\n")
+            for day, lines in by_day.items():
+                day = date.fromisoformat(day)
+                self._rotate(day)
+                fd = os.open(_file_for(self.directory, day), os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                try:
+                    os.write(fd, b"".join(lines))
+                finally:
+                    os.close(fd)
+            self.written += len(batch)
+            return len(batch)
+
+    def _rotate(self, day):
+        if self._day is not None and day <= self._day:
+            return
+        self._day = day
+        if self.keep_days <= 0:
+            return
+        cutoff = _file_for(self.directory, day - timedelta(days=self.keep_days))
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith("audit-") and name.endswith(".jsonl") and path < cutoff:
+                os.remove(path)
+
+    def stats(self):
+        return {"written": self.written, "pending": self.pending_count(), "dropped": self.dropped}
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Audit log flush failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+
+_audit_log = None
+_audit_log_lock = threading.Lock()
+
+
+def get_audit_log():
+    """
+    Returns the process's audit log, or None when AUDIT_LOG=0.
+    """
+    global _audit_log
+    if not AUDIT_ENABLED:
+        return None
+    if _audit_log is None:
+        with _audit_log_lock:
+            if _audit_log is None:
+                _audit_log = AuditLog(AUDIT_DIR).start()
+    return _audit_log
+
+
+def close_audit_log():
+    global _audit_log
+    with _audit_log_lock:
+        if _audit_log is not None:
+            _audit_log.close()
+            _audit_log = None
+
+
+def record_event(event, **fields):
+    audit_log = get_audit_log()
+    if audit_log is None:
+        return None
+    try:
+        return audit_log.record(event, **fields)
+    except Exception as e:
+        logger.warning(f"Audit event {event} not recorded: {e}")
+        return None
+
+
+# Reading
+
+def read_events(date_from, date_to, directory=None, event=None, admin_id=None):
+    """
+    Yields events logged between date_from and date_to (UTC days, inclusive).
+    """
+    directory = directory or AUDIT_DIR
+    day = date_from
+    while day <= date_to:
+        path = _file_for(directory, day)
+        day += timedelta(days=1)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # torn last line of a crashed writer
+                if event is not None and entry.get("event") != event:
+                    continue
+                if admin_id is not None and entry.get("admin_id") != admin_id:
+                    continue
+                yield entry
+
+
+def load_scores(date_from, date_to, directory=None, admin_id=None):
+    """
+    (distances, genuine) arrays for the labelled verifications in range.
+    Labels may be logged up to AUDIT_KEEP_DAYS later; the newest one wins.
+    """
+    labels = {}
+    for entry in read_events(date_from, datetime.now(timezone.utc).date(), directory, event="label"):
+        labels[entry.get("ref")] = bool(entry.get("genuine"))
+    distances, genuine = [], []
+    for entry in read_events(date_from, date_to, directory, event="verify", admin_id=admin_id):
+        if entry.get("distance") is None or entry["id"] not in labels:
+            continue
+        distances.append(float(entry["distance"]))
+        genuine.append(labels[entry["id"]])
+    return np.asarray(distances, dtype=np.float64), np.asarray(genuine, dtype=bool)
+
+
+def far_frr(distances, genuine, thresholds=None):
+    """
+    False accept / false reject rates of the rule ``distance <= threshold``
+    at each threshold, plus the equal error rate.
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    genuine = np.asarray(genuine, dtype=bool)
+    thresholds = np.round(np.linspace(0.3, 0.8, 51), 3) if thresholds is None else np.asarray(thresholds)
+    genuine_sorted = np.sort(distances[genuine])
+    impostor_sorted = np.sort(distances[~genuine])
+    accepted_genuine = np.searchsorted(genuine_sorted, thresholds, side="right")
+    accepted_impostor = np.searchsorted(impostor_sorted, thresholds, side="right")
+    far = accepted_impostor / len(impostor_sorted) if len(impostor_sorted) else np.zeros(len(thresholds))
+    frr = 1.0 - accepted_genuine / len(genuine_sorted) if len(genuine_sorted) else np.zeros(len(thresholds))
+
+    eer = None
+    if len(genuine_sorted) and len(impostor_sorted):
+        i = int(np.argmin(np.abs(far - frr)))
+        eer = {"threshold": float(thresholds[i]), "rate": round(float((far[i] + frr[i]) / 2), 4)}
+    return {
+        "genuine": int(len(genuine_sorted)),
+        "impostor": int(len(impostor_sorted)),
+        "thresholds": [float(t) for t in thresholds],
+        "far": [round(float(v), 4) for v in far],
+        "frr": [round(float(v), 4) for v in frr],
+        "eer": eer,
+    }
+
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == "label" and argv[3] in ("genuine", "impostor"):
+        audit_log = AuditLog()
+        audit_log.record("label", ref=argv[2], genuine=argv[3] == "genuine")
+        audit_log.flush()
+        return 0
+    if len(argv) in (4, 5) and argv[1] == "far-frr":
+        distances, genuine = load_scores(
+            date.fromisoformat(argv[2]), date.fromisoformat(argv[3]), admin_id=argv[4] if len(argv) == 5 else None
+        )
+        print(json.dumps(far_frr(distances, genuine), indent=2))
+        return 0
+    print(__doc__)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
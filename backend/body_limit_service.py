@@ -0,0 +1,166 @@
+"""
+Request body size limits, enforced while the body streams in.
+
+A request whose Content-Length is over its route's limit gets 413 before
+any of the body is read. Bodies without a Content-Length (chunked uploads)
+are counted as they arrive and cut off with 413 at the first chunk over the
+limit, so an oversized upload never ends up fully buffered by Starlette or
+parsed by Pydantic.
+
+Built-in limits follow the routes: image routes allow as many base64 frames
+of FACE_MAX_IMAGE_BYTES as they accept (check-ins take a liveness burst,
+batch marking up to BATCH_MAX_FRAMES), archive and video uploads go to disk and get
+BODY_LIMIT_UPLOAD_BYTES, and everything else BODY_LIMIT_DEFAULT_BYTES.
+BODY_LIMITS overrides by path prefix ("/api/v1/register_face=8388608");
+the longest matching prefix wins and 0 means no limit.
+"""
+import os
+
+from fastapi import HTTPException
+
+from face_service import BATCH_MAX_FRAMES, LIVENESS_MAX_BURST, MAX_IMAGE_BYTES
+from response_service import FastJSONResponse
+
+DEFAULT_LIMIT = int(os.environ.get("BODY_LIMIT_DEFAULT_BYTES", 1024 * 1024))
+UPLOAD_LIMIT = int(os.environ.get("BODY_LIMIT_UPLOAD_BYTES", 512 * 1024 * 1024))
+# JSON keys, data-URL headers and the other fields.
+ENVELOPE_BYTES = 64 * 1024
+
+
+def _images(count):
+    return count * (MAX_IMAGE_BYTES * 4 // 3 + 4) + ENVELOPE_BYTES
+
+
+# Checked in order; the first rule with a marker in the path applies.
+_RULES = (
+    (("/enroll", "/stream"), UPLOAD_LIMIT),
+    (("/batch",), _images(BATCH_MAX_FRAMES)),
+    (("register_face", "register-face"), _images(1)),
+    (("mark_attendance", "mark-attendance", "verify_face", "verify-face"), _images(1 + LIVENESS_MAX_BURST)),
+)
+
+
+def _env_overrides():
+    overrides = {}
+    for item in os.environ.get("BODY_LIMITS", "").split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip():
+            overrides[key.strip()] = int(value)
+    return overrides
+
+
+class BodyTooLarge(HTTPException):
+    def __init__(self, limit):
+        super().__init__(
+            status_code=413,
+            detail={
+                "success": False,
+                "error_code": "PAYLOAD_TOO_LARGE",
+                "message": "Request body exceeds the allowed size.",
+            },
+            headers={"Connection": "close"},
+        )
+        self.limit = limit
+
+
+class BodyLimiter:
+    def __init__(self, overrides=None, default=DEFAULT_LIMIT):
+        overrides = _env_overrides() if overrides is None else dict(overrides)
+        self.default = overrides.pop("default", default)
+        self.prefixes = sorted(overrides.items(), key=lambda item: len(item[0]), reverse=True)
+        self.rejected_early = 0
+        self.rejected_streaming = 0
+
+    def limit_for(self, path):
+        """
+        Byte limit for a request path, or None for no limit.
+        """
+        limit = None
+        for prefix, value in self.prefixes:
+            if path.startswith(prefix):
+                limit = value
+                break
+        else:
+            for markers, value in _RULES:
+                if any(marker in path for marker in markers):
+                    limit = value
+                    break
+            else:
+                limit = self.default
+        return limit or None
+
+    def stats(self):
+        return {"rejected_early": self.rejected_early, "rejected_streaming": self.rejected_streaming}
+
+
+_limiter = BodyLimiter()
+
+
+def get_body_limiter():
+    return _limiter
+
+
+def _declared_length(scope):
+    for key, value in scope.get("headers") or ():
+        if key == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+async def _send_too_large(scope, receive, send, exc):
+    response = FastJSONResponse(status_code=413, content=exc.detail, headers=exc.headers)
+    await response(scope, receive, send)
+
+
+class BodyLimitMiddleware:
+    def __init__(self, app, limiter=None):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limiter = self.limiter or get_body_limiter()
+        limit = limiter.limit_for(scope.get("path", ""))
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        declared = _declared_length(scope)
+        if declared is not None and declared > limit:
+            limiter.rejected_early += 1
+            await _send_too_large(scope, receive, send, BodyTooLarge(limit))
+            return
+
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    limiter.rejected_streaming += 1
+                    # FastAPI re-raises HTTPExceptions from body reads, so the
+                    # app's handler usually answers; the except below covers
+                    # routes that read the stream themselves.
+                    raise BodyTooLarge(limit)
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except BodyTooLarge as exc:
+            if response_started:
+                raise
+            await _send_too_large(scope, receive, send, exc)
@@ -0,0 +1,106 @@
+"""
+Per-admin data versions and a small response cache for read-heavy endpoints.
+
+Every write that changes what an admin's statistics or exports would show
+bumps that admin's version. Cached responses are keyed on
+(admin, endpoint, params, version), so a bump invalidates them without
+tracking which entries depend on what.
+
+Versions live in process memory. Writes made by another worker, or straight
+to Supabase from the frontend, aren't seen here, so entries also expire after
+RESPONSE_CACHE_TTL_SECONDS, which bounds how stale a response can be.
+
+ETags depend only on the endpoint and the response body, so every worker
+issues the same tag for the same content and an unchanged response still
+revalidates as 304 after a version bump or a restart.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 30))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 256))
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_data_version(admin_id) -> int:
+    return _versions.get(str(admin_id), 0)
+
+
+def bump_data_version(admin_id):
+    if not admin_id:
+        return
+    with _versions_lock:
+        key = str(admin_id)
+        _versions[key] = _versions.get(key, 0) + 1
+
+
+def content_etag(endpoint, body):
+    """
+    Weak ETag for ``body`` served by ``endpoint``.
+    """
+    return f'W/"{endpoint}.{hashlib.sha1(body).hexdigest()[:16]}"'
+
+
+class CachedResponse:
+    __slots__ = ("etag", "body", "media_type", "headers", "expires_at")
+
+    def __init__(self, etag, body, media_type, headers, expires_at):
+        self.etag = etag
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    def __init__(self, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(admin_id, endpoint, params=()):
+        return (str(admin_id), endpoint, tuple(params), get_data_version(admin_id))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires_at < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, media_type, headers=None):
+        etag = content_etag(key[1], body)
+        entry = CachedResponse(etag, body, media_type, dict(headers or {}), time.monotonic() + self.ttl_seconds)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_response_cache = ResponseCache()
+
+
+def get_response_cache():
+    return _response_cache
@@ -0,0 +1,299 @@
+"""
+Per-admin face match thresholds calibrated from stored encodings.
+
+Every admin has one encoding per student, so every pair of their students is
+an impostor sample: the distance distribution over those pairs says how
+close two different faces in that school get. Genuine samples come from the
+audit log (audit_service): verifications that were accepted, rejections
+the same student got past on a retry within CALIBRATION_RETRY_SECONDS
+(almost always a false reject), and anything a reviewer labelled; labels
+win over both heuristics.
+
+The recommended threshold is the largest distance at which at most
+CALIBRATION_TARGET_FAR of the impostor pairs would be accepted, kept within
+[CALIBRATION_MIN_THRESHOLD, CALIBRATION_MAX_THRESHOLD]; the floor defaults
+to what FACE_MATCH_THRESHOLD / MIN_CONFIDENCE accept together. Pairwise distances
+are computed CALIBRATION_CHUNK_ROWS rows at a time and binned straight into
+a histogram, so memory stays at chunk x students however big the admin is.
+
+Results are written to FACE_THRESHOLDS_PATH; face_service picks them up
+(re-read when the file changes) and uses an admin's threshold in place of
+FACE_MATCH_THRESHOLD / MIN_CONFIDENCE. Admins with fewer than
+CALIBRATION_MIN_STUDENTS encodings are left on the defaults.
+
+Command line:
+    python calibration_service.py <admin_id | all> [days] [--write]
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from audit_service import read_events
+from database_service import get_supabase_client
+from gallery_service import fetch_admin_gallery, fetch_all_rows
+
+logger = logging.getLogger(__name__)
+
+THRESHOLDS_PATH = os.environ.get(
+    "FACE_THRESHOLDS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".face_thresholds.json"),
+)
+THRESHOLDS_RELOAD_SECONDS = float(os.environ.get("FACE_THRESHOLDS_RELOAD_SECONDS", 30))
+TARGET_FAR = float(os.environ.get("CALIBRATION_TARGET_FAR", 0.001))
+# Unset, the floor is the distance the default rule accepts, so calibration
+# never recommends a stricter threshold than the defaults; it may still
+# loosen up to CALIBRATION_MAX_THRESHOLD.
+MIN_THRESHOLD = float(os.environ["CALIBRATION_MIN_THRESHOLD"]) if os.environ.get("CALIBRATION_MIN_THRESHOLD") else None
+MAX_THRESHOLD = float(os.environ.get("CALIBRATION_MAX_THRESHOLD", 0.6))
+MIN_STUDENTS = int(os.environ.get("CALIBRATION_MIN_STUDENTS", 20))
+CHUNK_ROWS = int(os.environ.get("CALIBRATION_CHUNK_ROWS", 512))
+RETRY_SECONDS = int(os.environ.get("CALIBRATION_RETRY_SECONDS", 300))
+SAMPLE_DAYS = 30
+
+BIN_WIDTH = 0.001
+# Distances between 128-d face encodings stay well under 2.
+BINS = 2000
+
+
+def impostor_histogram(matrix, chunk_rows=CHUNK_ROWS):
+    """
+    (counts, nearest): histogram of the distances between every pair of
+    rows, in BIN_WIDTH bins, and each row's distance to its nearest other row.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    n = len(matrix)
+    counts = np.zeros(BINS, dtype=np.int64)
+    nearest = np.full(n, np.inf)
+    if n < 2:
+        return counts, nearest
+    norms = np.einsum("ij,ij->i", matrix, matrix)
+    for start in range(0, n, chunk_rows):
+        end = min(start + chunk_rows, n)
+        # Same |a|^2 + |b|^2 - 2ab expansion as face_service.match_encodings.
+        sq = norms[start:end, None] + norms[None, :] - 2.0 * matrix[start:end] @ matrix.T
+        distances = np.sqrt(np.maximum(sq, 0.0))
+        rows = np.arange(start, end)
+        distances[rows - start, rows] = np.inf
+        nearest[start:end] = distances.min(axis=1)
+        # Each pair once: only columns to the right of the diagonal.
+        upper = distances[np.arange(end - start)[:, None] < (np.arange(n)[None, :] - start)]
+        counts += np.bincount(np.minimum((upper / BIN_WIDTH).astype(np.int64), BINS - 1), minlength=BINS)
+    return counts, nearest
+
+
+def genuine_samples(student_ids, date_from, date_to, directory=None):
+    """
+    Distances from logged verifications of ``student_ids`` that were most
+    likely the real student, and the ones labelled impostor.
+    """
+    students = set(student_ids)
+    labels = {}
+    for entry in read_events(date_from, datetime.now(timezone.utc).date(), directory, event="label"):
+        labels[entry.get("ref")] = bool(entry.get("genuine"))
+
+    genuine, impostor = [], []
+    rejected = {}  # student_id -> [(ts, distance, id)] awaiting a retry
+    for entry in read_events(date_from, date_to, directory, event="verify"):
+        student_id, distance = entry.get("student_id"), entry.get("distance")
+        if student_id not in students or distance is None or entry.get("replayed"):
+            continue
+        ts = datetime.fromisoformat(entry["ts"]).timestamp()
+        label = labels.get(entry["id"])
+        if label is not None:
+            (genuine if label else impostor).append(distance)
+        elif entry.get("match"):
+            genuine.append(distance)
+            for rejected_ts, rejected_distance, rejected_id in rejected.pop(student_id, ()):
+                if ts - rejected_ts <= RETRY_SECONDS and rejected_id not in labels:
+                    genuine.append(rejected_distance)
+        else:
+            rejected.setdefault(student_id, []).append((ts, distance, entry["id"]))
+    return np.asarray(genuine, dtype=np.float64), np.asarray(impostor, dtype=np.float64)
+
+
+def effective_threshold(max_distance, min_confidence):
+    """
+    The distance the rule ``distance <= max_distance and confidence >=
+    min_confidence`` actually accepts.
+    """
+    return round(min(max_distance, 1.0 - min_confidence / 100.0), 3)
+
+
+def min_threshold():
+    if MIN_THRESHOLD is not None:
+        return MIN_THRESHOLD
+    from face_service import FACE_MATCH_THRESHOLD, MIN_CONFIDENCE
+
+    return effective_threshold(FACE_MATCH_THRESHOLD, MIN_CONFIDENCE)
+
+
+def recommend_threshold(counts, impostor=(), target_far=TARGET_FAR):
+    """
+    Largest bin edge whose impostor acceptance rate is within target_far
+    (for the gallery pairs and, if any, the labelled impostors), clamped.
+    """
+    edges = np.arange(1, BINS + 1) * BIN_WIDTH
+    total = counts.sum()
+    far = np.cumsum(counts) / total if total else np.zeros(BINS)
+    allowed = far <= target_far
+    impostor = np.sort(np.asarray(impostor, dtype=np.float64))
+    if len(impostor):
+        allowed &= np.searchsorted(impostor, edges, side="right") / len(impostor) <= target_far
+    ok = np.flatnonzero(allowed)
+    floor = min_threshold()
+    threshold = float(edges[ok[-1]]) if len(ok) else floor
+    return round(min(max(threshold, floor), MAX_THRESHOLD), 3)
+
+
+def _rates(counts, genuine, threshold):
+    total = counts.sum()
+    bins = int(round(threshold / BIN_WIDTH))
+    return {
+        "far": round(float(counts[:bins].sum() / total), 5) if total else None,
+        "frr": round(float(np.mean(np.asarray(genuine) > threshold)), 4) if len(genuine) else None,
+    }
+
+
+def calibrate_admin(client, admin_id, days=SAMPLE_DAYS, directory=None, current=None):
+    """
+    Calibration report for one admin; ``threshold`` is None when there are
+    too few encodings to say anything. ``current`` is the (max distance,
+    min confidence) rule in use, for the before/after rates.
+    """
+    gallery = fetch_admin_gallery(client, admin_id)
+    counts, nearest = impostor_histogram(gallery.matrix)
+    today = datetime.now(timezone.utc).date()
+    genuine, impostor = genuine_samples(gallery.student_ids, today - timedelta(days=days), today, directory)
+
+    report = {
+        "admin_id": admin_id,
+        "students": len(gallery.student_ids),
+        "impostor_pairs": int(counts.sum()),
+        "genuine_samples": int(len(genuine)),
+        "labelled_impostors": int(len(impostor)),
+        "threshold": None,
+    }
+    if len(gallery.student_ids) < MIN_STUDENTS:
+        return report
+
+    finite = nearest[np.isfinite(nearest)]
+    report["nearest_impostor"] = {
+        "min": round(float(finite.min()), 4),
+        "p05": round(float(np.percentile(finite, 5)), 4),
+        "median": round(float(np.median(finite)), 4),
+    }
+    if len(genuine):
+        report["genuine_distance"] = {
+            "median": round(float(np.median(genuine)), 4),
+            "p95": round(float(np.percentile(genuine, 95)), 4),
+        }
+    threshold = recommend_threshold(counts, impostor)
+    report["threshold"] = threshold
+    report["recommended"] = _rates(counts, genuine, threshold)
+    if current is not None:
+        effective = effective_threshold(*current)
+        report["current"] = {"threshold": effective, **_rates(counts, genuine, effective)}
+    return report
+
+
+def write_thresholds(reports, path=None):
+    """
+    Merge calibrated thresholds into the thresholds file (atomic replace).
+    """
+    path = path or THRESHOLDS_PATH
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    admins = data.setdefault("admins", {})
+    calibrated_at = datetime.now(timezone.utc).isoformat()
+    for report in reports:
+        if report.get("threshold") is not None:
+            admins[report["admin_id"]] = {
+                "threshold": report["threshold"],
+                "students": report["students"],
+                "genuine_samples": report["genuine_samples"],
+                "calibrated_at": calibrated_at,
+            }
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+    return len(admins)
+
+
+_thresholds = {}
+_thresholds_key = None
+_thresholds_checked = 0.0
+_thresholds_lock = threading.Lock()
+
+
+def _load_thresholds(path):
+    global _thresholds, _thresholds_key, _thresholds_checked
+    now = time.monotonic()
+    if _thresholds_key is not None and now - _thresholds_checked < THRESHOLDS_RELOAD_SECONDS:
+        return _thresholds
+    with _thresholds_lock:
+        try:
+            stat = os.stat(path)
+            key = (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            key = (path, None, None)
+        if key != _thresholds_key:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    admins = json.load(f).get("admins", {}) if key[1] is not None else {}
+                _thresholds = {admin_id: float(entry["threshold"]) for admin_id, entry in admins.items()}
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Could not load face thresholds from {path}: {e}")
+            _thresholds_key = key
+        _thresholds_checked = now
+        return _thresholds
+
+
+def get_admin_threshold(admin_id):
+    """
+    The calibrated max match distance for ``admin_id``, or None.
+    """
+    if admin_id is None:
+        return None
+    return _load_thresholds(THRESHOLDS_PATH).get(admin_id)
+
+
+def reset_thresholds():
+    global _thresholds, _thresholds_key, _thresholds_checked
+    with _thresholds_lock:
+        _thresholds, _thresholds_key, _thresholds_checked = {}, None, 0.0
+
+
+def main(argv):
+    args = [arg for arg in argv[1:] if arg != "--write"]
+    if len(args) not in (1, 2):
+        print(__doc__)
+        return 2
+
+    from face_service import FACE_MATCH_THRESHOLD, MIN_CONFIDENCE
+
+    logging.basicConfig(level=logging.INFO)
+    client = get_supabase_client()
+    days = int(args[1]) if len(args) == 2 else SAMPLE_DAYS
+    admins = [row["id"] for row in fetch_all_rows(client, "admins", "id")] if args[0] == "all" else [args[0]]
+    reports = []
+    for admin_id in admins:
+        report = calibrate_admin(client, admin_id, days, current=(FACE_MATCH_THRESHOLD, MIN_CONFIDENCE))
+        reports.append(report)
+        print(json.dumps(report))
+    if "--write" in argv[1:]:
+        print(json.dumps({"written": THRESHOLDS_PATH, "admins": write_thresholds(reports)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,17 @@
+-- Indexes for the attendance read paths.
+-- Run in the Supabase SQL Editor after FINAL_DATABASE_SETUP.sql. Safe to re-run.
+--
+-- On a large, busy table run each statement on its own with
+-- CREATE INDEX CONCURRENTLY (outside a transaction) to avoid blocking writes.
+
+-- GET /api/v1/attendance, exports and statistics: one admin's rows, newest
+-- first, keyset-paginated on (date, id).
+CREATE INDEX IF NOT EXISTS attendance_admin_date_id_idx
+    ON public.attendance (admin_id, date DESC, id DESC);
+
+-- Duplicate checks when marking (student, day, optional subject) and
+-- per-student history.
+CREATE INDEX IF NOT EXISTS attendance_student_date_subject_idx
+    ON public.attendance (student_id, date, subject);
+
+ANALYZE public.attendance;
@@ -0,0 +1,243 @@
+"""
+Face detector backends.
+
+Every backend returns boxes in face_recognition's (top, right, bottom, left)
+order on an RGB image, so the landmark/encoder stage doesn't care which one
+found the face.
+
+    hog    dlib HOG (face_recognition default), CPU friendly, frontal only
+    cnn    dlib CNN (mmod), better on profiles, slow without a GPU
+    yunet  OpenCV FaceDetectorYN, fast on CPU; needs the ONNX model file
+    auto   yunet when its model is available, otherwise hog
+
+The backend is chosen with FACE_DETECTOR, and per admin with
+FACE_DETECTOR_BY_ADMIN (a JSON object of admin id -> backend).
+
+Benchmark the backends on a folder of sample images:
+    python detector_service.py benchmark <folder> [hog,yunet,cnn]
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DETECTOR = os.environ.get("FACE_DETECTOR", "hog").lower()
+YUNET_MODEL_PATH = os.environ.get(
+    "FACE_YUNET_MODEL",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "face_detection_yunet_2023mar.onnx"),
+)
+YUNET_SCORE_THRESHOLD = float(os.environ.get("FACE_YUNET_SCORE", 0.8))
+BACKENDS = ("hog", "cnn", "yunet")
+
+
+def _load_admin_overrides():
+    raw = os.environ.get("FACE_DETECTOR_BY_ADMIN", "")
+    if not raw:
+        return {}
+    try:
+        overrides = json.loads(raw)
+    except ValueError:
+        logger.error("FACE_DETECTOR_BY_ADMIN is not valid JSON, ignoring it")
+        return {}
+    return {str(k): str(v).lower() for k, v in overrides.items()}
+
+
+_ADMIN_DETECTORS = _load_admin_overrides()
+_DETECTORS = {}
+_DETECTORS_LOCK = threading.Lock()
+
+
+class DlibDetector:
+    def __init__(self, model):
+        self.name = model
+        self.model = model
+
+    def detect(self, image_rgb):
+        import face_recognition
+
+        return face_recognition.face_locations(image_rgb, model=self.model)
+
+
+class YuNetDetector:
+    name = "yunet"
+
+    def __init__(self, model_path=None, score_threshold=YUNET_SCORE_THRESHOLD):
+        import cv2
+
+        # Resolved here rather than bound as a default when the module loads.
+        model_path = model_path or YUNET_MODEL_PATH
+
+        if not hasattr(cv2, "FaceDetectorYN"):
+            raise RuntimeError("OpenCV build has no FaceDetectorYN")
+        if not os.path.exists(model_path):
+            raise RuntimeError(f"YuNet model not found at {model_path}")
+        self.model_path = model_path
+        self.score_threshold = score_threshold
+        # FaceDetectorYN keeps the input size as state, so one per thread.
+        self._local = threading.local()
+
+    def _detector(self, width, height):
+        import cv2
+
+        detector = getattr(self._local, "detector", None)
+        if detector is None:
+            detector = cv2.FaceDetectorYN.create(self.model_path, "", (width, height), self.score_threshold)
+            self._local.detector = detector
+        detector.setInputSize((width, height))
+        return detector
+
+    def detect(self, image_rgb):
+        import cv2
+
+        height, width = image_rgb.shape[:2]
+        # YuNet was trained on BGR input.
+        _, faces = self._detector(width, height).detect(cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR))
+        if faces is None:
+            return []
+        boxes = []
+        for x, y, w, h in np.asarray(faces)[:, :4]:
+            left, top = max(0, int(round(x))), max(0, int(round(y)))
+            right, bottom = min(width, int(round(x + w))), min(height, int(round(y + h)))
+            if right > left and bottom > top:
+                boxes.append((top, right, bottom, left))
+        return boxes
+
+
+def _create(name):
+    if name in ("hog", "cnn"):
+        return DlibDetector(name)
+    if name == "yunet":
+        return YuNetDetector()
+    raise ValueError(f"Unknown face detector backend: {name}")
+
+
+def get_detector(name=None):
+    """
+    Returns the detector for ``name`` (default: FACE_DETECTOR). A backend that
+    can't be created falls back to HOG rather than failing requests.
+    """
+    name = (name or DEFAULT_DETECTOR).lower()
+    detector = _DETECTORS.get(name)
+    if detector is not None:
+        return detector
+
+    with _DETECTORS_LOCK:
+        if name in _DETECTORS:
+            return _DETECTORS[name]
+        if name == "auto":
+            try:
+                detector = _create("yunet")
+            except RuntimeError:
+                detector = _create("hog")
+        else:
+            try:
+                detector = _create(name)
+            except (RuntimeError, ValueError) as e:
+                logger.error(f"Face detector '{name}' unavailable, falling back to hog: {e}")
+                detector = _create("hog")
+        _DETECTORS[name] = detector
+        return detector
+
+
+def get_admin_detector(admin_id=None):
+    return get_detector(_ADMIN_DETECTORS.get(str(admin_id)) if admin_id else None)
+
+
+def set_admin_detector(admin_id, name):
+    if name is None:
+        _ADMIN_DETECTORS.pop(str(admin_id), None)
+        return
+    name = name.lower()
+    if name not in BACKENDS + ("auto",):
+        raise ValueError(f"Unknown face detector backend: {name}")
+    _ADMIN_DETECTORS[str(admin_id)] = name
+
+
+def benchmark(images, backends=BACKENDS, repeats=1):
+    """
+    Time each backend over ``images`` (RGB arrays).
+    Returns {backend: {"mean_ms", "p95_ms", "detection_rate", "faces"}} plus
+    an "error" entry for backends that couldn't be loaded.
+    """
+    results = {}
+    for name in backends:
+        try:
+            detector = _create(name)
+            detector.detect(np.zeros((120, 160, 3), dtype=np.uint8))  # load models outside the timing
+        except (RuntimeError, ValueError, ImportError) as e:
+            results[name] = {"error": str(e)}
+            continue
+
+        timings, detected, faces = [], 0, 0
+        for image in images:
+            for _ in range(repeats):
+                started = time.perf_counter()
+                boxes = detector.detect(image)
+                timings.append((time.perf_counter() - started) * 1000)
+            detected += 1 if boxes else 0
+            faces += len(boxes)
+
+        timings = np.asarray(timings) if timings else np.zeros(1)
+        results[name] = {
+            "mean_ms": round(float(timings.mean()), 2),
+            "p95_ms": round(float(np.percentile(timings, 95)), 2),
+            "detection_rate": round(detected / len(images), 3) if len(images) else 0.0,
+            "faces": faces,
+        }
+    return results
+
+
+def recommend(results, tolerance=0.02):
+    """
+    Pick the fastest backend whose detection rate is within ``tolerance`` of the best.
+    """
+    usable = {name: r for name, r in results.items() if "error" not in r}
+    if not usable:
+        return None
+    best_rate = max(r["detection_rate"] for r in usable.values())
+    candidates = [name for name, r in usable.items() if r["detection_rate"] >= best_rate - tolerance]
+    return min(candidates, key=lambda name: usable[name]["mean_ms"])
+
+
+def _load_folder(path):
+    import cv2
+
+    images = []
+    for name in sorted(os.listdir(path)):
+        image = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if image is not None:
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def main(argv):
+    if len(argv) < 3 or argv[1] != "benchmark":
+        print(__doc__)
+        return 2
+
+    images = _load_folder(argv[2])
+    if not images:
+        print(f"No readable images in {argv[2]}")
+        return 1
+    backends = tuple(argv[3].split(",")) if len(argv) > 3 else BACKENDS
+    results = benchmark(images, backends)
+
+    print(f"{len(images)} images")
+    print(f"{'backend':<8} {'mean ms':>9} {'p95 ms':>9} {'detected':>9} {'faces':>7}")
+    for name, r in results.items():
+        if "error" in r:
+            print(f"{name:<8} unavailable: {r['error']}")
+            continue
+        print(f"{name:<8} {r['mean_ms']:>9} {r['p95_ms']:>9} {r['detection_rate']:>9.1%} {r['faces']:>7}")
+    print(f"recommended: FACE_DETECTOR={recommend(results)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,285 @@
+"""
+Bulk face enrollment from a ZIP archive or a folder of photos.
+
+Each image is named after the student's roll number (e.g. ``CS-042.jpg``).
+Images are decoded and encoded across a process pool, encodings are upserted
+into ``face_encodings`` in multi-row batches, and a per-file report is
+yielded as results land so callers can stream it back. The pool is created
+on the first upload in a process (get_enroll_pool) and shared by the ones
+after it, so workers and their loaded models are reused. The CPU the pool
+spends is charged to the uploading admin's tenant budget.
+
+Command line:
+    python enrollment_service.py <admin_id> <archive.zip | folder>
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from database_service import get_supabase_client
+from detector_service import get_admin_detector
+from face_service import MAX_IMAGE_BYTES, decode_image_bytes, get_face_encoding, get_replay_cache
+from gallery_service import record_changes, upsert_encodings
+from local_store_service import get_local_store
+from tenant_service import get_tenant_scheduler
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+# Every server worker may start a pool; split the node's cores between them.
+ENROLL_WORKERS = int(
+    os.environ.get("ENROLL_WORKERS", max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get("WORKERS", 1)))))
+)
+MAX_ARCHIVE_FILES = int(os.environ.get("ENROLL_MAX_FILES", 5000))
+UPSERT_BATCH_SIZE = 100
+
+
+def _roll_from_name(name):
+    stem, ext = os.path.splitext(os.path.basename(name))
+    if ext.lower() not in IMAGE_EXTENSIONS or stem.startswith("."):
+        return None
+    return stem.strip()
+
+
+def iter_zip_images(fileobj):
+    """
+    Yields (file name, image bytes or None, error or None) for each image in a ZIP.
+    """
+    with zipfile.ZipFile(fileobj) as archive:
+        members = [
+            info
+            for info in archive.infolist()
+            if not info.is_dir() and "__MACOSX" not in info.filename and _roll_from_name(info.filename)
+        ]
+        for count, info in enumerate(members):
+            if count >= MAX_ARCHIVE_FILES:
+                yield info.filename, None, "Archive has too many files"
+                continue
+            # Check the declared size before inflating anything.
+            if info.file_size > MAX_IMAGE_BYTES:
+                yield info.filename, None, "Image too large"
+                continue
+            # A damaged entry (bad header, CRC mismatch, truncated data) fails
+            # on its own instead of ending the report halfway.
+            try:
+                img_bytes = archive.read(info)
+            except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as e:
+                logger.warning(f"Unreadable archive entry {info.filename}: {e}")
+                yield info.filename, None, "Invalid image: corrupt archive entry"
+                continue
+            yield info.filename, img_bytes, None
+
+
+def iter_folder_images(path):
+    names = [
+        name for name in sorted(os.listdir(path)) if _roll_from_name(name) and os.path.isfile(os.path.join(path, name))
+    ]
+    for count, name in enumerate(names):
+        full_path = os.path.join(path, name)
+        if count >= MAX_ARCHIVE_FILES:
+            yield name, None, "Archive has too many files"
+            continue
+        if os.path.getsize(full_path) > MAX_IMAGE_BYTES:
+            yield name, None, "Image too large"
+            continue
+        with open(full_path, "rb") as fh:
+            yield name, fh.read(), None
+
+
+def _encode_file(name, img_bytes, admin_id=None):
+    """
+    Runs in a pool process: decode and encode one image.
+    Returns (name, encoding, error, CPU seconds spent).
+    """
+    started = time.process_time()
+    image_rgb, error = decode_image_bytes(img_bytes)
+    if not error:
+        encoding, error = get_face_encoding(image_rgb, get_admin_detector(admin_id))
+    cpu = time.process_time() - started
+    if error:
+        return name, None, error, cpu
+    return name, encoding.tolist(), None, cpu
+
+
+def _failure(name, roll, message, error_code=None):
+    entry = {"file": name, "roll_number": roll, "success": False, "error": message}
+    if error_code:
+        entry["error_code"] = error_code
+    return entry
+
+
+def _flush(client, admin_id, pending):
+    """
+    Upsert a batch of (name, roll, student_id, encoding) and report each file.
+    Like register_student_face, the kiosk mirror, this process's gallery and
+    the other workers (change log) see the new encodings right away.
+    """
+    rows = [{"student_id": sid, "encoding": encoding, "updated_at": "now()"} for _, _, sid, encoding in pending]
+    try:
+        client.table("face_encodings").upsert(rows, on_conflict="student_id").execute()
+    except Exception as e:
+        logger.error(f"Bulk enrollment upsert of {len(rows)} rows failed: {e}")
+        return [_failure(name, roll, "Database update failed", "DATABASE_ERROR") for name, roll, _, _ in pending]
+
+    encodings = {sid: np.asarray(encoding, dtype=np.float64) for _, _, sid, encoding in pending}
+    store = get_local_store()
+    if store is not None:
+        for student_id, encoding in encodings.items():
+            store.put_encoding(student_id, encoding)
+    upsert_encodings({student_id: (admin_id, encoding) for student_id, encoding in encodings.items()})
+    record_changes(list(encodings))
+
+    cache = get_replay_cache()
+    entries = []
+    for name, roll, student_id, _ in pending:
+        cache.invalidate(student_id)
+        entries.append({"file": name, "roll_number": roll, "student_id": student_id, "success": True})
+    return entries
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_enroll_pool():
+    """
+    The process's shared encoding pool, created on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=max(1, ENROLL_WORKERS))
+    return _pool
+
+
+def close_enroll_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def enroll_images(admin_id, sources, client=None, workers=ENROLL_WORKERS, executor=None):
+    """
+    Enroll every image from ``sources`` for one admin's students, on
+    ``executor`` or the shared pool.
+    Yields one report dict per file, then a final {"summary": ...} dict.
+    """
+    client = client or get_supabase_client()
+    students_res = client.table("students").select("id, roll_number").eq("admin_id", admin_id).execute()
+    students_by_roll = {
+        str(row["roll_number"]).strip().lower(): row["id"]
+        for row in (students_res.data or [])
+        if row.get("id") and row.get("roll_number") is not None
+    }
+
+    totals = {"total": 0, "enrolled": 0, "failed": 0}
+
+    def tally(entries):
+        for entry in entries:
+            totals["enrolled" if entry["success"] else "failed"] += 1
+        return entries
+
+    executor = executor or get_enroll_pool()
+    scheduler = get_tenant_scheduler()
+    in_flight = {}
+    pending = []
+    seen_rolls = set()
+    max_in_flight = max(1, workers) * 4
+
+    def drain(block_until):
+        done, _ = wait(list(in_flight), return_when=block_until)
+        finished = []
+        for future in done:
+            name, roll, student_id = in_flight.pop(future)
+            try:
+                _, encoding, error, cpu = future.result()
+            except Exception as e:
+                finished.append(_failure(name, roll, f"Encoding failed: {e}"))
+                continue
+            scheduler.charge(admin_id, cpu)
+            if error:
+                finished.append(_failure(name, roll, error))
+            else:
+                pending.append((name, roll, student_id, encoding))
+        return finished
+
+    def flush_full_batches():
+        entries = []
+        while len(pending) >= UPSERT_BATCH_SIZE:
+            entries.extend(_flush(client, admin_id, pending[:UPSERT_BATCH_SIZE]))
+            del pending[:UPSERT_BATCH_SIZE]
+        return entries
+
+    try:
+        for name, img_bytes, error in sources:
+            totals["total"] += 1
+            roll = _roll_from_name(name)
+            if error:
+                yield from tally([_failure(name, roll, error)])
+                continue
+
+            key = (roll or "").lower()
+            student_id = students_by_roll.get(key)
+            if not student_id:
+                yield from tally([_failure(name, roll, "No student with this roll number", "UNKNOWN_STUDENT")])
+                continue
+            if key in seen_rolls:
+                yield from tally([_failure(name, roll, "Duplicate roll number in archive", "DUPLICATE_FILE")])
+                continue
+            seen_rolls.add(key)
+
+            in_flight[executor.submit(_encode_file, name, img_bytes, admin_id)] = (name, roll, student_id)
+            # Bound how many decoded images can be queued at once.
+            if len(in_flight) >= max_in_flight:
+                yield from tally(drain(FIRST_COMPLETED))
+            yield from tally(flush_full_batches())
+
+        while in_flight:
+            yield from tally(drain(FIRST_COMPLETED))
+            yield from tally(flush_full_batches())
+        if pending:
+            yield from tally(_flush(client, admin_id, pending))
+            pending.clear()
+    finally:
+        # The pool outlives this upload; only drop what it still has queued.
+        for future in in_flight:
+            future.cancel()
+
+    logger.info(f"Bulk enrollment for admin {admin_id}: {totals}")
+    yield {"summary": True, **totals}
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(__doc__)
+        return 2
+
+    logging.basicConfig(level=logging.INFO)
+    admin_id, path = argv[1], argv[2]
+    try:
+        if os.path.isdir(path):
+            for entry in enroll_images(admin_id, iter_folder_images(path)):
+                print(json.dumps(entry))
+            return 0
+
+        with open(path, "rb") as fh:
+            for entry in enroll_images(admin_id, iter_zip_images(fh)):
+                print(json.dumps(entry))
+        return 0
+    finally:
+        close_enroll_pool()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,51 +1,881 @@
-import face_recognition
 import numpy as np
 import base64
-import cv2
+import binascii
 import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from calibration_service import get_admin_threshold
 from database_service import get_supabase_client
+from detector_service import get_admin_detector, get_detector
+from gallery_service import (
+    apply_logged_changes,
+    fetch_admin_gallery,
+    get_gallery,
+    record_change,
+    remove_encoding,
+    upsert_encoding,
+)
+from local_store_service import OFFLINE_ERRORS, get_local_store
 import logging
 
 logger = logging.getLogger(__name__)
 
-# System Rules
+# System Rules (defaults; calibration_service can set a per-admin threshold)
 FACE_MATCH_THRESHOLD = 0.55
 MIN_CONFIDENCE = 72.0
 
+# face_recognition pulls in dlib and its models, cv2 is large too. Both are
+# imported on first use so non-face endpoints (exports, statistics) and the
+# process itself start quickly; warm_up() front-loads the cost at startup.
+_face_recognition = None
+_cv2 = None
+_IMPORT_LOCK = threading.Lock()
+
+_WARMUP_LOCK = threading.Lock()
+_WARMUP_STATE = {"status": "cold", "duration_ms": None, "error": None, "warmed_at": None}
+
+
+def _get_face_recognition():
+    global _face_recognition
+    if _face_recognition is None:
+        with _IMPORT_LOCK:
+            if _face_recognition is None:
+                import face_recognition
+                _face_recognition = face_recognition
+    return _face_recognition
+
+
+def _get_cv2():
+    global _cv2
+    if _cv2 is None:
+        with _IMPORT_LOCK:
+            if _cv2 is None:
+                import cv2
+                _cv2 = cv2
+    return _cv2
+
+
+def get_face_recognition():
+    """
+    The face_recognition module, imported on first use.
+    """
+    return _get_face_recognition()
+
+
+def get_cv2():
+    """
+    The cv2 module, imported on first use.
+    """
+    return _get_cv2()
+
+
+def warm_up():
+    """
+    Load the face models and run detector + encoder once on a synthetic frame,
+    so the first real request does not pay for model loading.
+    Safe to call repeatedly; only the first call does work.
+    """
+    with _WARMUP_LOCK:
+        if _WARMUP_STATE["status"] == "ready":
+            return True
+        _WARMUP_STATE.update(status="warming", error=None)
+        started = time.perf_counter()
+        try:
+            _get_cv2()
+            face_recognition = _get_face_recognition()
+            frame = np.full((240, 320, 3), 127, dtype=np.uint8)
+            get_detector().detect(frame)
+            # The blank frame has no faces, so force the landmark + encoder
+            # path with a fixed box to load and exercise those models too.
+            face_recognition.face_encodings(frame, known_face_locations=[(60, 220, 180, 100)])
+        except Exception as e:
+            logger.error(f"Face model warm-up failed: {e}")
+            _WARMUP_STATE.update(status="failed", error=str(e))
+            return False
+
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        _WARMUP_STATE.update(status="ready", duration_ms=duration_ms, warmed_at=time.time())
+        logger.info(f"Face models warmed up in {duration_ms} ms")
+        return True
+
+
+def get_warmup_state():
+    return dict(_WARMUP_STATE)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+# Upload limits, checked before any decoding work is done.
+MAX_IMAGE_BYTES = _env_int("FACE_MAX_IMAGE_BYTES", 5 * 1024 * 1024)
+MAX_IMAGE_PIXELS = _env_int("FACE_MAX_IMAGE_PIXELS", 4096 * 4096)
+MAX_IMAGE_SIDE = _env_int("FACE_MAX_IMAGE_SIDE", 8192)
+# OpenCV's own decoder limits, for headers _probe_dimensions can't read;
+# they are read once, when cv2 first decodes something.
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_PIXELS", str(MAX_IMAGE_PIXELS))
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_WIDTH", str(MAX_IMAGE_SIDE))
+os.environ.setdefault("OPENCV_IO_MAX_IMAGE_HEIGHT", str(MAX_IMAGE_SIDE))
+# Long side the HOG detector actually needs; larger JPEGs are decoded at 1/2
+# or 1/4 scale straight from the DCT, which is far cheaper than a full decode.
+DETECT_TARGET_SIDE = _env_int("FACE_DETECT_TARGET_SIDE", 800)
+# Classroom snapshots have small faces, so batch decodes keep more resolution.
+BATCH_DETECT_TARGET_SIDE = _env_int("FACE_BATCH_DETECT_TARGET_SIDE", 1920)
+BATCH_MAX_FRAMES = 3
+
+_IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"RIFF", "webp"),
+    (b"BM", "bmp"),
+)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _sniff_format(img_bytes):
+    for signature, fmt in _IMAGE_SIGNATURES:
+        if img_bytes.startswith(signature):
+            if fmt == "webp" and img_bytes[8:12] != b"WEBP":
+                return None
+            return fmt
+    return None
+
+
+def _probe_dimensions(img_bytes, fmt):
+    """
+    Read (width, height) from the image header without decoding pixels.
+    Returns None when the header can't be parsed cheaply.
+    """
+    if fmt == "png" and len(img_bytes) >= 24:
+        return int.from_bytes(img_bytes[16:20], "big"), int.from_bytes(img_bytes[20:24], "big")
+    if fmt == "bmp" and len(img_bytes) >= 26:
+        width = int.from_bytes(img_bytes[18:22], "little", signed=True)
+        height = int.from_bytes(img_bytes[22:26], "little", signed=True)
+        return abs(width), abs(height)  # negative height means top-down rows
+    if fmt == "webp" and len(img_bytes) >= 30:
+        chunk = img_bytes[12:16]
+        if chunk == b"VP8X":
+            return int.from_bytes(img_bytes[24:27], "little") + 1, int.from_bytes(img_bytes[27:30], "little") + 1
+        if chunk == b"VP8L":
+            bits = int.from_bytes(img_bytes[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8 ":
+            width, height = int.from_bytes(img_bytes[26:28], "little"), int.from_bytes(img_bytes[28:30], "little")
+            return width & 0x3FFF, height & 0x3FFF
+        return None
+    if fmt != "jpeg":
+        return None
+
+    i, size = 2, len(img_bytes)
+    while i + 9 < size:
+        if img_bytes[i] != 0xFF:
+            return None
+        marker = img_bytes[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height = int.from_bytes(img_bytes[i + 5:i + 7], "big")
+            width = int.from_bytes(img_bytes[i + 7:i + 9], "big")
+            return width, height
+        i += 2 + int.from_bytes(img_bytes[i + 2:i + 4], "big")
+    return None
+
+
+def image_too_large(width, height):
+    return width * height > MAX_IMAGE_PIXELS or max(width, height) > MAX_IMAGE_SIDE
+
+
+def _decode_flag(cv2, fmt, dimensions, target_side):
+    if fmt != "jpeg" or not dimensions:
+        return cv2.IMREAD_COLOR
+    long_side = max(dimensions)
+    if long_side >= target_side * 4:
+        return cv2.IMREAD_REDUCED_COLOR_4
+    if long_side >= target_side * 2:
+        return cv2.IMREAD_REDUCED_COLOR_2
+    return cv2.IMREAD_COLOR
+
+
+def _base64_image_bytes(base64_string):
+    """
+    Encoded image bytes from a (data-URL or bare) base64 string, size-checked
+    before decoding. Returns (bytes, None) or (None, error message).
+    """
+    if not isinstance(base64_string, str) or not base64_string:
+        return None, "Invalid image: empty payload"
+
+    header, sep, payload = base64_string.partition(",")
+    if sep:
+        if not (header.startswith("data:image/") and header.endswith(";base64")):
+            return None, "Invalid image: unsupported data URL header"
+    else:
+        payload = header
+
+    # Base64 inflates by 4/3, so the decoded size is known before decoding.
+    if len(payload) * 3 // 4 > MAX_IMAGE_BYTES:
+        return None, "Image too large"
+
+    try:
+        return base64.b64decode(payload), None
+    except (binascii.Error, ValueError):
+        return None, "Invalid image: malformed base64"
+
+
+def _probe_image(img_bytes):
+    """
+    (format, dimensions or None, error) from the header alone, so oversized
+    or unsupported images are refused before any pixels are allocated.
+    """
+    if len(img_bytes) > MAX_IMAGE_BYTES:
+        return None, None, "Image too large"
+    fmt = _sniff_format(img_bytes)
+    if fmt is None:
+        return None, None, "Invalid image: unsupported format"
+    dimensions = _probe_dimensions(img_bytes, fmt)
+    if dimensions and image_too_large(*dimensions):
+        return fmt, dimensions, "Image too large"
+    return fmt, dimensions, None
+
+
+def decode_image_checked(base64_string, target_side=DETECT_TARGET_SIDE):
+    """
+    Decode a (data-URL or bare) base64 image into an RGB array.
+    Returns (image, None) or (None, error message).
+    """
+    img_bytes, error = _base64_image_bytes(base64_string)
+    if error:
+        return None, error
+    return decode_image_bytes(img_bytes, target_side)
+
+
+def decode_image_bytes(img_bytes, target_side=DETECT_TARGET_SIDE, rgb=True):
+    """
+    Decode raw encoded image bytes into an RGB (or, with ``rgb=False``, BGR)
+    array. Returns (image, None) or (None, error message).
+    """
+    fmt, dimensions, error = _probe_image(img_bytes)
+    if error:
+        return None, error
+
+    cv2 = _get_cv2()
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), _decode_flag(cv2, fmt, dimensions, target_side))
+    if img is None:
+        return None, "Invalid image: corrupt data"
+    if dimensions is None and image_too_large(img.shape[1], img.shape[0]):
+        return None, "Image too large"
+
+    # Swap channels inside the decoded buffer. dlib needs a C-contiguous RGB
+    # array, so a reversed-stride view would only defer the copy.
+    if rgb:
+        cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
+    return img, None
+
+
 def decode_image(base64_string):
+    image, error = decode_image_checked(base64_string)
+    if error:
+        logger.warning(f"Image decode error: {error}")
+    return image
+
+# Kiosks resubmit the same frame on network retries and double taps. Replays
+# of a rejected frame are answered from a short-lived cache keyed on the
+# student and a perceptual hash of the frame, instead of re-running detection
+# + encoding.
+REPLAY_TTL_SECONDS = _env_int("FACE_REPLAY_TTL_SECONDS", 10)
+REPLAY_MAX_STUDENTS = _env_int("FACE_REPLAY_MAX_STUDENTS", 2048)
+REPLAY_MAX_FRAMES_PER_STUDENT = 4
+REPLAY_MAX_HAMMING = 4
+
+
+def frame_hash(image_base64):
+    """
+    64-bit difference hash of the frame, computed from a 1/8-scale grayscale
+    decode so it costs about a millisecond. Returns None if the frame fails
+    the upload checks (size, format, header dimensions) or can't be decoded.
+    CPU work: call it off the event loop.
+    """
+    img_bytes, error = _base64_image_bytes(image_base64)
+    if error or _probe_image(img_bytes)[2]:
+        return None
+
+    cv2 = _get_cv2()
+    gray = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        return None
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class ReplayCache:
+    """
+    Bounded, expiring map of (student_id, frame hash) -> rejected
+    verification result. Near-identical frames (hash within
+    REPLAY_MAX_HAMMING bits) also hit. Accepted results are never stored, so
+    a replayed frame can't mark attendance without being verified again.
+    """
+
+    def __init__(self, ttl_seconds=REPLAY_TTL_SECONDS, max_students=REPLAY_MAX_STUDENTS, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_students = max_students
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, student_id, phash):
+        if phash is None or self.ttl_seconds <= 0:
+            return None
+        now = self._clock()
+        with self._lock:
+            frames = self._entries.get(student_id)
+            if frames:
+                frames[:] = [f for f in frames if f[2] > now]
+                for cached_hash, result, _ in frames:
+                    if bin(cached_hash ^ phash).count("1") <= REPLAY_MAX_HAMMING:
+                        self.hits += 1
+                        return result
+            self.misses += 1
+            return None
+
+    def put(self, student_id, phash, result):
+        if phash is None or self.ttl_seconds <= 0 or result[0]:
+            return
+        with self._lock:
+            frames = self._entries.pop(student_id, [])
+            frames.append((phash, result, self._clock() + self.ttl_seconds))
+            self._entries[student_id] = frames[-REPLAY_MAX_FRAMES_PER_STUDENT:]
+            while len(self._entries) > self.max_students:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, student_id):
+        with self._lock:
+            self._entries.pop(student_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_replay_cache = ReplayCache()
+
+
+def get_replay_cache():
+    return _replay_cache
+
+
+def lookup_replayed_verification(student_id, phash):
+    """
+    Returns the cached rejection (match, confidence, message, liveness) for a
+    replayed frame, given its frame_hash(), or None.
+    """
+    return _replay_cache.get(student_id, phash)
+
+
+def replay_cache_enabled():
+    """
+    Off only with FACE_LIVENESS=enforce: there a rejection can depend on the
+    burst, which the cache isn't keyed on, so a retry with a fresh burst has
+    to be verified again. In report mode liveness never decides the outcome.
+    """
+    return LIVENESS_MODE != "enforce"
+
+
+# Pre-encoding quality gate. These checks run on the detected face box and
+# cost well under a millisecond, against tens of milliseconds for the encoder.
+MIN_FACE_SIZE = _env_int("FACE_MIN_SIZE", 60)
+BLUR_THRESHOLD = float(os.environ.get("FACE_BLUR_THRESHOLD", 35.0))
+DARK_THRESHOLD = 45
+BRIGHT_THRESHOLD = 215
+CLIPPED_FRACTION = 0.45
+MAX_YAW_RATIO = 0.35
+MAX_ROLL_DEGREES = 30.0
+QUALITY_PATCH_SIDE = 128
+# Prefixes of the messages assess_face_quality returns.
+QUALITY_ERRORS = ("Face too small", "Poor lighting", "Face image too blurry", "Face not facing camera")
+QUALITY_RETRY_WINDOW_SECONDS = _env_int("FACE_QUALITY_RETRY_WINDOW_SECONDS", 120)
+QUALITY_RETRY_MAX_ENTRIES = 10000
+
+_QUALITY_LOCK = threading.Lock()
+_QUALITY_STATS = {
+    "checked": 0,
+    "rejected": {},
+    "encodings": 0,
+    "encoder_ms_total": 0.0,
+    "encoder_ms_saved": 0.0,
+    "retries_avoided": 0,
+    "liveness_checked": 0,
+    "liveness_failed": 0,
+    "liveness_ms_total": 0.0,
+}
+
+
+def _record_encoding(duration_ms):
+    with _QUALITY_LOCK:
+        _QUALITY_STATS["encodings"] += 1
+        _QUALITY_STATS["encoder_ms_total"] += duration_ms
+
+
+def _record_quality(reason):
+    with _QUALITY_LOCK:
+        _QUALITY_STATS["checked"] += 1
+        if reason is None:
+            return
+        rejected = _QUALITY_STATS["rejected"]
+        rejected[reason] = rejected.get(reason, 0) + 1
+        # Each rejection skips one encoder run; charge it at the observed average.
+        if _QUALITY_STATS["encodings"]:
+            _QUALITY_STATS["encoder_ms_saved"] += _QUALITY_STATS["encoder_ms_total"] / _QUALITY_STATS["encodings"]
+
+
+# Students whose last check-in the gate refused: student_id -> monotonic time.
+_quality_refused = OrderedDict()
+
+
+def _record_attempt(student_id, matched, message):
+    """
+    A student the gate refused who matches on their next attempt (within
+    QUALITY_RETRY_WINDOW_SECONDS) counts as a retry avoided: the specific
+    error got them a usable frame at once, where the encoded poor frame would
+    have been a borderline mismatch that says nothing about what to fix.
+    """
+    now = time.monotonic()
+    with _QUALITY_LOCK:
+        refused_at = _quality_refused.pop(student_id, None)
+        if matched and refused_at is not None and now - refused_at <= QUALITY_RETRY_WINDOW_SECONDS:
+            _QUALITY_STATS["retries_avoided"] += 1
+        if message.startswith(QUALITY_ERRORS):
+            _quality_refused[student_id] = now
+            while len(_quality_refused) > QUALITY_RETRY_MAX_ENTRIES:
+                _quality_refused.popitem(last=False)
+
+
+def get_quality_stats():
+    with _QUALITY_LOCK:
+        stats = dict(_QUALITY_STATS, rejected=dict(_QUALITY_STATS["rejected"]))
+    stats["rejected_total"] = sum(stats["rejected"].values())
+    stats["encoder_ms_total"] = round(stats["encoder_ms_total"], 1)
+    stats["encoder_ms_saved"] = round(stats["encoder_ms_saved"], 1)
+    stats["liveness_ms_total"] = round(stats["liveness_ms_total"], 1)
+    return stats
+
+
+def _pose_error(landmarks):
     try:
-        if ',' in base64_string:
-            base64_string = base64_string.split(',')[1]
-        img_bytes = base64.b64decode(base64_string)
-        nparr = np.frombuffer(img_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    except Exception as e:
-        print(f"Image decode error: {e}")
+        left_eye = np.mean(landmarks["left_eye"], axis=0)
+        right_eye = np.mean(landmarks["right_eye"], axis=0)
+        nose = np.mean(landmarks["nose_tip"], axis=0)
+    except (KeyError, TypeError, ValueError):
+        return None
+    dx, dy = right_eye - left_eye
+    eye_distance = float(np.hypot(dx, dy))
+    if eye_distance < 1.0:
+        return None
+    if abs(np.degrees(np.arctan2(dy, dx))) > MAX_ROLL_DEGREES:
+        return "Face not facing camera: head tilted"
+    # Frontal faces have the nose roughly halfway between the eyes.
+    yaw_ratio = (nose[0] - (left_eye[0] + right_eye[0]) / 2.0) / eye_distance
+    if abs(yaw_ratio) > MAX_YAW_RATIO:
+        return "Face not facing camera: head turned"
+    return None
+
+
+def _face_patch(image_rgb, location):
+    """
+    Grey QUALITY_PATCH_SIDE square of the face box, or None if the box is
+    smaller than MIN_FACE_SIZE.
+    """
+    top, right, bottom, left = location
+    height, width = image_rgb.shape[:2]
+    top, left = max(0, top), max(0, left)
+    bottom, right = min(height, bottom), min(width, right)
+    if min(bottom - top, right - left) < MIN_FACE_SIZE:
         return None
 
-def get_face_encoding(image_rgb):
+    cv2 = _get_cv2()
+    gray = cv2.cvtColor(np.ascontiguousarray(image_rgb[top:bottom, left:right]), cv2.COLOR_RGB2GRAY)
+    # Normalise the patch size so scores don't depend on distance.
+    return cv2.resize(gray, (QUALITY_PATCH_SIDE, QUALITY_PATCH_SIDE), interpolation=cv2.INTER_AREA)
+
+
+def assess_face_quality(image_rgb, location, landmarks=None):
+    """
+    Cheap checks on the detected face before paying for the 128-d encoder.
+    Returns None when the face is usable, otherwise an error message.
+    """
+    patch = _face_patch(image_rgb, location)
+    if patch is None:
+        return "Face too small: move closer to the camera"
+
+    cv2 = _get_cv2()
+
+    mean = float(patch.mean())
+    clipped_dark = float(np.count_nonzero(patch < 16)) / patch.size
+    clipped_bright = float(np.count_nonzero(patch > 240)) / patch.size
+    if mean < DARK_THRESHOLD or clipped_dark > CLIPPED_FRACTION:
+        return "Poor lighting: face too dark"
+    if mean > BRIGHT_THRESHOLD or clipped_bright > CLIPPED_FRACTION:
+        return "Poor lighting: face overexposed"
+
+    if cv2.Laplacian(patch, cv2.CV_64F).var() < BLUR_THRESHOLD:
+        return "Face image too blurry: hold still"
+
+    if landmarks:
+        return _pose_error(landmarks)
+    return None
+
+
+def _encode_face(image_rgb, detector=None):
+    """
+    Returns (encoding, location, landmarks, error). The face box and
+    landmarks are handed back so later stages (liveness) don't detect again.
+    """
+    face_recognition = _get_face_recognition()
     # Detect faces
-    locations = face_recognition.face_locations(image_rgb, model="hog")
+    locations = (detector or get_detector()).detect(image_rgb)
     if len(locations) != 1:
-        return None, f"Found {len(locations)} faces. System requires exactly 1 face."
-    
+        return None, None, None, f"Found {len(locations)} faces. System requires exactly 1 face."
+
+    landmarks = face_recognition.face_landmarks(image_rgb, locations, model="small")
+    landmarks = landmarks[0] if landmarks else None
+    quality_error = assess_face_quality(image_rgb, locations[0], landmarks)
+    _record_quality(quality_error.split(":")[0] if quality_error else None)
+    if quality_error:
+        return None, locations[0], landmarks, quality_error
+
+    started = time.perf_counter()
     encodings = face_recognition.face_encodings(image_rgb, locations)
+    _record_encoding((time.perf_counter() - started) * 1000)
     if not encodings:
-        return None, "No face encoding found."
-    
-    return encodings[0], None
+        return None, locations[0], landmarks, "No face encoding found."
+
+    return encodings[0], locations[0], landmarks, None
+
+
+def get_face_encoding(image_rgb, detector=None):
+    encoding, _location, _landmarks, error = _encode_face(image_rgb, detector)
+    return encoding, error
+
 
-def register_student_face(student_id: str, image_base64: str):
+# Passive liveness. It works on the face box and landmarks the encoder path
+# already produced, plus up to LIVENESS_MAX_BURST extra frames from the same
+# capture, for which only the landmark model is run (at the same box). The
+# texture and spectrum scores take about a millisecond on the 128px patch;
+# each burst frame adds a decode and a landmark pass.
+#
+# FACE_LIVENESS: "off", "report" (scores returned, never blocks) or "enforce".
+# The thresholds are heuristics; check them against your own kiosks' traffic
+# in report mode before enforcing.
+LIVENESS_MODE = os.environ.get("FACE_LIVENESS", "report").lower()
+LIVENESS_MAX_BURST = _env_int("FACE_LIVENESS_MAX_BURST", 2)
+# Printed and on-screen faces lose fine texture when recaptured...
+LIVENESS_MIN_LBP_ENTROPY = float(os.environ.get("FACE_LIVENESS_MIN_LBP_ENTROPY", 5.0))
+LIVENESS_MIN_HIGH_FREQ = float(os.environ.get("FACE_LIVENESS_MIN_HIGH_FREQ", 0.003))
+# ...and screens add moire: one narrow peak holding much of the fine detail.
+LIVENESS_MAX_MOIRE = float(os.environ.get("FACE_LIVENESS_MAX_MOIRE", 0.05))
+# Across a burst, a blink is eye contrast dropping below this share of its
+# peak; motion is the nose moving relative to the eyes (a flat photo keeps
+# that geometry fixed however it is moved), in inter-eye distances.
+LIVENESS_BLINK_RATIO = float(os.environ.get("FACE_LIVENESS_BLINK_RATIO", 0.7))
+LIVENESS_MIN_MOTION = float(os.environ.get("FACE_LIVENESS_MIN_MOTION", 0.015))
+
+_LBP_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1))
+_HIGH_FREQ_CUTOFF = 0.25  # cycles per pixel; Nyquist is 0.5
+_RADIUS_CACHE = {}
+
+
+def _lbp_entropy(patch):
+    """
+    Entropy (bits, 0-8) of the 8-neighbour local binary pattern histogram.
+    """
+    patch = patch.astype(np.int16)
+    h, w = patch.shape
+    centre = patch[1:-1, 1:-1]
+    codes = np.zeros(centre.shape, dtype=np.uint8)
+    for bit, (dy, dx) in enumerate(_LBP_OFFSETS):
+        codes |= (patch[1 + dy:h - 1 + dy, 1 + dx:w - 1 + dx] >= centre).astype(np.uint8) << bit
+    hist = np.bincount(codes.ravel(), minlength=256) / codes.size
+    hist = hist[hist > 0]
+    return float(-(hist * np.log2(hist)).sum())
+
+
+def _radius_bins(shape):
+    radius = _RADIUS_CACHE.get(shape)
+    if radius is None:
+        fy = np.fft.fftfreq(shape[0])[:, None]
+        fx = np.fft.rfftfreq(shape[1])[None, :]
+        radius = _RADIUS_CACHE[shape] = np.hypot(fy, fx)
+    return radius
+
+
+def _spectrum_scores(patch):
+    """
+    (high-frequency share of the energy, share of that high-frequency energy
+    in its single strongest bin).
+    """
+    patch = patch.astype(np.float32)
+    power = np.abs(np.fft.rfft2(patch - patch.mean())) ** 2
+    radius = _radius_bins(patch.shape)
+    total = float(power.sum())
+    if total <= 0:
+        return 0.0, 0.0
+    high = power[radius > _HIGH_FREQ_CUTOFF]
+    high_total = float(high.sum())
+    if high_total <= 0:
+        return 0.0, 0.0
+    return high_total / total, float(high.max()) / high_total
+
+
+def _eye_contrast(image_rgb, eye):
+    # Mean vertical gradient around the eye: lids, iris and sclera stack up
+    # when open; a closed lid is mostly skin.
+    try:
+        (x0, y0), (x1, y1) = eye[0], eye[-1]
+    except (TypeError, ValueError, IndexError):
+        return None
+    width = float(np.hypot(x1 - x0, y1 - y0))
+    if width < 2:
+        return None
+    cx, cy = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+    half_w, half_h = width * 0.6, width * 0.35
+    crop = image_rgb[
+        max(0, int(cy - half_h)):max(0, int(cy + half_h) + 1),
+        max(0, int(cx - half_w)):max(0, int(cx + half_w) + 1),
+    ]
+    if crop.shape[0] < 2 or crop.shape[1] < 1:
+        return None
+    gray = crop.mean(axis=2) if crop.ndim == 3 else crop.astype(np.float64)
+    return float(np.abs(np.diff(gray, axis=0)).mean())
+
+
+def _nose_offset(landmarks):
+    try:
+        left_eye = np.mean(landmarks["left_eye"], axis=0)
+        right_eye = np.mean(landmarks["right_eye"], axis=0)
+        nose = np.mean(landmarks["nose_tip"], axis=0)
+    except (KeyError, TypeError, ValueError):
+        return None
+    eye_distance = float(np.hypot(*(right_eye - left_eye)))
+    if eye_distance < 1.0:
+        return None
+    return (nose - (left_eye + right_eye) / 2.0) / eye_distance
+
+
+def assess_liveness(image_rgb, location, landmarks=None, burst=()):
+    """
+    Passive liveness for one detected face. ``burst`` holds (image_rgb,
+    landmarks) for extra frames of the same capture. Returns a dict of the
+    scores with ``live`` and, when not live, a ``reason``.
+    """
+    started = time.perf_counter()
+    result = {"live": True, "reason": None, "frames": 1 + len(burst)}
+    patch = _face_patch(image_rgb, location)
+    if patch is None:
+        result.update(live=False, reason="face too small")
+    else:
+        entropy = _lbp_entropy(patch)
+        high_freq, moire = _spectrum_scores(patch)
+        result.update(
+            lbp_entropy=round(entropy, 3), high_freq_ratio=round(high_freq, 4), moire_peak=round(moire, 4)
+        )
+        if entropy < LIVENESS_MIN_LBP_ENTROPY or high_freq < LIVENESS_MIN_HIGH_FREQ:
+            result.update(live=False, reason="flat texture")
+        elif moire > LIVENESS_MAX_MOIRE:
+            result.update(live=False, reason="screen pattern")
+
+    if burst:
+        frames = [(image_rgb, landmarks)] + list(burst)
+        contrasts, offsets = [], []
+        for frame, marks in frames:
+            if not marks:
+                continue
+            eyes = [_eye_contrast(frame, marks.get(name)) for name in ("left_eye", "right_eye")]
+            eyes = [value for value in eyes if value is not None]
+            if eyes:
+                contrasts.append(sum(eyes) / len(eyes))
+            offset = _nose_offset(marks)
+            if offset is not None:
+                offsets.append(offset)
+        blink = len(contrasts) > 1 and min(contrasts) < LIVENESS_BLINK_RATIO * max(contrasts)
+        motion = (
+            max(float(np.hypot(*(offset - offsets[0]))) for offset in offsets[1:]) if len(offsets) > 1 else 0.0
+        )
+        result.update(blink=bool(blink), motion=round(motion, 4))
+        if result["live"] and not blink and motion < LIVENESS_MIN_MOTION:
+            result.update(live=False, reason="no blink or motion")
+
+    duration_ms = (time.perf_counter() - started) * 1000
+    result["duration_ms"] = round(duration_ms, 2)
+    with _QUALITY_LOCK:
+        _QUALITY_STATS["liveness_checked"] += 1
+        _QUALITY_STATS["liveness_failed"] += 0 if result["live"] else 1
+        _QUALITY_STATS["liveness_ms_total"] += duration_ms
+    return result
+
+
+def _burst_landmarks(frames, image_shape, location):
+    """
+    Decodes burst frames and runs only the landmark model at the primary
+    frame's face box. Frames that fail to decode or differ in size are skipped.
+    """
+    face_recognition = _get_face_recognition()
+    burst = []
+    for frame_base64 in list(frames or ())[:LIVENESS_MAX_BURST]:
+        frame_rgb, error = decode_image_checked(frame_base64)
+        if error or frame_rgb.shape != image_shape:
+            continue
+        marks = face_recognition.face_landmarks(frame_rgb, [location], model="small")
+        burst.append((frame_rgb, marks[0] if marks else None))
+    return burst
+
+
+# Student -> admin lookups for students the shared gallery doesn't hold. A
+# student never changes admin, so the TTL only bounds how long a removed
+# student lingers.
+STUDENT_ADMIN_TTL_SECONDS = _env_int("FACE_STUDENT_ADMIN_TTL_SECONDS", 300)
+STUDENT_ADMIN_MAX_ENTRIES = 50000
+_student_admins = OrderedDict()
+_student_admins_lock = threading.Lock()
+
+
+def cached_admin_of_student(student_id):
+    """
+    The student's admin from the gallery or the lookup cache, or None.
+    Never does I/O, so it is safe on the event loop.
+    """
+    gallery = get_gallery()
+    admin_id = gallery.admin_of(student_id) if gallery is not None else None
+    if admin_id is not None:
+        return admin_id
+    with _student_admins_lock:
+        entry = _student_admins.get(student_id)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+    return None
+
+
+def admin_of_student(student_id):
+    """
+    The student's admin: gallery, lookup cache, kiosk mirror, then Supabase.
+    Returns None when it can't be found (the default match rule applies).
+    """
+    admin_id = cached_admin_of_student(student_id)
+    if admin_id is not None:
+        return admin_id
+    try:
+        store = get_local_store()
+        student = store.get_student(student_id) if store is not None else None
+        admin_id = student.get("admin_id") if student else None
+        if admin_id is None:
+            res = get_supabase_client().table("students").select("admin_id").eq("id", student_id).execute()
+            admin_id = res.data[0].get("admin_id") if res.data else None
+    except Exception as e:
+        logger.warning(f"Could not look up the admin of student {student_id}: {e}")
+        return None
+    if admin_id is not None:
+        with _student_admins_lock:
+            _student_admins[student_id] = (admin_id, time.monotonic() + STUDENT_ADMIN_TTL_SECONDS)
+            _student_admins.move_to_end(student_id)
+            while len(_student_admins) > STUDENT_ADMIN_MAX_ENTRIES:
+                _student_admins.popitem(last=False)
+    return admin_id
+
+
+def reset_student_admins():
+    with _student_admins_lock:
+        _student_admins.clear()
+
+
+def match_rule(admin_id):
+    """
+    (max distance, min confidence) applied to ``admin_id``'s students.
+    """
+    threshold = get_admin_threshold(admin_id)
+    if threshold is None:
+        return FACE_MATCH_THRESHOLD, MIN_CONFIDENCE
+    return threshold, (1.0 - threshold) * 100
+
+
+def match_encodings(probes, gallery_matrix):
+    """
+    Match every probe encoding against every gallery row in one pass.
+    Returns (best_rows, distances) where best_rows[i] is the closest gallery
+    row for probe i (-1 if the gallery is empty).
+    """
+    probes = np.asarray(probes, dtype=np.float64).reshape(-1, 128)
+    if len(gallery_matrix) == 0 or len(probes) == 0:
+        return np.full(len(probes), -1), np.full(len(probes), np.inf)
+
+    gallery = np.asarray(gallery_matrix, dtype=np.float64)
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab, which avoids a (P, G, 128) temporary.
+    sq = (
+        np.einsum("ij,ij->i", probes, probes)[:, None]
+        + np.einsum("ij,ij->i", gallery, gallery)[None, :]
+        - 2.0 * probes @ gallery.T
+    )
+    distances = np.sqrt(np.maximum(sq, 0.0))
+    best_rows = distances.argmin(axis=1)
+    return best_rows, distances[np.arange(len(probes)), best_rows]
+
+
+def identify_faces(admin_id: str, images):
+    """
+    Detect every face in one or more frames and match them against the
+    admin's registered encodings.
+    Returns ({student_id: confidence}, stats) where each student keeps their
+    best confidence across frames, or (None, error message).
+    """
+    face_recognition = _get_face_recognition()
+    detector = get_admin_detector(admin_id)
+    probes = []
+    for image_base64 in images:
+        image_rgb, error = decode_image_checked(image_base64, target_side=BATCH_DETECT_TARGET_SIDE)
+        if error:
+            return None, error
+        locations = detector.detect(image_rgb)
+        if locations:
+            probes.extend(face_recognition.face_encodings(image_rgb, locations))
+
+    if not probes:
+        return None, "Found 0 faces in the submitted frames."
+
+    gallery = fetch_admin_gallery(get_supabase_client(), admin_id)
+    best_rows, best_distances = match_encodings(probes, gallery.matrix)
+    max_distance, min_confidence = match_rule(admin_id)
+
+    matches = {}
+    for row, dist in zip(best_rows, best_distances):
+        if row < 0:
+            continue
+        confidence = (1.0 - dist) * 100
+        if dist <= max_distance and confidence >= min_confidence:
+            student_id = gallery.student_ids[row]
+            matches[student_id] = max(matches.get(student_id, 0.0), round(float(confidence), 2))
+
+    stats = {"faces_detected": len(probes), "students_matched": len(matches)}
+    logger.info(f"Batch identification for admin {admin_id}: {stats}")
+    return matches, stats
+
+
+def register_student_face(student_id: str, image_base64: str, admin_id: str = None):
     """
     Register a face for a student.
     Stores encoding in Supabase 'face_encodings' table.
     """
-    image_rgb = decode_image(image_base64)
-    if image_rgb is None:
-        return False, "Invalid image"
+    image_rgb, error = decode_image_checked(image_base64)
+    if error:
+        return False, error
 
-    encoding, error = get_face_encoding(image_rgb)
+    encoding, error = get_face_encoding(image_rgb, get_admin_detector(admin_id))
     if error:
         return False, error
 
@@ -64,6 +894,7 @@ def register_student_face(student_id: str, image_base64: str):
         return False, f"Invalid encoding length: {len(encoding_list)}"
     
     client = get_supabase_client()
+    store = get_local_store()
     
     # Upsert to handle re-registration (or delete old first)
     # Using upsert on specific constraint if unique constraint on student_id exists
@@ -80,65 +911,142 @@ def register_student_face(student_id: str, image_base64: str):
             logger.error(f"Supabase upsert failed for student {student_id}")
             return False, "Database update failed"
         
+        if store is not None:
+            store.put_encoding(student_id, encoding)
+        upsert_encoding(student_id, admin_id, encoding)
+        record_change(student_id)
+        _replay_cache.invalidate(student_id)
         logger.info(f"Successfully registered face for student {student_id}")
         return True, "Face registered successfully"
+    except OFFLINE_ERRORS as e:
+        if store is not None and store.covers(admin_id):
+            # Offline kiosk: keep it locally and push on the next sync.
+            store.put_encoding(student_id, encoding, dirty=True)
+            upsert_encoding(student_id, admin_id, encoding)
+            record_change(student_id)
+            _replay_cache.invalidate(student_id)
+            logger.warning(f"Supabase unreachable, queued face registration for {student_id} locally: {e}")
+            return True, "Face registered successfully"
+        logger.error(f"Registration error for student {student_id}: {e}")
+        return False, str(e)
     except Exception as e:
         logger.error(f"Registration error for student {student_id}: {e}")
         return False, str(e)
 
-def verify_student_face(student_id: str, image_base64: str):
+def verify_student_face(student_id: str, image_base64: str, burst=None, phash=None, admin_id=None):
     """
     Verify uploaded face against stored encoding.
+    Returns (match, confidence, message, liveness); liveness is None when
+    FACE_LIVENESS is off. ``burst`` is an optional list of extra frames from
+    the same capture for the blink/motion check. ``admin_id`` picks the
+    student's calibrated threshold; without it the defaults apply.
+    Replays of a recently rejected frame are answered from the replay cache.
+    Callers that already hashed the frame and checked the cache pass
+    ``phash`` so neither is done twice.
     """
-    image_rgb = decode_image(image_base64)
-    if image_rgb is None:
-        return False, 0.0, "Invalid image"
+    use_cache = replay_cache_enabled()
+    if phash is None and use_cache:
+        phash = frame_hash(image_base64)
+        cached = _replay_cache.get(student_id, phash)
+        if cached is not None:
+            logger.info(f"Replayed frame for {student_id}, returning cached rejection")
+            return cached
+
+    result = _verify_student_face(student_id, image_base64, burst, admin_id)
+    _record_attempt(student_id, result[0], result[2])
+    # Lookup failures and unregistered students can change on the next call.
+    if use_cache and not result[2].startswith(("Verification error", "Face not registered")):
+        _replay_cache.put(student_id, phash, result)
+    return result
 
-    new_encoding, error = get_face_encoding(image_rgb)
+
+def _verify_student_face(student_id: str, image_base64: str, burst=None, admin_id=None):
+    image_rgb, error = decode_image_checked(image_base64)
     if error:
-        return False, 0.0, error
+        return False, 0.0, error, None
 
-    client = get_supabase_client()
+    # Same detector the student was enrolled with (FACE_DETECTOR_BY_ADMIN).
+    new_encoding, location, landmarks, error = _encode_face(image_rgb, get_admin_detector(admin_id))
+    if error:
+        return False, 0.0, error, None
+
+    liveness = None
+    if LIVENESS_MODE != "off":
+        frames = _burst_landmarks(burst, image_rgb.shape, location) if burst else ()
+        liveness = assess_liveness(image_rgb, location, landmarks, frames)
+        if LIVENESS_MODE == "enforce" and not liveness["live"]:
+            logger.warning(f"Liveness check failed for {student_id}: {liveness['reason']}")
+            return False, 0.0, f"Liveness check failed: {liveness['reason']}", liveness
+
+    store = get_local_store()
     
     try:
         # Fetch stored encoding
         logger.info(f"Verifying face for student_id: {student_id}")
-        res = client.table("face_encodings").select("encoding").eq("student_id", student_id).execute()
-        
-        if not res.data:
-            logger.warning(f"Face not registered for student_id: {student_id}")
-            return False, 0.0, "Face not registered for this student"
-        
-        stored_data = res.data[0]['encoding']
-        stored_encoding = np.array(stored_data, dtype=np.float64)
+        # In-process gallery first (lock-free read of an immutable snapshot),
+        # then the kiosk mirror, then Supabase.
+        apply_logged_changes()
+        gallery = get_gallery()
+        stored_encoding = gallery.get(student_id) if gallery is not None else None
+        if stored_encoding is None and store is not None:
+            known, stored_encoding = store.lookup_encoding(student_id)
+            if known and stored_encoding is None:
+                # Deleted on this kiosk; the delete hasn't reached Supabase yet.
+                return False, 0.0, "Face not registered for this student", liveness
+        if stored_encoding is None:
+            res = get_supabase_client().table("face_encodings").select("encoding").eq("student_id", student_id).execute()
+            
+            if not res.data:
+                logger.warning(f"Face not registered for student_id: {student_id}")
+                return False, 0.0, "Face not registered for this student", liveness
+            
+            stored_data = res.data[0]['encoding']
+            stored_encoding = np.array(stored_data, dtype=np.float64)
         
         # Ensure both encodings are 1D arrays with shape (128,)
         if stored_encoding.shape != (128,):
             logger.error(f"Invalid stored encoding shape: {stored_encoding.shape}")
-            return False, 0.0, f"Invalid stored encoding format. Expected (128,), got {stored_encoding.shape}"
+            return False, 0.0, f"Invalid stored encoding format. Expected (128,), got {stored_encoding.shape}", liveness
         
         if new_encoding.shape != (128,):
             logger.error(f"Invalid new encoding shape: {new_encoding.shape}")
-            return False, 0.0, f"Invalid face encoding format. Expected (128,), got {new_encoding.shape}"
+            return False, 0.0, f"Invalid face encoding format. Expected (128,), got {new_encoding.shape}", liveness
         
         # Compare - ensure stored_encoding is in a list for face_distance
-        distances = face_recognition.face_distance([stored_encoding], new_encoding)
+        distances = _get_face_recognition().face_distance([stored_encoding], new_encoding)
         dist = distances[0]
         confidence = (1.0 - dist) * 100
-        
-        is_match = dist <= FACE_MATCH_THRESHOLD and confidence >= MIN_CONFIDENCE
+
+        max_distance, min_confidence = match_rule(admin_id)
+        is_match = dist <= max_distance and confidence >= min_confidence
         
         logger.info(f"Verification result for {student_id}: match={is_match}, confidence={confidence}%")
-        return is_match, round(confidence, 2), "Match found" if is_match else "Face does not match"
+        return is_match, round(confidence, 2), "Match found" if is_match else "Face does not match", liveness
         
     except Exception as e:
         logger.error(f"Verification exception for {student_id}: {e}")
-        return False, 0.0, f"Verification error: {str(e)}"
+        return False, 0.0, f"Verification error: {str(e)}", liveness
 
-def delete_student_face(student_id: str):
+def delete_student_face(student_id: str, admin_id: str = None):
     client = get_supabase_client()
+    store = get_local_store()
     try:
         client.table("face_encodings").delete().eq("student_id", student_id).execute()
+        if store is not None:
+            store.delete_encoding(student_id)
+        remove_encoding(student_id)
+        record_change(student_id)
+        _replay_cache.invalidate(student_id)
         return True, "Deleted"
+    except OFFLINE_ERRORS as e:
+        if store is not None and store.covers(admin_id):
+            store.delete_encoding(student_id, dirty=True)
+            remove_encoding(student_id)
+            record_change(student_id)
+            _replay_cache.invalidate(student_id)
+            logger.warning(f"Supabase unreachable, queued face deletion for {student_id} locally: {e}")
+            return True, "Deleted"
+        return False, str(e)
     except Exception as e:
+        logger.error(f"Deletion error for student {student_id}: {e}")
         return False, str(e)
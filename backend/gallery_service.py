@@ -0,0 +1,724 @@
+"""
+Read-mostly face encoding gallery.
+
+The gallery is a (N, 128) float64 matrix of every registered encoding plus
+student/admin id columns. It is persisted as an .npy file and opened with
+mmap, so every worker on a node maps the same page-cache pages instead of
+holding a private copy. In pre-fork deployments the parent loads it once and
+the forked workers inherit the mapping copy-on-write.
+
+Snapshots are versioned: each save goes to its own directory under
+``snapshots/`` and a ``CURRENT`` pointer file is swapped atomically, so a
+worker never maps a half-written gallery. The index records a watermark (the
+newest ``updated_at`` seen); on boot a worker maps the current snapshot,
+fetches only the encodings changed since then and re-reads the students in
+the change log, leaving the id scan to the refresher's first pass.
+
+One process per node owns the snapshots (an flock on ``owner.lock``): its
+refresher folds changes into a new snapshot, while the other workers keep
+theirs as a small overlay and remap the owner's snapshot when it moves on.
+The full student_id scan that finds deleted rows only runs when there are
+changes or every FACE_GALLERY_SCAN_SECONDS.
+
+Registrations and deletions are also appended to ``changes.log``, and every
+worker re-reads the ids other processes logged there before its next
+verification, so a change made on one worker takes effect on the others at
+once instead of after the refresher's next pass.
+"""
+import copy
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from database_service import get_supabase_client
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows: every process writes snapshots
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIM = 128
+GALLERY_DIR = os.environ.get(
+    "FACE_GALLERY_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".gallery"),
+)
+MATRIX_FILE = "encodings.npy"
+INDEX_FILE = "index.json"
+CURRENT_FILE = "CURRENT"
+OWNER_FILE = "owner.lock"
+CHANGES_FILE = "changes.log"
+# The snapshot owner empties the change log after a refresh once it is this big.
+CHANGES_MAX_BYTES = 1024 * 1024
+SNAPSHOT_FORMAT = 2
+SNAPSHOTS_KEPT = 2
+# Re-fetch this far behind the watermark to catch rows committed late with an
+# older updated_at.
+WATERMARK_OVERLAP_SECONDS = 120
+FETCH_PAGE_SIZE = 1000
+IN_FILTER_CHUNK = 200
+
+# Local changes are kept as an overlay on the base matrix and folded in once
+# there are this many.
+COMPACT_AFTER = int(os.environ.get("FACE_GALLERY_COMPACT_AFTER", 256))
+REFRESH_SECONDS = int(os.environ.get("FACE_GALLERY_REFRESH_SECONDS", 30))
+SCAN_SECONDS = int(os.environ.get("FACE_GALLERY_SCAN_SECONDS", 600))
+
+# The installed gallery is immutable: readers grab the reference and never
+# lock; writers build a new gallery and swap the reference under
+# _write_lock, which only orders writers among themselves.
+_gallery = None
+_write_lock = threading.Lock()
+
+
+class EncodingGallery:
+    """
+    Immutable once built. Changes go through with_changes(), which returns a
+    new gallery sharing this one's base matrix and indexes.
+    """
+
+    def __init__(self, student_ids, admin_ids, matrix, watermark=None):
+        self.student_ids = list(student_ids)
+        self.admin_ids = list(admin_ids)
+        self.matrix = matrix
+        self.watermark = watermark
+        # Snapshot this gallery was mapped from, if any.
+        self.generation = None
+        self._row_by_student = {sid: i for i, sid in enumerate(self.student_ids)}
+        self._rows_by_admin = {}
+        for i, admin_id in enumerate(self.admin_ids):
+            self._rows_by_admin.setdefault(admin_id, []).append(i)
+        # student_id -> (admin_id, vector), or None once deleted.
+        self._overlay = {}
+        self._overlay_admins = frozenset()
+        self._size = len(self.student_ids)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, student_id):
+        if student_id in self._overlay:
+            return self._overlay[student_id] is not None
+        return student_id in self._row_by_student
+
+    @property
+    def pending_changes(self):
+        return len(self._overlay)
+
+    def get(self, student_id):
+        if student_id in self._overlay:
+            entry = self._overlay[student_id]
+            return None if entry is None else entry[1]
+        row = self._row_by_student.get(student_id)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def for_admin(self, admin_id):
+        """
+        Returns (student_ids, matrix) restricted to one admin's students.
+        """
+        rows = self._rows_by_admin.get(admin_id) or []
+        if admin_id in self._overlay_admins:
+            student_ids = [self.student_ids[i] for i in rows if self.student_ids[i] not in self._overlay]
+            vectors = [self.matrix[i] for i in rows if self.student_ids[i] not in self._overlay]
+            for student_id, entry in self._overlay.items():
+                if entry is not None and entry[0] == admin_id:
+                    student_ids.append(student_id)
+                    vectors.append(entry[1])
+            if not vectors:
+                return [], np.empty((0, ENCODING_DIM), dtype=np.float64)
+            return student_ids, np.vstack(vectors)
+        if not rows:
+            return [], np.empty((0, ENCODING_DIM), dtype=np.float64)
+        if rows[-1] - rows[0] + 1 == len(rows):
+            # build_gallery() groups rows by admin, so this is a zero-copy view.
+            return self.student_ids[rows[0]:rows[-1] + 1], self.matrix[rows[0]:rows[-1] + 1]
+        return [self.student_ids[i] for i in rows], self.matrix[rows]
+
+    def with_changes(self, upserts=None, deletes=()):
+        """
+        New gallery with ``upserts`` ({student_id: (admin_id, vector)}) and
+        ``deletes`` applied. Shares the base matrix; only the overlay is copied.
+        """
+        derived = copy.copy(self)
+        overlay = dict(self._overlay)
+        admins = set(self._overlay_admins)
+        for student_id, (admin_id, vector) in (upserts or {}).items():
+            if admin_id is None:
+                # Keep the owner we already know about.
+                admin_id = self.admin_of(student_id)
+            vector = np.array(vector, dtype=np.float64)
+            vector.setflags(write=False)
+            overlay[student_id] = (admin_id, vector)
+            admins.add(admin_id)
+        for student_id in deletes:
+            overlay[student_id] = None
+        for student_id in list(upserts or {}) + list(deletes):
+            row = self._row_by_student.get(student_id)
+            if row is not None:
+                admins.add(self.admin_ids[row])
+
+        derived._overlay = overlay
+        derived._overlay_admins = frozenset(admins)
+        derived._size = (
+            len(self.student_ids)
+            - sum(1 for sid in overlay if sid in self._row_by_student)
+            + sum(1 for entry in overlay.values() if entry is not None)
+        )
+        return derived
+
+    def ids(self):
+        """
+        Every student_id in the gallery, overlay included.
+        """
+        ids = {sid for sid in self.student_ids if sid not in self._overlay}
+        ids.update(sid for sid, entry in self._overlay.items() if entry is not None)
+        return ids
+
+    def admin_of(self, student_id):
+        entry = self._overlay.get(student_id)
+        if entry is not None:
+            return entry[0]
+        row = self._row_by_student.get(student_id)
+        return self.admin_ids[row] if row is not None else None
+
+    def compacted(self):
+        """
+        Fold the overlay into a fresh base matrix.
+        """
+        if not self._overlay:
+            return self
+        keep_rows = [i for i, sid in enumerate(self.student_ids) if sid not in self._overlay]
+        live = [(sid, entry) for sid, entry in self._overlay.items() if entry is not None]
+        delta = EncodingGallery(
+            [sid for sid, _ in live],
+            [entry[0] for _, entry in live],
+            np.vstack([entry[1] for _, entry in live]) if live else np.empty((0, ENCODING_DIM), dtype=np.float64),
+        )
+        return merge_galleries(self, keep_rows, delta)
+
+
+# Unique column each table is paged by; "id" for the rest.
+_ORDER_KEYS = {"face_encodings": "student_id"}
+
+
+def fetch_all_rows(client, table, fields, filters=None, order=None):
+    """
+    Page through a whole table (PostgREST caps a single response).
+    ``filters`` is an optional list of (field, value) equality filters or
+    (field, operator, value) filters such as ("updated_at", "gte", ts).
+    Pages are ordered by ``order`` (the table's key by default); without a
+    stable order, offsets can skip or repeat rows between pages.
+    """
+    order = order or _ORDER_KEYS.get(table, "id")
+    rows = []
+    start = 0
+    while True:
+        query = client.table(table).select(fields)
+        for spec in filters or ():
+            field, op, value = spec if len(spec) == 3 else (spec[0], "eq", spec[1])
+            query = getattr(query, op)(field, value)
+        res = query.order(order).range(start, start + FETCH_PAGE_SIZE - 1).execute()
+        page = res.data or []
+        rows.extend(page)
+        if len(page) < FETCH_PAGE_SIZE:
+            return rows
+        start += FETCH_PAGE_SIZE
+
+
+def _max_watermark(current, rows):
+    stamps = [row["updated_at"] for row in rows if row.get("updated_at")]
+    if current:
+        stamps.append(current)
+    return max(stamps) if stamps else None
+
+
+def build_gallery(encoding_rows, admin_by_student, watermark=None):
+    """
+    Build an in-memory gallery from face_encodings rows, skipping malformed ones.
+    """
+    student_ids, admin_ids, vectors = [], [], []
+    # Group by admin so each tenant's encodings are one contiguous block.
+    encoding_rows = sorted(encoding_rows, key=lambda r: str(admin_by_student.get(r.get("student_id")) or ""))
+    for row in encoding_rows:
+        student_id = row.get("student_id")
+        vector = np.asarray(row.get("encoding") or [], dtype=np.float64)
+        if not student_id or vector.shape != (ENCODING_DIM,):
+            logger.warning(f"Skipping malformed gallery row for student {student_id}")
+            continue
+        student_ids.append(student_id)
+        admin_ids.append(admin_by_student.get(student_id))
+        vectors.append(vector)
+
+    matrix = np.vstack(vectors) if vectors else np.empty((0, ENCODING_DIM), dtype=np.float64)
+    return EncodingGallery(student_ids, admin_ids, matrix, _max_watermark(watermark, encoding_rows))
+
+
+def merge_galleries(base, keep_rows, delta):
+    """
+    Rows ``keep_rows`` of ``base`` plus everything in ``delta``, regrouped by admin.
+    """
+    student_ids = [base.student_ids[i] for i in keep_rows] + delta.student_ids
+    admin_ids = [base.admin_ids[i] for i in keep_rows] + delta.admin_ids
+    matrix = np.concatenate([np.asarray(base.matrix[keep_rows], dtype=np.float64), delta.matrix])
+    order = sorted(range(len(student_ids)), key=lambda i: str(admin_ids[i] or ""))
+    merged = EncodingGallery(
+        [student_ids[i] for i in order],
+        [admin_ids[i] for i in order],
+        matrix[order] if order else matrix,
+        max(filter(None, (base.watermark, delta.watermark)), default=None),
+    )
+    merged.matrix.setflags(write=False)
+    return merged
+
+
+def fetch_admin_gallery(client, admin_id):
+    """
+    Build a gallery of one admin's encodings straight from Supabase.
+    """
+    students_res = client.table("students").select("id").eq("admin_id", admin_id).execute()
+    student_ids = [row["id"] for row in (students_res.data or []) if row.get("id")]
+
+    encoding_rows = []
+    # Chunk the IN filter so the PostgREST query string stays short.
+    for start in range(0, len(student_ids), IN_FILTER_CHUNK):
+        chunk = student_ids[start:start + IN_FILTER_CHUNK]
+        res = client.table("face_encodings").select("student_id, encoding").in_("student_id", chunk).execute()
+        encoding_rows.extend(res.data or [])
+
+    return build_gallery(encoding_rows, {sid: admin_id for sid in student_ids})
+
+
+def _read_current(directory):
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as fh:
+            return fh.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _prune_snapshots(directory, current):
+    snapshots_dir = os.path.join(directory, "snapshots")
+    names = sorted(os.listdir(snapshots_dir))
+    # Workers still mapping a removed snapshot keep their pages until they let go.
+    for name in names[:-SNAPSHOTS_KEPT]:
+        if name != current:
+            shutil.rmtree(os.path.join(snapshots_dir, name), ignore_errors=True)
+
+
+def save_gallery(gallery, directory=GALLERY_DIR):
+    """
+    Write ``gallery`` as a new snapshot and make it current. Returns its name.
+    """
+    generation = f"{time.time_ns():020d}-{os.getpid()}"
+    snapshot_dir = os.path.join(directory, "snapshots", generation)
+    os.makedirs(snapshot_dir)
+
+    with open(os.path.join(snapshot_dir, MATRIX_FILE), "wb") as fh:
+        np.save(fh, np.ascontiguousarray(gallery.matrix, dtype=np.float64))
+    with open(os.path.join(snapshot_dir, INDEX_FILE), "w") as fh:
+        json.dump(
+            {
+                "format": SNAPSHOT_FORMAT,
+                "watermark": gallery.watermark,
+                "student_ids": gallery.student_ids,
+                "admin_ids": gallery.admin_ids,
+            },
+            fh,
+        )
+
+    # Swap the pointer last so readers only ever see a complete snapshot.
+    tmp_current = os.path.join(directory, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(tmp_current, "w") as fh:
+        fh.write(generation)
+    os.replace(tmp_current, os.path.join(directory, CURRENT_FILE))
+    _prune_snapshots(directory, generation)
+    return generation
+
+
+def open_gallery(directory=GALLERY_DIR):
+    """
+    Memory-map the current snapshot written by save_gallery().
+    Returns None if there is no usable snapshot.
+    """
+    generation = _read_current(directory)
+    if generation is None:
+        return None
+    snapshot_dir = os.path.join(directory, "snapshots", generation)
+    try:
+        with open(os.path.join(snapshot_dir, INDEX_FILE)) as fh:
+            index = json.load(fh)
+        matrix = np.load(os.path.join(snapshot_dir, MATRIX_FILE), mmap_mode="r")
+    except (OSError, ValueError) as e:
+        logger.error(f"Gallery snapshot {generation} is unreadable, ignoring it: {e}")
+        return None
+    if index.get("format") != SNAPSHOT_FORMAT:
+        logger.info(f"Gallery snapshot {generation} has an old format, ignoring it")
+        return None
+    if matrix.ndim != 2 or matrix.shape[1] != ENCODING_DIM or matrix.shape[0] != len(index["student_ids"]):
+        logger.error(f"Gallery snapshot {generation} is inconsistent, ignoring it")
+        return None
+    gallery = EncodingGallery(index["student_ids"], index["admin_ids"], matrix, index.get("watermark"))
+    gallery.generation = generation
+    return gallery
+
+
+def _rewind(watermark):
+    try:
+        stamp = datetime.fromisoformat(watermark)
+    except (TypeError, ValueError):
+        return watermark
+    return (stamp - timedelta(seconds=WATERMARK_OVERLAP_SECONDS)).isoformat()
+
+
+def _admins_for(client, student_ids):
+    admin_by_student = {}
+    student_ids = sorted(student_ids)
+    for start in range(0, len(student_ids), IN_FILTER_CHUNK):
+        chunk = student_ids[start:start + IN_FILTER_CHUNK]
+        res = client.table("students").select("id, admin_id").in_("id", chunk).execute()
+        admin_by_student.update({row["id"]: row.get("admin_id") for row in (res.data or []) if row.get("id")})
+    return admin_by_student
+
+
+def _fetch_changes(client, gallery, scan_ids=True, scan_on_change=True):
+    """
+    (modified rows, removed ids, watermark): the encodings changed since the
+    gallery's watermark and, when ``scan_ids`` or there are changes (and
+    ``scan_on_change``), the ids it holds that are gone from Supabase.
+    """
+    since = _rewind(gallery.watermark)
+    changed = fetch_all_rows(client, "face_encodings", "student_id, encoding, updated_at", [("updated_at", "gte", since)])
+
+    # Rows inside the overlap window come back on every pass; skip the ones
+    # the gallery already has.
+    modified = []
+    for row in changed:
+        stored = gallery.get(row.get("student_id"))
+        if stored is None or not np.array_equal(stored, row.get("encoding")):
+            modified.append(row)
+    removed = set()
+    if scan_ids or (modified and scan_on_change):
+        live_ids = {row["student_id"] for row in fetch_all_rows(client, "face_encodings", "student_id")}
+        removed = gallery.ids() - live_ids
+    return modified, removed, _max_watermark(gallery.watermark, changed)
+
+
+def refresh_gallery(client, snapshot, scan_ids=True, scan_on_change=True):
+    """
+    Bring a snapshot up to date with Supabase by fetching only the encodings
+    changed since its watermark, plus the id column to drop deleted rows.
+    Returns the snapshot itself when nothing changed.
+    """
+    modified, removed, watermark = _fetch_changes(client, snapshot, scan_ids, scan_on_change)
+    if not modified and not removed:
+        return snapshot
+
+    modified_ids = {row.get("student_id") for row in modified}
+    keep_rows = [i for i, sid in enumerate(snapshot.student_ids) if sid not in removed and sid not in modified_ids]
+    delta = build_gallery(modified, _admins_for(client, modified_ids), watermark)
+    return merge_galleries(snapshot, keep_rows, delta)
+
+
+def _as_upserts(client, rows):
+    """
+    {student_id: (admin_id, vector)} for with_changes(), skipping malformed rows.
+    """
+    rows = [
+        row
+        for row in rows
+        if row.get("student_id") and np.asarray(row.get("encoding") or [], dtype=np.float64).shape == (ENCODING_DIM,)
+    ]
+    admins = _admins_for(client, {row["student_id"] for row in rows})
+    return {row["student_id"]: (admins.get(row["student_id"]), row["encoding"]) for row in rows}
+
+
+_owner_fd = None
+_owner_pid = None
+_owner_lock = threading.Lock()
+
+
+def _try_lock(directory):
+    os.makedirs(directory, exist_ok=True)
+    fd = os.open(os.path.join(directory, OWNER_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def is_snapshot_owner(directory=None):
+    """
+    Whether this process writes the gallery snapshots. The first refresher
+    to take the lock keeps it for the life of the process.
+    """
+    global _owner_fd, _owner_pid
+    if fcntl is None:
+        return True
+    with _owner_lock:
+        if _owner_fd is not None and _owner_pid == os.getpid():
+            return True
+        fd = _try_lock(directory or GALLERY_DIR)
+        if fd is None:
+            return False
+        _owner_fd, _owner_pid = fd, os.getpid()
+        return True
+
+
+def _save_if_unowned(gallery, directory):
+    """
+    Boot-time save: only when no refresher owns the snapshots (it would
+    publish the same changes), and without keeping the lock, so a prefork
+    parent doesn't hand it to every worker.
+    """
+    if fcntl is None or (_owner_fd is not None and _owner_pid == os.getpid()):
+        save_gallery(gallery, directory)
+        return True
+    fd = _try_lock(directory)
+    if fd is None:
+        return False
+    try:
+        save_gallery(gallery, directory)
+    finally:
+        os.close(fd)
+    return True
+
+
+# Change log
+
+_changes_offset = 0
+_changes_lock = threading.Lock()
+
+
+def _changes_size(directory):
+    try:
+        return os.stat(os.path.join(directory, CHANGES_FILE)).st_size
+    except OSError:
+        return 0
+
+
+def record_change(student_id, directory=None):
+    """
+    Tell the other workers on this node that ``student_id``'s encoding was
+    registered or deleted.
+    """
+    record_changes((student_id,), directory)
+
+
+def record_changes(student_ids, directory=None):
+    """
+    record_change for several students in one append.
+    """
+    if _gallery is None or not student_ids:
+        return
+    directory = directory or GALLERY_DIR
+    pid = os.getpid()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd = os.open(os.path.join(directory, CHANGES_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(f"{pid} {student_id}\n" for student_id in student_ids).encode("utf-8"))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Could not log gallery changes for {len(student_ids)} students: {e}")
+
+
+def _reload_students(client, student_ids):
+    rows = []
+    student_ids = sorted(student_ids)
+    for start in range(0, len(student_ids), IN_FILTER_CHUNK):
+        chunk = student_ids[start:start + IN_FILTER_CHUNK]
+        res = client.table("face_encodings").select("student_id, encoding").in_("student_id", chunk).execute()
+        rows.extend(res.data or [])
+    upserts = _as_upserts(client, rows)
+    _install_change(upserts, [sid for sid in student_ids if sid not in upserts])
+
+
+def apply_logged_changes(client=None, directory=None):
+    """
+    Re-read the encodings other processes logged as changed since the last
+    call. Costs one stat() when nothing changed. Returns the number of
+    students re-read; on a Supabase error the same lines are tried again on
+    the next call.
+    """
+    global _changes_offset
+    if _gallery is None:
+        return 0
+    directory = directory or GALLERY_DIR
+    size = _changes_size(directory)
+    if size == _changes_offset:
+        return 0
+    with _changes_lock:
+        offset = _changes_offset if size >= _changes_offset else 0  # emptied by the owner
+        try:
+            with open(os.path.join(directory, CHANGES_FILE), "rb") as fh:
+                fh.seek(offset)
+                data = fh.read(size - offset)
+        except OSError as e:
+            logger.warning(f"Could not read the gallery change log: {e}")
+            return 0
+        complete = data.rfind(b"\n") + 1
+        pid = str(os.getpid())
+        student_ids = set()
+        for line in data[:complete].decode("utf-8", "replace").splitlines():
+            writer, _, student_id = line.partition(" ")
+            if writer != pid and student_id:
+                student_ids.add(student_id)
+        if student_ids:
+            try:
+                _reload_students(client or get_supabase_client(), student_ids)
+            except Exception as e:
+                logger.warning(f"Could not re-read {len(student_ids)} changed gallery entries: {e}")
+                return 0
+        _changes_offset = offset + complete
+        return len(student_ids)
+
+
+def load_gallery(client=None, directory=GALLERY_DIR, full=False):
+    """
+    Install the mmapped gallery as this process's gallery. Starts from the
+    current snapshot, applies the changes since its watermark and re-reads
+    the students in the change log (deletions made through this API); falls
+    back to fetching every encoding when there is no snapshot (or ``full``).
+    Rows deleted some other way go at the refresher's first id scan.
+    """
+    global _gallery, _changes_offset
+    client = client or get_supabase_client()
+    started = time.perf_counter()
+    snapshot = None if full else open_gallery(directory)
+
+    if snapshot is not None and snapshot.watermark:
+        _changes_offset = 0
+        gallery = refresh_gallery(client, snapshot, scan_ids=False, scan_on_change=False)
+        source = "snapshot" if gallery is snapshot else "snapshot+delta"
+    else:
+        # Changes logged before the fetch are in what it returns.
+        _changes_offset = _changes_size(directory)
+        encoding_rows = fetch_all_rows(client, "face_encodings", "student_id, encoding, updated_at")
+        student_rows = fetch_all_rows(client, "students", "id, admin_id")
+        admin_by_student = {row["id"]: row.get("admin_id") for row in student_rows if row.get("id")}
+        gallery = build_gallery(encoding_rows, admin_by_student)
+        source = "full fetch"
+
+    if gallery is not snapshot and _save_if_unowned(gallery, directory):
+        gallery = open_gallery(directory) or gallery
+    _gallery = gallery
+    apply_logged_changes(client, directory)
+    logger.info(
+        f"Loaded face gallery with {len(gallery)} encodings from {source} "
+        f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+    )
+    return _gallery
+
+
+def get_gallery():
+    return _gallery
+
+
+def set_gallery(gallery):
+    global _gallery
+    _gallery = gallery
+
+
+def _install_change(upserts=None, deletes=()):
+    global _gallery
+    with _write_lock:
+        current = _gallery
+        if current is None:
+            return
+        updated = current.with_changes(upserts, deletes)
+        if updated.pending_changes >= COMPACT_AFTER:
+            updated = updated.compacted()
+        _gallery = updated
+
+
+def upsert_encoding(student_id, admin_id, encoding):
+    """
+    Reflect a registration in this process's gallery, if one is loaded.
+    """
+    _install_change(upserts={student_id: (admin_id, encoding)})
+
+
+def upsert_encodings(upserts):
+    """
+    upsert_encoding for a batch: ``upserts`` maps student_id -> (admin_id, encoding).
+    """
+    _install_change(upserts=upserts)
+
+
+def remove_encoding(student_id):
+    _install_change(deletes=(student_id,))
+
+
+def refresh_installed_gallery(client=None, directory=None, scan_ids=True):
+    """
+    Apply Supabase changes since the watermark (e.g. registrations handled by
+    other workers) to the installed gallery. The fetch runs without the lock;
+    if a local write compacted the gallery meanwhile, this round is skipped.
+    """
+    global _gallery
+    base = _gallery
+    if base is None or not base.watermark:
+        return False
+    client = client or get_supabase_client()
+    directory = directory or GALLERY_DIR
+    if is_snapshot_owner(directory):
+        compact = base.compacted()
+        refreshed = refresh_gallery(client, compact, scan_ids)
+        if refreshed is not compact:
+            # Persist so the next boot starts from here, and map it back.
+            save_gallery(refreshed, directory)
+            refreshed = open_gallery(directory) or refreshed
+        if _changes_size(directory) > CHANGES_MAX_BYTES:
+            # Workers that hadn't read the tail yet get it from their next refresh.
+            open(os.path.join(directory, CHANGES_FILE), "wb").close()
+    else:
+        # Start from the owner's newest snapshot and keep what Supabase has
+        # beyond it as overlay changes; never a private copy of the matrix.
+        start = base
+        if _read_current(directory) != base.generation:
+            start = open_gallery(directory) or base
+        modified, removed, watermark = _fetch_changes(client, start, scan_ids)
+        if start is base and not modified and not removed:
+            return True
+        refreshed = start.with_changes(_as_upserts(client, modified), removed)
+        refreshed.watermark = watermark
+
+    with _write_lock:
+        current = _gallery
+        if current.matrix is not base.matrix:
+            return False
+        # Re-apply local writes that landed while we were fetching.
+        newer = {sid: entry for sid, entry in current._overlay.items() if base._overlay.get(sid) is not entry}
+        upserts = {sid: entry for sid, entry in newer.items() if entry is not None}
+        deletes = [sid for sid, entry in newer.items() if entry is None]
+        _gallery = refreshed.with_changes(upserts, deletes) if newer else refreshed
+    return True
+
+
+def run_refresher(interval=REFRESH_SECONDS, stop_event=None):
+    """
+    Keep the installed gallery in sync; meant for a daemon thread. The
+    first pass runs the id scan that load_gallery skips.
+    """
+    stop_event = stop_event or threading.Event()
+    last_scan = time.monotonic() - SCAN_SECONDS
+    while not stop_event.wait(interval):
+        scan_ids = time.monotonic() - last_scan >= SCAN_SECONDS
+        try:
+            refresh_installed_gallery(scan_ids=scan_ids)
+            if scan_ids:
+                last_scan = time.monotonic()
+        except Exception as e:
+            logger.warning(f"Face gallery refresh failed: {e}")
@@ -0,0 +1,275 @@
+"""
+Local SQLite mirror of ``students`` and ``face_encodings`` for kiosks.
+
+With LOCAL_STORE=1 the request path reads students and encodings from this
+mirror instead of Supabase, so latency no longer follows the remote tail.
+Face registrations and deletions that can't reach Supabase are kept here as
+dirty rows and pushed on the next reconciliation. Attendance goes through the
+write-behind buffer in attendance_service, which LOCAL_STORE also enables.
+
+LOCAL_STORE_ADMIN_ID scopes the mirror to the kiosk's admin: only that
+admin's students and encodings are copied down, and only their faces are
+registered or deleted offline. Without it the whole tables are mirrored.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from database_service import get_supabase_client
+from gallery_service import ENCODING_DIM, IN_FILTER_CHUNK, fetch_all_rows
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover - httpx comes with supabase
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+LOCAL_STORE_ENABLED = os.environ.get("LOCAL_STORE", "0").lower() in ("1", "true", "yes")
+LOCAL_STORE_PATH = os.environ.get(
+    "LOCAL_STORE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".local_store.db"),
+)
+SYNC_INTERVAL_SECONDS = int(os.environ.get("LOCAL_STORE_SYNC_SECONDS", 60))
+LOCAL_STORE_ADMIN_ID = os.environ.get("LOCAL_STORE_ADMIN_ID") or None
+
+# Failures that mean Supabase couldn't be reached, as opposed to a request it
+# answered with an error. Only these fall back to the local store.
+OFFLINE_ERRORS = (ConnectionError, TimeoutError) + ((httpx.TransportError,) if httpx is not None else ())
+
+
+class LocalStore:
+    def __init__(self, path=LOCAL_STORE_PATH, client_factory=get_supabase_client, admin_id=LOCAL_STORE_ADMIN_ID):
+        self.path = path
+        self.admin_id = admin_id
+        self._client_factory = client_factory
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sync = None
+        self.last_error = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS students (id TEXT PRIMARY KEY, admin_id TEXT, name TEXT, roll_number TEXT)"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS face_encodings (
+                student_id TEXT PRIMARY KEY,
+                encoding BLOB,
+                dirty INTEGER NOT NULL DEFAULT 0,
+                deleted INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+
+    # Reads
+
+    def get_student(self, student_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, admin_id, name, roll_number FROM students WHERE id = ?", (student_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"id": row[0], "admin_id": row[1], "name": row[2], "roll_number": row[3]}
+
+    def lookup_encoding(self, student_id):
+        """
+        (known, encoding): ``known`` is False when the mirror has no row for
+        the student; a local tombstone is (True, None).
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT encoding, deleted FROM face_encodings WHERE student_id = ?", (student_id,)
+            ).fetchone()
+        if row is None:
+            return False, None
+        if row[1] or row[0] is None:
+            return True, None
+        return True, np.frombuffer(row[0], dtype=np.float64)
+
+    def get_encoding(self, student_id):
+        return self.lookup_encoding(student_id)[1]
+
+    def covers(self, admin_id):
+        """
+        Whether offline writes for ``admin_id``'s students belong in this mirror.
+        """
+        return self.admin_id is None or admin_id == self.admin_id
+
+    # Writes
+
+    def put_encoding(self, student_id, encoding, dirty=False):
+        blob = np.ascontiguousarray(encoding, dtype=np.float64).tobytes()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO face_encodings (student_id, encoding, dirty, deleted) VALUES (?, ?, ?, 0)",
+                (student_id, blob, int(dirty)),
+            )
+
+    def delete_encoding(self, student_id, dirty=False):
+        with self._lock:
+            if dirty:
+                # Keep a tombstone until the delete reaches Supabase.
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO face_encodings (student_id, encoding, dirty, deleted) VALUES (?, NULL, 1, 1)",
+                    (student_id,),
+                )
+            else:
+                self._conn.execute("DELETE FROM face_encodings WHERE student_id = ?", (student_id,))
+
+    def dirty_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM face_encodings WHERE dirty = 1").fetchone()[0]
+
+    # Reconciliation
+
+    def _push_dirty(self, client):
+        with self._lock:
+            dirty = self._conn.execute(
+                "SELECT student_id, encoding, deleted FROM face_encodings WHERE dirty = 1"
+            ).fetchall()
+        pushed_blobs = [(sid, blob) for sid, blob, deleted in dirty if not deleted]
+        upserts = [
+            {"student_id": sid, "encoding": np.frombuffer(blob, dtype=np.float64).tolist(), "updated_at": "now()"}
+            for sid, blob in pushed_blobs
+        ]
+        deletes = [sid for sid, _, deleted in dirty if deleted]
+
+        if upserts:
+            client.table("face_encodings").upsert(upserts, on_conflict="student_id").execute()
+        for student_id in deletes:
+            client.table("face_encodings").delete().eq("student_id", student_id).execute()
+
+        with self._lock:
+            # Only clear rows that weren't re-registered while we were pushing.
+            self._conn.executemany(
+                "UPDATE face_encodings SET dirty = 0 WHERE student_id = ? AND encoding = ? AND deleted = 0",
+                pushed_blobs,
+            )
+            self._conn.executemany(
+                "DELETE FROM face_encodings WHERE student_id = ? AND deleted = 1", [(sid,) for sid in deletes]
+            )
+        return len(upserts) + len(deletes)
+
+    def _pull(self, client):
+        if self.admin_id is None:
+            students = fetch_all_rows(client, "students", "id, admin_id, name, roll_number")
+            encodings = fetch_all_rows(client, "face_encodings", "student_id, encoding")
+        else:
+            students = fetch_all_rows(
+                client, "students", "id, admin_id, name, roll_number", [("admin_id", self.admin_id)]
+            )
+            student_ids = [row["id"] for row in students if row.get("id")]
+            encodings = []
+            # Chunk the IN filter so the PostgREST query string stays short.
+            for start in range(0, len(student_ids), IN_FILTER_CHUNK):
+                chunk = student_ids[start:start + IN_FILTER_CHUNK]
+                encodings.extend(
+                    fetch_all_rows(client, "face_encodings", "student_id, encoding", [("student_id", "in_", chunk)])
+                )
+
+        encoding_rows = []
+        for row in encodings:
+            vector = np.asarray(row.get("encoding") or [], dtype=np.float64)
+            if row.get("student_id") and vector.shape == (ENCODING_DIM,):
+                encoding_rows.append((row["student_id"], vector.tobytes()))
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM students")
+                self._conn.executemany(
+                    "INSERT INTO students (id, admin_id, name, roll_number) VALUES (?, ?, ?, ?)",
+                    [
+                        (row["id"], row.get("admin_id"), row.get("name"), row.get("roll_number"))
+                        for row in students
+                        if row.get("id")
+                    ],
+                )
+                # Local changes not yet pushed win over the remote copy.
+                self._conn.execute("DELETE FROM face_encodings WHERE dirty = 0")
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO face_encodings (student_id, encoding, dirty, deleted) VALUES (?, ?, 0, 0)",
+                    encoding_rows,
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(students), len(encoding_rows)
+
+    def sync(self):
+        """
+        Push local changes, then refresh the mirror. Returns True on success.
+        """
+        try:
+            client = self._client_factory()
+            pushed = self._push_dirty(client)
+            students, encodings = self._pull(client)
+        except Exception as e:
+            self.last_error = str(e)
+            logger.warning(f"Local store sync failed, serving the last mirror: {e}")
+            return False
+        self.last_sync = time.time()
+        self.last_error = None
+        logger.info(f"Local store synced: pushed {pushed}, mirrored {students} students / {encodings} encodings")
+        return True
+
+    def status(self):
+        return {
+            "last_sync_age_seconds": round(time.time() - self.last_sync, 1) if self.last_sync else None,
+            "last_error": self.last_error,
+            "dirty_encodings": self.dirty_count(),
+        }
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.sync()
+            self._stop.wait(SYNC_INTERVAL_SECONDS)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="local-store-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._conn.close()
+
+
+_local_store = None
+_local_store_lock = threading.Lock()
+
+
+def get_local_store():
+    """
+    Returns the process's local store, or None when LOCAL_STORE is off.
+    """
+    global _local_store
+    if not LOCAL_STORE_ENABLED:
+        return None
+    if _local_store is None:
+        with _local_store_lock:
+            if _local_store is None:
+                _local_store = LocalStore().start()
+    return _local_store
+
+
+def close_local_store():
+    global _local_store
+    with _local_store_lock:
+        if _local_store is not None:
+            _local_store.close()
+            _local_store = None
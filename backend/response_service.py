@@ -0,0 +1,234 @@
+"""
+Response encoding: orjson-backed JSON and negotiated compression.
+
+CompressionMiddleware compresses text-like responses (JSON, NDJSON, CSV, ...)
+above COMPRESSION_MIN_BYTES with the best encoding the client accepts out of
+zstd, br and gzip. Streaming responses are compressed chunk by chunk and
+flushed after each one, so NDJSON progress reports still arrive as they are
+produced. Bodies or chunks of COMPRESSION_THREAD_MIN_BYTES and up are
+compressed in a worker thread, so a large export doesn't stall the event
+loop for everyone else. brotli and zstandard are optional; without them only
+gzip is offered.
+"""
+import os
+import zlib
+
+import anyio
+from fastapi.responses import JSONResponse, StreamingResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", 1024))
+COMPRESSION_THREAD_MIN_BYTES = int(os.environ.get("COMPRESSION_THREAD_MIN_BYTES", 64 * 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSONResponse rendered with orjson when it is installed.
+    """
+
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that calls ``release()`` once it is done, whether the
+    body went out in full, the client went away or the stream raised. A
+    generator's finally isn't enough: it never runs if iteration never starts.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+
+class _Gzip:
+    def __init__(self):
+        self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class _Brotli:
+    def __init__(self):
+        self._obj = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._obj.process(data) + self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+class _Zstd:
+    def __init__(self):
+        self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data) + self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+def available_encodings():
+    """
+    Encodings this process can produce, in order of preference.
+    """
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+_COMPRESSORS = {"gzip": _Gzip, "br": _Brotli, "zstd": _Zstd}
+
+
+def choose_encoding(accept_encoding: str, available=None):
+    """
+    Pick an encoding from an Accept-Encoding header, honouring q-values and
+    breaking ties by our preference. Returns None for identity.
+    """
+    available = available or available_encodings()
+    weights = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_BYTES, thread_size=COMPRESSION_THREAD_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.thread_size = thread_size
+
+    async def _compress(self, fn, data):
+        # Calls for one response are awaited in turn, so its compressor is
+        # never used from two threads at once.
+        if len(data) >= self.thread_size:
+            return await anyio.to_thread.run_sync(fn, data)
+        return fn(data)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept = ""
+        for name, value in scope.get("headers", []):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "compressor": None, "passthrough": False}
+
+        async def send_compressed(message):
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if state["compressor"] is None:
+                start = state["start"]
+                headers = list(start.get("headers", []))
+                header_map = {k.lower(): v for k, v in headers}
+                content_type = header_map.get(b"content-type", b"").decode("latin-1").lower()
+                if (
+                    b"content-encoding" in header_map
+                    or start.get("status") in (204, 304)
+                    or not content_type.startswith(COMPRESSIBLE_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)
+                ):
+                    state["passthrough"] = True
+                    await send(start)
+                    await send(message)
+                    return
+
+                compressor = _COMPRESSORS[encoding]()
+                state["compressor"] = compressor
+                headers = [(k, v) for k, v in headers if k.lower() not in (b"content-length", b"vary")]
+                vary = header_map.get(b"vary")
+                headers.append((b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"))
+                headers.append((b"content-encoding", encoding.encode("latin-1")))
+
+                if not more_body:
+                    # Whole body in one message: send it with a length.
+                    payload = await self._compress(lambda data: compressor.compress(data) + compressor.finish(), body)
+                    headers.append((b"content-length", str(len(payload)).encode("latin-1")))
+                    await send({**start, "headers": headers})
+                    await send({"type": "http.response.body", "body": payload})
+                    return
+                await send({**start, "headers": headers})
+
+            compressor = state["compressor"]
+            payload = await self._compress(compressor.compress, body) if body else b""
+            if not more_body:
+                payload += compressor.finish()
+            await send({"type": "http.response.body", "body": payload, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
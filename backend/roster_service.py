@@ -0,0 +1,420 @@
+"""
+Per-day roster bitsets for absentee reporting.
+
+``attendance`` only stores who was present, so "who was absent" means
+crossing an admin's students with their lecture days. The materialiser does
+that once per day and keeps one packed bitset per (admin, day) in a local
+SQLite file: bit i is set when student i of that day's roster was present.
+Absentee lists, monthly registers and the "absent" rows of exports then only
+unpack a few hundred bytes per day.
+
+Sessions are the lecture days on the admin's timetable
+(attendance_service.is_lecture_day) plus any other day on which someone was marked. A day's roster is the students created
+on or before it (students.created_at), so a backfill doesn't count students
+absent before they existed. A day is kept once it was built at least
+ROSTER_SETTLE_SECONDS after it ended; until then (today, and any day last
+built while it was still today) it is rebuilt on read, where "ended" is
+midnight in the admin's timetable timezone. Today is rebuilt at most once
+per ROSTER_TODAY_TTL_SECONDS per process, and straight away after a mark
+bumps the admin's data version (cache_service). With
+ROSTER_MATERIALIZE=1 a background job also rebuilds yesterday and today for
+every admin each ROSTER_REFRESH_SECONDS, which picks up marks that reached
+Supabase late (write-behind buffers, offline kiosks).
+
+Command line (backfill, or a nightly cron instead of the background job):
+    python roster_service.py <admin_id | all> <date_from> <date_to>
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+from attendance_service import is_lecture_day
+from cache_service import get_data_version
+from database_service import get_supabase_client
+from gallery_service import fetch_all_rows
+from schedule_service import get_schedule
+
+logger = logging.getLogger(__name__)
+
+ROSTER_PATH = os.environ.get(
+    "ROSTER_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".roster.db"),
+)
+ROSTER_MATERIALIZE = os.environ.get("ROSTER_MATERIALIZE", "0").lower() in ("1", "true", "yes")
+ROSTER_REFRESH_SECONDS = int(os.environ.get("ROSTER_REFRESH_SECONDS", 3600))
+ROSTER_SETTLE_SECONDS = int(os.environ.get("ROSTER_SETTLE_SECONDS", 3600))
+ROSTER_TODAY_TTL_SECONDS = float(os.environ.get("ROSTER_TODAY_TTL_SECONDS", 30))
+
+
+def _pack(present):
+    return np.packbits(present, bitorder="little").tobytes()
+
+
+def _unpack(bits, count):
+    return np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=count, bitorder="little").astype(bool)
+
+
+def _settles_at(day, tz=None):
+    """
+    Timestamp after which a build of ``day`` (an iso date) is final; the day
+    ends at midnight in ``tz`` (a ZoneInfo, or None for server local time).
+    """
+    end = datetime.combine(date.fromisoformat(day) + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return end.timestamp() + ROSTER_SETTLE_SECONDS
+
+
+# admin_id -> (iso day, data version, built_at) of this process's last build of today.
+_today_builds = {}
+_today_builds_lock = threading.Lock()
+
+
+def _today_is_fresh(admin_id, today):
+    with _today_builds_lock:
+        build = _today_builds.get(admin_id)
+    if build is None:
+        return False
+    day, version, built_at = build
+    return (
+        day == today.isoformat()
+        and version == get_data_version(admin_id)
+        and time.time() - built_at < ROSTER_TODAY_TTL_SECONDS
+    )
+
+
+def reset_today_builds():
+    with _today_builds_lock:
+        _today_builds.clear()
+
+
+def _day_range(date_from, date_to):
+    day = date_from
+    while day <= date_to:
+        yield day
+        day += timedelta(days=1)
+
+
+class RosterStore:
+    def __init__(self, path=ROSTER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Each distinct student list is stored once: [[id, name, roll_number], ...] sorted by id.
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rosters (list_id TEXT PRIMARY KEY, students TEXT NOT NULL)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS roster_days (
+                admin_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                list_id TEXT NOT NULL,
+                bits BLOB NOT NULL,
+                present INTEGER NOT NULL,
+                built_at REAL NOT NULL,
+                PRIMARY KEY (admin_id, day)
+            )
+            """
+        )
+        # Every day a build has looked at, sessions or not, so days without
+        # a session aren't mistaken for days not built yet.
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS roster_covered (admin_id TEXT NOT NULL, day TEXT NOT NULL, "
+            "built_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (admin_id, day))"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(roster_covered)")}
+        if "built_at" not in columns:
+            # Files from before built_at: every day gets rebuilt once.
+            self._conn.execute("ALTER TABLE roster_covered ADD COLUMN built_at REAL NOT NULL DEFAULT 0")
+
+    def put_days(self, admin_id, days, covered=()):
+        """
+        ``days`` is [(iso_day, students, bits, present_count)], where
+        ``students`` is the sorted [[id, name, roll_number], ...] list that
+        day's bitset indexes into; ``covered`` is every iso day the build
+        spanned.
+        """
+        lists, rows = {}, []
+        for day, students, bits, present in days:
+            payload = json.dumps(students, separators=(",", ":"))
+            list_id = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+            lists[list_id] = payload
+            rows.append((day, list_id, bits, present))
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO rosters (list_id, students) VALUES (?, ?)", list(lists.items())
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO roster_days (admin_id, day, list_id, bits, present, built_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(admin_id, day, list_id, bits, present, now) for day, list_id, bits, present in rows],
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO roster_covered (admin_id, day, built_at) VALUES (?, ?, ?)",
+                    [(admin_id, day, now) for day in covered],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(lists)
+
+    def get_days(self, admin_id, date_from, date_to):
+        """
+        {iso_day: (list_id, bits, present_count)} for built days in range.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, list_id, bits, present FROM roster_days WHERE admin_id = ? AND day BETWEEN ? AND ?",
+                (admin_id, date_from.isoformat(), date_to.isoformat()),
+            ).fetchall()
+        return {day: (list_id, bytes(bits), present) for day, list_id, bits, present in rows}
+
+    def get_covered(self, admin_id, date_from, date_to, tz=None):
+        """
+        Days in range whose last build is final (see _settles_at).
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, built_at FROM roster_covered WHERE admin_id = ? AND day BETWEEN ? AND ?",
+                (admin_id, date_from.isoformat(), date_to.isoformat()),
+            ).fetchall()
+        return {day for day, built_at in rows if built_at >= _settles_at(day, tz)}
+
+    def get_students(self, list_ids):
+        if not list_ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT list_id, students FROM rosters WHERE list_id IN ({','.join('?' * len(list_ids))})",
+                list(list_ids),
+            ).fetchall()
+        return {list_id: json.loads(students) for list_id, students in rows}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def materialize_roster(client, admin_id, date_from, date_to, store=None):
+    """
+    Build the bitsets for every session day in [date_from, date_to] from the
+    admin's students that existed by then. Returns the number of days written.
+    """
+    store = store or get_roster_store()
+    student_rows = fetch_all_rows(
+        client, "students", "id, name, roll_number, created_at", [("admin_id", admin_id)]
+    )
+    student_rows = sorted((row for row in student_rows if row.get("id")), key=lambda row: row["id"])
+    students = [[row["id"], row.get("name"), row.get("roll_number")] for row in student_rows]
+    # First day on the roll; students without created_at count from the start.
+    joined = np.array([(row.get("created_at") or "")[:10] for row in student_rows], dtype="U10")
+    rows = fetch_all_rows(
+        client,
+        "attendance",
+        "student_id, date",
+        [("admin_id", admin_id), ("date", "gte", date_from.isoformat()), ("date", "lte", date_to.isoformat())],
+    )
+
+    covered = [day.isoformat() for day in _day_range(date_from, date_to)]
+    sessions = {day.isoformat() for day in _day_range(date_from, date_to) if is_lecture_day(day, admin_id)}
+    sessions.update(row["date"] for row in rows if row.get("date"))
+    sessions = sorted(sessions)
+    if not sessions:
+        store.put_days(admin_id, [], covered)
+        return 0
+
+    day_index = {day: i for i, day in enumerate(sessions)}
+    student_index = {row[0]: i for i, row in enumerate(students)}
+    present = np.zeros((len(sessions), len(students)), dtype=bool)
+    marks = [
+        (day_index[row["date"]], student_index[row["student_id"]])
+        for row in rows
+        if row.get("student_id") in student_index
+    ]
+    if marks:
+        marked = np.array(marks, dtype=np.int64)
+        present[marked[:, 0], marked[:, 1]] = True
+
+    days = []
+    for i, day in enumerate(sessions):
+        # Anyone marked present was on the roll, whatever created_at says.
+        on_roll = (joined <= day) | present[i]
+        members = np.flatnonzero(on_roll)
+        days.append((day, [students[j] for j in members], _pack(present[i][on_roll]), int(present[i].sum())))
+    store.put_days(admin_id, days, covered)
+    return len(sessions)
+
+
+class Roster:
+    """
+    Students x session days for one admin. ``enrolled`` is False where a
+    student wasn't on that day's roster (e.g. added later), so they count as
+    neither present nor absent.
+    """
+
+    def __init__(self, students, days, present, enrolled):
+        self.students = students
+        self.days = days
+        self.present = present
+        self.enrolled = enrolled
+
+    @property
+    def absent(self):
+        return self.enrolled & ~self.present
+
+    def _student(self, i):
+        sid, name, roll = self.students[i]
+        return {"student_id": sid, "name": name or "N/A", "roll_number": roll or "N/A"}
+
+    def absentees(self, day):
+        if day not in self.days:
+            return []
+        column = self.days.index(day)
+        return [self._student(i) for i in np.flatnonzero(self.absent[:, column]).tolist()]
+
+    def register(self):
+        """
+        One row per student with a P/A/- mark per session day.
+        """
+        symbols = np.where(self.present, "P", np.where(self.enrolled, "A", "-"))
+        present_counts, absent_counts = self.present.sum(axis=1), self.absent.sum(axis=1)
+        register = []
+        for i in range(len(self.students)):
+            entry = self._student(i)
+            entry.update(
+                marks="".join(symbols[i].tolist()),
+                present=int(present_counts[i]),
+                absent=int(absent_counts[i]),
+            )
+            register.append(entry)
+        return register
+
+    def absent_records(self):
+        """
+        Absences shaped like the attendance records the exports take.
+        """
+        rows, columns = np.nonzero(self.absent)
+        return [
+            {
+                "student_id": self.students[i][0],
+                "date": self.days[j],
+                "status": "absent",
+                "confidence": 0,
+                "verified": False,
+                "students": {"name": self.students[i][1] or "N/A", "roll_number": self.students[i][2] or "N/A"},
+            }
+            for i, j in zip(rows.tolist(), columns.tolist())
+        ]
+
+
+def load_roster(client, admin_id, date_from, date_to, store=None, today=None):
+    """
+    Roster for [date_from, date_to] (clamped to today), materialising days
+    that haven't been built, or were last built before they settled.
+    """
+    store = store or get_roster_store()
+    timetable = get_schedule().timetable(admin_id)
+    today = today or timetable.today()
+    date_to = min(date_to, today)
+    if date_from > date_to:
+        return Roster([], [], np.zeros((0, 0), dtype=bool), np.zeros((0, 0), dtype=bool))
+
+    covered = store.get_covered(admin_id, date_from, date_to, timetable.tz)
+    # Today is never settled, but a recent build with no marks since will do.
+    missing = [day for day in _day_range(date_from, date_to) if day.isoformat() not in covered]
+    if missing and missing[-1] == today and _today_is_fresh(admin_id, today):
+        missing.pop()
+    if missing:
+        # Read before the fetch, so a mark landing mid-build bumps past it.
+        version, built_at = get_data_version(admin_id), time.time()
+        materialize_roster(client, admin_id, min(missing), max(missing), store)
+        if missing[-1] == today:
+            with _today_builds_lock:
+                _today_builds[admin_id] = (today.isoformat(), version, built_at)
+    built = store.get_days(admin_id, date_from, date_to)
+
+    days = sorted(built)
+    lists = store.get_students({list_id for list_id, _, _ in built.values()})
+    # Union of every day's roster; the latest day's names win.
+    students = {}
+    for day in days:
+        for row in lists[built[day][0]]:
+            students[row[0]] = row
+    ordered = sorted(students.values(), key=lambda row: row[0])
+    index = {row[0]: i for i, row in enumerate(ordered)}
+
+    present = np.zeros((len(ordered), len(days)), dtype=bool)
+    enrolled = np.zeros((len(ordered), len(days)), dtype=bool)
+    for j, day in enumerate(days):
+        list_id, bits, _ = built[day]
+        rows = np.fromiter((index[row[0]] for row in lists[list_id]), dtype=np.int64)
+        enrolled[rows, j] = True
+        present[rows, j] = _unpack(bits, len(rows))
+    return Roster(ordered, days, present, enrolled)
+
+
+def materialize_recent(client=None, store=None, today=None):
+    """
+    Rebuild yesterday and today for every admin. Returns days written.
+    """
+    client = client or get_supabase_client()
+    written = 0
+    for admin in fetch_all_rows(client, "admins", "id"):
+        day = today or get_schedule().timetable(admin["id"]).today()
+        written += materialize_roster(client, admin["id"], day - timedelta(days=1), day, store)
+    return written
+
+
+def run_materializer(interval=ROSTER_REFRESH_SECONDS, stop_event=None):
+    """
+    Background job; meant for a daemon thread.
+    """
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval):
+        try:
+            written = materialize_recent()
+            logger.info(f"Roster materialised {written} admin-days")
+        except Exception as e:
+            logger.warning(f"Roster materialisation failed: {e}")
+
+
+_roster_store = None
+_roster_store_lock = threading.Lock()
+
+
+def get_roster_store():
+    global _roster_store
+    if _roster_store is None:
+        with _roster_store_lock:
+            if _roster_store is None:
+                _roster_store = RosterStore()
+    return _roster_store
+
+
+def main(argv):
+    if len(argv) != 4:
+        print(__doc__)
+        return 2
+
+    logging.basicConfig(level=logging.INFO)
+    client = get_supabase_client()
+    date_from, date_to = date.fromisoformat(argv[2]), date.fromisoformat(argv[3])
+    admins = [row["id"] for row in fetch_all_rows(client, "admins", "id")] if argv[1] == "all" else [argv[1]]
+    for admin_id in admins:
+        written = materialize_roster(client, admin_id, date_from, date_to)
+        print(json.dumps({"admin_id": admin_id, "days": written}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,271 @@
+"""
+Lecture timetables: which subject, if any, is in session for an admin.
+
+Timetables are read from a JSON file (SCHEDULE_PATH) shaped like:
+
+    {
+      "timezone": "Asia/Kolkata",
+      "holidays": ["2026-12-25"],
+      "default": {"subjects": {...}},
+      "admins": {
+        "<admin-id>": {
+          "timezone": "Europe/London",
+          "holidays": ["2026-11-05"],
+          "subjects": {
+            "Maths": [{"days": "mon,wed", "start": "09:00", "end": "10:00"}],
+            "Lab": [{"days": "fri", "start": "22:00", "end": "01:00"}]
+          }
+        }
+      }
+    }
+
+Each admin's sessions are folded into one weekly interval index: the week
+is split at every session start and end into segments that each list the
+sessions covering them, so a lookup is a bisect over the segment bounds.
+Sessions may cross midnight (end before start) and count towards the day
+they started on. Admins without a timetable use "default", and without that
+the old ATTENDANCE_START_HOUR/END_HOUR window in server-local time, without
+a subject.
+
+A timetable's lecture days (the days absentee reports count) are the
+weekdays it has sessions on, or its "lecture_days" when given; the hour
+window uses ATTENDANCE_LECTURE_DAYS. ATTENDANCE_HOLIDAYS adds to every
+timetable's holidays.
+
+The file is re-read when its mtime changes, checked at most every
+SCHEDULE_RELOAD_SECONDS; a file that fails to parse leaves the previous
+timetables in place.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_PATH = os.environ.get(
+    "SCHEDULE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "schedule.json"),
+)
+SCHEDULE_RELOAD_SECONDS = float(os.environ.get("SCHEDULE_RELOAD_SECONDS", 5))
+
+_DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+DAY_MINUTES = 24 * 60
+WEEK_MINUTES = 7 * DAY_MINUTES
+
+
+def _minutes(value):
+    hours, _, minutes = str(value).partition(":")
+    total = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= total <= DAY_MINUTES:
+        raise ValueError(f"invalid time {value!r}")
+    return total
+
+
+def _days(value):
+    names = value.split(",") if isinstance(value, str) else list(value)
+    days = []
+    for name in names:
+        name = name.strip()[:3].lower()
+        if name not in _DAYS:
+            raise ValueError(f"invalid day {name!r}")
+        days.append(_DAYS.index(name))
+    return days
+
+
+class Timetable:
+    """
+    One admin's week. ``sessions`` is [(subject, weekday, start_minute,
+    end_minute)] in local time, where an end at or before the start means
+    the next day; ``tz`` is a ZoneInfo or None for server local time.
+    """
+
+    def __init__(self, sessions, tz=None, holidays=(), lecture_days=None):
+        self.tz = tz
+        self.holidays = frozenset(holidays)
+        self.sessions = len(sessions)
+        if lecture_days is None:
+            lecture_days = {session[1] for session in sessions}
+        self.lecture_days = frozenset(lecture_days)
+
+        # (begin, end, subject, week_start) pieces on [0, WEEK_MINUTES).
+        pieces = []
+        for subject, weekday, start, end in sessions:
+            begin = weekday * DAY_MINUTES + start
+            finish = begin + (end - start if end > start else end + DAY_MINUTES - start)
+            if finish <= WEEK_MINUTES:
+                pieces.append((begin, finish, subject, begin))
+            else:
+                # Sunday night into Monday morning.
+                pieces.append((begin, WEEK_MINUTES, subject, begin))
+                pieces.append((0, finish - WEEK_MINUTES, subject, begin))
+
+        bounds = sorted({0, WEEK_MINUTES} | {p[0] for p in pieces} | {p[1] for p in pieces})
+        starting, ending = {}, {}
+        for piece in pieces:
+            starting.setdefault(piece[0], []).append(piece)
+            ending.setdefault(piece[1], []).append(piece)
+        self._bounds = bounds[:-1]
+        self._segments = []
+        active = []
+        for bound in self._bounds:
+            active = [p for p in active if p not in ending.get(bound, ())] + starting.get(bound, [])
+            # Latest start first, so an ambiguous lookup picks the session that began most recently.
+            self._segments.append(tuple(sorted(((p[3], p[2]) for p in active), reverse=True)))
+
+    def active(self, now):
+        """
+        [(subject, session_date)] in session at ``now`` (an aware datetime,
+        or naive server-local), most recently started first.
+        """
+        if self.tz is not None:
+            local = now.astimezone(self.tz)
+        elif now.tzinfo is not None:
+            local = now.astimezone().replace(tzinfo=None)
+        else:
+            local = now
+        minute = local.weekday() * DAY_MINUTES + local.hour * 60 + local.minute
+        segment = self._segments[bisect_right(self._bounds, minute) - 1]
+        sessions = []
+        for week_start, subject in segment:
+            started = local - timedelta(minutes=(minute - week_start) % WEEK_MINUTES)
+            if started.date().isoformat() not in self.holidays:
+                sessions.append((subject, started.date()))
+        return sessions
+
+    def today(self):
+        """
+        The current date in the timetable's timezone.
+        """
+        return datetime.now(self.tz).date() if self.tz is not None else date.today()
+
+    def is_lecture_day(self, day):
+        return day.weekday() in self.lecture_days and day.isoformat() not in self.holidays
+
+
+def _env_holidays():
+    return {item.strip() for item in os.environ.get("ATTENDANCE_HOLIDAYS", "").split(",") if item.strip()}
+
+
+def _legacy_timetable(holidays):
+    start_hour = int(os.environ.get("ATTENDANCE_START_HOUR", "0"))
+    end_hour = int(os.environ.get("ATTENDANCE_END_HOUR", "23"))
+    # e.g. ATTENDANCE_LECTURE_DAYS="mon,tue,wed,thu,fri,sat"
+    configured = os.environ.get("ATTENDANCE_LECTURE_DAYS", "mon,tue,wed,thu,fri")
+    names = [name.strip()[:3].lower() for name in configured.split(",")]
+    lecture_days = {_DAYS.index(name) for name in names if name in _DAYS}
+    start, end = start_hour * 60, min(end_hour + 1, 24) * 60
+    if end <= start:
+        return Timetable([], None, holidays, lecture_days)
+    return Timetable([(None, weekday, start, end) for weekday in range(7)], None, holidays, lecture_days)
+
+
+def _parse_timetable(spec, tz_name, holidays):
+    tz_name = spec.get("timezone", tz_name)
+    sessions = []
+    for subject, entries in (spec.get("subjects") or {}).items():
+        for entry in entries:
+            start, end = _minutes(entry["start"]), _minutes(entry["end"])
+            for weekday in _days(entry.get("days", _DAYS)):
+                sessions.append((subject, weekday, start, end))
+    holidays = set(holidays) | set(spec.get("holidays", ()))
+    lecture_days = _days(spec["lecture_days"]) if "lecture_days" in spec else None
+    return Timetable(sessions, ZoneInfo(tz_name) if tz_name else None, holidays, lecture_days)
+
+
+class Schedule:
+    def __init__(self, config=None):
+        config = config or {}
+        tz_name = config.get("timezone") or os.environ.get("SCHEDULE_TIMEZONE") or None
+        holidays = set(config.get("holidays", ())) | _env_holidays()
+        self.timetables = {
+            admin_id: _parse_timetable(spec, tz_name, holidays)
+            for admin_id, spec in (config.get("admins") or {}).items()
+        }
+        default = config.get("default")
+        self.default = _parse_timetable(default, tz_name, holidays) if default else _legacy_timetable(holidays)
+
+    def timetable(self, admin_id):
+        return self.timetables.get(admin_id, self.default)
+
+    def resolve(self, admin_id, subject=None, now=None):
+        """
+        (allowed, subject, session_date) for a mark at ``now``. Without a
+        ``subject`` the session in progress supplies it; with one, it has to
+        be among the sessions in progress.
+        """
+        timetable = self.timetable(admin_id)
+        now = now or (datetime.now(timetable.tz) if timetable.tz is not None else datetime.now())
+        active = timetable.active(now)
+        if subject:
+            active = [session for session in active if session[0] in (subject, None)]
+            if not active:
+                return False, subject, None
+            return True, subject, active[0][1]
+        if not active:
+            return False, None, None
+        return True, active[0][0], active[0][1]
+
+    def describe(self):
+        return {
+            "admins": len(self.timetables),
+            "sessions": sum(t.sessions for t in self.timetables.values()) + self.default.sessions,
+        }
+
+
+def load_schedule(path=SCHEDULE_PATH):
+    if not os.path.exists(path):
+        return Schedule()
+    with open(path, "r", encoding="utf-8") as f:
+        return Schedule(json.load(f))
+
+
+_schedule = None
+_schedule_key = None
+_schedule_checked = 0.0
+_schedule_lock = threading.Lock()
+
+
+def _file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def get_schedule(path=None):
+    """
+    The current timetables, reloaded when the file changed.
+    """
+    global _schedule, _schedule_key, _schedule_checked
+    now = time.monotonic()
+    if _schedule is not None and now - _schedule_checked < SCHEDULE_RELOAD_SECONDS:
+        return _schedule
+    path = path or SCHEDULE_PATH
+    with _schedule_lock:
+        if _schedule is not None and now - _schedule_checked < SCHEDULE_RELOAD_SECONDS:
+            return _schedule
+        key = (path, _file_key(path))
+        if _schedule is None or key != _schedule_key:
+            try:
+                schedule = load_schedule(path)
+                logger.info(f"Loaded lecture schedule: {schedule.describe()}")
+                _schedule = schedule
+            except Exception as e:
+                logger.warning(f"Could not load lecture schedule from {path}: {e}")
+                if _schedule is None:
+                    _schedule = Schedule()
+            _schedule_key = key
+        _schedule_checked = now
+        return _schedule
+
+
+def reset_schedule():
+    global _schedule, _schedule_key, _schedule_checked
+    with _schedule_lock:
+        _schedule, _schedule_key, _schedule_checked = None, None, 0.0
@@ -1,18 +1,71 @@
 """
 Production Uvicorn startup script for AttendX Backend
+
+Set PREFORK=1 to run under Gunicorn with the app, the face models and the
+encoding gallery loaded once in the parent process. Workers are forked from
+it and share those pages copy-on-write, so per-node memory no longer grows
+with the worker count.
 """
-import uvicorn
+import gc
+import logging
 import os
 
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+
+def _prefork_enabled():
+    return os.environ.get("PREFORK", "0").lower() in ("1", "true", "yes")
+
+
+def run_prefork(port, workers):
+    from gunicorn.app.base import BaseApplication
+
+    import face_service
+    import gallery_service
+
+    logging.basicConfig(level=logging.INFO)
+    # Load everything read-mostly before the fork.
+    face_service.warm_up()
+    try:
+        gallery_service.load_gallery()
+    except Exception as exc:
+        logger.error("Face gallery preload failed, workers will start without it: %s", exc)
+
+    from app import app
+
+    # Move everything allocated so far out of the GC's tracked generations so
+    # collections in the workers don't write to (and un-share) those pages.
+    gc.freeze()
+
+    class PreforkApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"0.0.0.0:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("accesslog", "-")
+            self.cfg.set("loglevel", "info")
+
+        def load(self):
+            return app
+
+    PreforkApplication().run()
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     workers = int(os.environ.get("WORKERS", 4))
-    
-    uvicorn.run(
-        "app:app",
-        host="0.0.0.0",
-        port=port,
-        workers=workers,
-        log_level="info",
-        access_log=True
-    )
+
+    if _prefork_enabled():
+        run_prefork(port, workers)
+    else:
+        uvicorn.run(
+            "app:app",
+            host="0.0.0.0",
+            port=port,
+            workers=workers,
+            log_level="info",
+            access_log=True
+        )
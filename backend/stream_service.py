@@ -0,0 +1,326 @@
+"""
+Continuous attendance capture from hall-camera video.
+
+Frames come from a short clip (anything OpenCV's VideoCapture can open, e.g.
+MJPEG or H.264) or from a chunked MJPEG byte stream. Frames that barely
+differ from the last processed one are skipped, faces are tracked across
+frames by box overlap, and each track is encoded only until it has been
+identified, so encoder cost follows the number of new faces rather than the
+number of frames.
+"""
+import logging
+import os
+import time
+
+import numpy as np
+
+from attendance_service import mark_student_attendance
+from database_service import get_supabase_client
+from face_service import (
+    MAX_IMAGE_BYTES,
+    decode_image_bytes,
+    get_cv2,
+    get_face_recognition,
+    image_too_large,
+    match_encodings,
+    match_rule,
+)
+from detector_service import get_admin_detector
+from gallery_service import fetch_admin_gallery
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+STREAM_DETECT_SIDE = _env_int("STREAM_DETECT_SIDE", 960)
+STREAM_MAX_FRAMES = _env_int("STREAM_MAX_FRAMES", 1800)
+# Uploaded clips are spooled to disk up to this size, and refused when their
+# container says they run longer than STREAM_MAX_CLIP_SECONDS.
+STREAM_MAX_CLIP_BYTES = _env_int("STREAM_MAX_CLIP_BYTES", 256 * 1024 * 1024)
+STREAM_MAX_CLIP_SECONDS = _env_float("STREAM_MAX_CLIP_SECONDS", 600)
+# Each frame is its own face-pool job, so a long clip never holds a worker.
+FRAME_TIMEOUT_SECONDS = _env_float("STREAM_FRAME_TIMEOUT_SECONDS", 10)
+# Mean absolute difference (0-255) on a 160px thumbnail below which a frame
+# is treated as unchanged and skipped.
+MOTION_THRESHOLD = _env_float("STREAM_MOTION_THRESHOLD", 3.0)
+# Process at least one frame in this many even without motion, so people who
+# sit still are still picked up.
+KEYFRAME_INTERVAL = 30
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_TTL_FRAMES = 45
+MAX_ENCODE_ATTEMPTS = 3
+MOTION_THUMB_WIDTH = 160
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class ClipTooLarge(ValueError):
+    pass
+
+
+_JPEG_SOI = b"\xff\xd8"
+_JPEG_EOI = b"\xff\xd9"
+
+
+def _iou(a, b):
+    # Boxes are face_recognition (top, right, bottom, left) tuples.
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    if not inter:
+        return 0.0
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return inter / float(area_a + area_b - inter)
+
+
+class _Track:
+    __slots__ = ("box", "last_seen", "student_id", "attempts")
+
+    def __init__(self, box, frame_index):
+        self.box = box
+        self.last_seen = frame_index
+        self.student_id = None
+        self.attempts = 0
+
+    @property
+    def needs_encoding(self):
+        return self.student_id is None and self.attempts < MAX_ENCODE_ATTEMPTS
+
+
+class StreamAttendanceSession:
+    """
+    Feeds frames from one camera through sampling, tracking, matching and
+    mark_student_attendance for one admin.
+    """
+
+    def __init__(self, admin_id, subject=None, gallery=None):
+        self.admin_id = admin_id
+        self.subject = subject
+        self.gallery = gallery if gallery is not None else fetch_admin_gallery(get_supabase_client(), admin_id)
+        self.detector = get_admin_detector(admin_id)
+        self.max_distance, self.min_confidence = match_rule(admin_id)
+        self.tracks = []
+        self.results = {}
+        self.stats = {
+            "frames_received": 0,
+            "frames_processed": 0,
+            "faces_detected": 0,
+            "faces_encoded": 0,
+            "students_marked": 0,
+        }
+        self._frame_index = -1
+        self._last_thumb = None
+        self._last_processed = -KEYFRAME_INTERVAL
+
+    def _should_process(self, frame_bgr):
+        cv2 = get_cv2()
+        height, width = frame_bgr.shape[:2]
+        thumb_height = max(1, int(height * MOTION_THUMB_WIDTH / width))
+        thumb = cv2.cvtColor(
+            cv2.resize(frame_bgr, (MOTION_THUMB_WIDTH, thumb_height), interpolation=cv2.INTER_AREA),
+            cv2.COLOR_BGR2GRAY,
+        )
+        changed = self._last_thumb is None or cv2.absdiff(thumb, self._last_thumb).mean() >= MOTION_THRESHOLD
+        keyframe = self._frame_index - self._last_processed >= KEYFRAME_INTERVAL
+        if changed or keyframe:
+            self._last_thumb = thumb
+            self._last_processed = self._frame_index
+            return True
+        return False
+
+    def _detection_image(self, frame_bgr):
+        cv2 = get_cv2()
+        height, width = frame_bgr.shape[:2]
+        scale = min(1.0, STREAM_DETECT_SIDE / float(max(height, width)))
+        if scale < 1.0:
+            frame_bgr = cv2.resize(frame_bgr, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame_bgr, cv2.COLOR_BGR2RGB)
+
+    def _assign_tracks(self, locations):
+        self.tracks = [t for t in self.tracks if self._frame_index - t.last_seen <= TRACK_TTL_FRAMES]
+        assigned = []
+        for box in locations:
+            best, best_iou = None, TRACK_IOU_THRESHOLD
+            for track in self.tracks:
+                if track.last_seen == self._frame_index:
+                    continue
+                overlap = _iou(box, track.box)
+                if overlap >= best_iou:
+                    best, best_iou = track, overlap
+            if best is None:
+                best = _Track(box, self._frame_index)
+                self.tracks.append(best)
+            best.box = box
+            best.last_seen = self._frame_index
+            assigned.append(best)
+        return assigned
+
+    def process_frame(self, frame_bgr):
+        """
+        Returns the list of student ids newly marked from this frame.
+        """
+        self._frame_index += 1
+        self.stats["frames_received"] += 1
+        if frame_bgr is None or not self._should_process(frame_bgr):
+            return []
+        self.stats["frames_processed"] += 1
+
+        face_recognition = get_face_recognition()
+        image_rgb = self._detection_image(frame_bgr)
+        locations = self.detector.detect(image_rgb)
+        self.stats["faces_detected"] += len(locations)
+        if not locations:
+            return []
+
+        pending = [t for t in self._assign_tracks(locations) if t.needs_encoding]
+        if not pending or len(self.gallery) == 0:
+            return []
+
+        encodings = face_recognition.face_encodings(image_rgb, [t.box for t in pending])
+        self.stats["faces_encoded"] += len(encodings)
+        rows, distances = match_encodings(encodings, self.gallery.matrix)
+
+        marked = []
+        for track, row, dist in zip(pending, rows, distances):
+            track.attempts += 1
+            confidence = (1.0 - dist) * 100
+            if row < 0 or dist > self.max_distance or confidence < self.min_confidence:
+                continue
+            student_id = self.gallery.student_ids[row]
+            track.student_id = student_id
+            if student_id in self.results:
+                continue
+            ok, code, _ = mark_student_attendance(student_id, round(float(confidence), 2), self.subject)
+            self.results[student_id] = {
+                "student_id": student_id,
+                "marked": ok,
+                "result_code": code,
+                "confidence": round(float(confidence), 2),
+            }
+            if ok:
+                self.stats["students_marked"] += 1
+                marked.append(student_id)
+        return marked
+
+    def summary(self):
+        return {**self.stats, "students": list(self.results.values())}
+
+
+def save_clip(source, target, max_bytes=STREAM_MAX_CLIP_BYTES, chunk_size=1024 * 1024):
+    """
+    Copy an uploaded clip to ``target``, refusing it past ``max_bytes``.
+    """
+    written = 0
+    while chunk := source.read(chunk_size):
+        written += len(chunk)
+        if written > max_bytes:
+            raise ClipTooLarge("Video clip too large")
+        target.write(chunk)
+    target.flush()
+    return written
+
+
+def iter_clip_frames(path, max_frames=STREAM_MAX_FRAMES, max_seconds=STREAM_MAX_CLIP_SECONDS):
+    cv2 = get_cv2()
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise ValueError("Unsupported or corrupt video clip")
+        # Same pixel limits as uploaded images, checked before any frame is decoded.
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if image_too_large(width, height):
+            raise FrameTooLarge("Video frames too large")
+        # Containers that don't report a frame count or rate give 0 and are
+        # bounded by max_frames alone.
+        fps, count = capture.get(cv2.CAP_PROP_FPS), capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        if fps > 0 and count > 0 and count / fps > max_seconds:
+            raise ClipTooLarge("Video clip too long")
+        for _ in range(max_frames):
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+class MjpegSplitter:
+    """
+    Splits a byte stream of concatenated JPEGs (MJPEG, optionally multipart
+    framed) into decoded BGR frames as the bytes arrive. Frames go through
+    face_service.decode_image_bytes, so the upload size and pixel limits
+    apply; frames that fail them are dropped and counted.
+    """
+
+    def __init__(self, max_frames=STREAM_MAX_FRAMES, max_frame_bytes=MAX_IMAGE_BYTES):
+        self.max_frames = max_frames
+        self.max_frame_bytes = max_frame_bytes
+        self.emitted = 0
+        self.rejected = 0
+        self._buffer = bytearray()
+
+    @property
+    def exhausted(self):
+        return self.emitted >= self.max_frames
+
+    def feed(self, chunk):
+        buffer = self._buffer
+        buffer.extend(chunk)
+        frames = []
+        while not self.exhausted:
+            start = buffer.find(_JPEG_SOI)
+            if start < 0:
+                # Keep a trailing 0xFF in case the marker straddles chunks.
+                del buffer[:-1]
+                break
+            end = buffer.find(_JPEG_EOI, start + 2)
+            if end < 0:
+                del buffer[:start]
+                if len(buffer) > self.max_frame_bytes:
+                    raise FrameTooLarge("MJPEG frame too large")
+                break
+            frame, error = decode_image_bytes(bytes(buffer[start:end + 2]), STREAM_DETECT_SIDE, rgb=False)
+            del buffer[:end + 2]
+            if error:
+                self.rejected += 1
+                continue
+            self.emitted += 1
+            frames.append(frame)
+        return frames
+
+
+def iter_mjpeg_frames(chunks, max_frames=STREAM_MAX_FRAMES):
+    splitter = MjpegSplitter(max_frames=max_frames)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+        if splitter.exhausted:
+            return
+
+
+def run_session(session, frames):
+    started = time.perf_counter()
+    for frame in frames:
+        session.process_frame(frame)
+    summary = session.summary()
+    summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    logger.info(
+        f"Stream session for admin {session.admin_id}: {summary['frames_processed']}/{summary['frames_received']} "
+        f"frames processed, {summary['faces_encoded']} encodings, {summary['students_marked']} marked"
+    )
+    return summary
@@ -0,0 +1,316 @@
+"""
+Per-admin (tenant) isolation for face work and exports.
+
+Face jobs from every admin share one pool of FACE_POOL_WORKERS threads, but
+each admin has its own queue and workers take from the queues in weighted
+round-robin. A school bulk-registering faces gets its turn and then yields to
+the next school instead of holding every worker. On top of that, each admin
+has:
+
+    TENANT_FACE_CONCURRENCY        face jobs running at once
+    TENANT_EXPORT_CONCURRENCY      exports / bulk jobs running at once
+    TENANT_CPU_SECONDS_PER_MINUTE  CPU time over a rolling minute
+
+An admin call over budget gets QuotaExceeded. Check-ins are scheduled and
+counted like everything else but never refused: the student at the kiosk
+isn't the one spending the budget.
+
+Weights come from TENANT_WEIGHTS ("admin-a=3,admin-b=2"); the default is 1.
+Counters are per process, like the other metrics.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+FACE_POOL_WORKERS = int(os.environ.get("FACE_POOL_WORKERS", max(4, os.cpu_count() or 1)))
+TENANT_FACE_CONCURRENCY = int(os.environ.get("TENANT_FACE_CONCURRENCY", max(1, FACE_POOL_WORKERS // 2)))
+TENANT_EXPORT_CONCURRENCY = int(os.environ.get("TENANT_EXPORT_CONCURRENCY", 1))
+TENANT_CPU_SECONDS_PER_MINUTE = float(os.environ.get("TENANT_CPU_SECONDS_PER_MINUTE", 60))
+TENANT_MAX_QUEUED = int(os.environ.get("TENANT_MAX_QUEUED", 32))
+CPU_WINDOW_SECONDS = 60.0
+# Check-ins whose student can't be mapped to an admin share this bucket.
+UNASSIGNED = "_unassigned"
+
+
+def _env_weights():
+    weights = {}
+    for item in os.environ.get("TENANT_WEIGHTS", "").split(","):
+        key, _, value = item.partition("=")
+        if key.strip() and value.strip():
+            weights[key.strip()] = max(1, int(value))
+    return weights
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"tenant quota exceeded: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Tenant:
+    def __init__(self, weight):
+        self.weight = weight
+        self.credit = weight
+        self.queue = deque()
+        self.in_ring = False
+        self.face_in_flight = 0
+        self.slots_in_flight = 0
+        self.cpu_window = deque()  # (finished_at, cpu_seconds)
+        self.jobs = {}
+        self.rejected = 0
+        self.cpu_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.queued_jobs = 0
+
+
+class TenantScheduler:
+    def __init__(
+        self,
+        workers=FACE_POOL_WORKERS,
+        face_concurrency=TENANT_FACE_CONCURRENCY,
+        export_concurrency=TENANT_EXPORT_CONCURRENCY,
+        cpu_seconds_per_minute=TENANT_CPU_SECONDS_PER_MINUTE,
+        max_queued=TENANT_MAX_QUEUED,
+        weights=None,
+    ):
+        self.workers = max(1, workers)
+        self.face_concurrency = max(1, face_concurrency)
+        self.export_concurrency = max(1, export_concurrency)
+        self.cpu_seconds_per_minute = cpu_seconds_per_minute
+        self.max_queued = max_queued
+        self.weights = _env_weights() if weights is None else dict(weights)
+        self._cond = threading.Condition()
+        self._tenants = {}
+        # Tenants with queued jobs, in service order.
+        self._ring = deque()
+        self._threads = []
+        self._closed = False
+
+    def _tenant(self, admin_id):
+        key = admin_id or UNASSIGNED
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            tenant = self._tenants[key] = _Tenant(self.weights.get(key, 1))
+        return key, tenant
+
+    def _face_limit(self, key):
+        return self.workers if key == UNASSIGNED else self.face_concurrency
+
+    def _cpu_used(self, tenant, now):
+        window = tenant.cpu_window
+        while window and window[0][0] <= now - CPU_WINDOW_SECONDS:
+            window.popleft()
+        return sum(cpu for _, cpu in window)
+
+    def _check_budget(self, tenant, now):
+        if self.cpu_seconds_per_minute <= 0:
+            return
+        used = self._cpu_used(tenant, now)
+        if used < self.cpu_seconds_per_minute:
+            return
+        # Wait until enough of the window has aged out to be back under.
+        freed, retry_at = 0.0, now + CPU_WINDOW_SECONDS
+        for finished_at, cpu in tenant.cpu_window:
+            freed += cpu
+            if used - freed < self.cpu_seconds_per_minute:
+                retry_at = finished_at + CPU_WINDOW_SECONDS
+                break
+        tenant.rejected += 1
+        raise QuotaExceeded("cpu", max(1, math.ceil(retry_at - now)))
+
+    def _record(self, tenant, kind, cpu, wall, waited=0.0):
+        tenant.cpu_window.append((time.monotonic(), cpu))
+        tenant.jobs[kind] = tenant.jobs.get(kind, 0) + 1
+        tenant.cpu_seconds += cpu
+        tenant.wall_seconds += wall
+        tenant.queue_wait_seconds += waited
+
+    # Face pool
+
+    def submit(self, admin_id, fn, *args, kind="face", enforce_quota=True):
+        """
+        Queue ``fn(*args)`` on the shared face pool under ``admin_id``.
+        Returns a concurrent.futures.Future; cancelling it before a worker
+        picks it up drops the job.
+        """
+        future = Future()
+        with self._cond:
+            self._start_workers()
+            key, tenant = self._tenant(admin_id)
+            if enforce_quota:
+                self._check_budget(tenant, time.monotonic())
+                if len(tenant.queue) >= self.max_queued:
+                    tenant.rejected += 1
+                    raise QuotaExceeded("queue", 1)
+            tenant.queue.append((future, fn, args, kind, time.monotonic()))
+            if not tenant.in_ring:
+                tenant.in_ring = True
+                self._ring.append(key)
+            self._cond.notify()
+        return future
+
+    def _next_job(self):
+        for _ in range(len(self._ring)):
+            key = self._ring[0]
+            tenant = self._tenants[key]
+            if tenant.face_in_flight >= self._face_limit(key):
+                self._ring.rotate(-1)
+                continue
+            job = tenant.queue.popleft()
+            tenant.credit -= 1
+            if not tenant.queue:
+                self._ring.popleft()
+                tenant.in_ring = False
+                tenant.credit = tenant.weight
+            elif tenant.credit <= 0:
+                # Used up its share of this round; go to the back.
+                tenant.credit = tenant.weight
+                self._ring.rotate(-1)
+            return tenant, job
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                picked = None
+                while picked is None:
+                    if self._closed:
+                        return
+                    picked = self._next_job()
+                    if picked is None:
+                        self._cond.wait()
+                tenant, (future, fn, args, kind, queued_at) = picked
+                if not future.set_running_or_notify_cancel():
+                    continue
+                tenant.face_in_flight += 1
+
+            started, cpu_started = time.monotonic(), time.thread_time()
+            try:
+                result, error = fn(*args), None
+            except BaseException as exc:
+                result, error = None, exc
+            finished = time.monotonic()
+
+            with self._cond:
+                tenant.face_in_flight -= 1
+                self._record(
+                    tenant, kind, time.thread_time() - cpu_started, finished - started, started - queued_at
+                )
+                tenant.queued_jobs += 1
+                # A tenant held back by its concurrency limit may now run.
+                self._cond.notify_all()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _start_workers(self):
+        if self._threads:
+            return
+        self._closed = False
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"face-pool-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self._threads = []
+
+    # Exports and other long admin jobs that run outside the face pool
+
+    def acquire_slot(self, admin_id, kind="export"):
+        with self._cond:
+            _, tenant = self._tenant(admin_id)
+            self._check_budget(tenant, time.monotonic())
+            if tenant.slots_in_flight >= self.export_concurrency:
+                tenant.rejected += 1
+                raise QuotaExceeded("concurrency", 5)
+            tenant.slots_in_flight += 1
+        return (tenant, kind, time.monotonic(), time.thread_time(), threading.get_ident())
+
+    def release_slot(self, token):
+        tenant, kind, started, cpu_started, thread_id = token
+        # thread_time() is per thread; a generator resumed elsewhere only
+        # has its wall time counted.
+        cpu = time.thread_time() - cpu_started if threading.get_ident() == thread_id else 0.0
+        with self._cond:
+            tenant.slots_in_flight -= 1
+            self._record(tenant, kind, cpu, time.monotonic() - started)
+
+    def charge(self, admin_id, cpu_seconds):
+        """
+        Count CPU spent on ``admin_id``'s behalf outside this process's
+        threads (e.g. in the enrollment process pool) against its budget.
+        """
+        with self._cond:
+            _, tenant = self._tenant(admin_id)
+            tenant.cpu_window.append((time.monotonic(), cpu_seconds))
+            tenant.cpu_seconds += cpu_seconds
+
+    @contextmanager
+    def slot(self, admin_id, kind="export"):
+        token = self.acquire_slot(admin_id, kind)
+        try:
+            yield
+        finally:
+            self.release_slot(token)
+
+    def totals(self):
+        """
+        Counters summed over every tenant, without tenant ids.
+        """
+        with self._cond:
+            tenants = list(self._tenants.values())
+            return {
+                "tenants": len(tenants),
+                "queued": sum(len(tenant.queue) for tenant in tenants),
+                "face_in_flight": sum(tenant.face_in_flight for tenant in tenants),
+                "exports_in_flight": sum(tenant.slots_in_flight for tenant in tenants),
+                "rejected": sum(tenant.rejected for tenant in tenants),
+                "cpu_seconds": round(sum(tenant.cpu_seconds for tenant in tenants), 3),
+            }
+
+    def usage(self, admin_id=None):
+        """
+        Per-tenant counters, or one tenant's when ``admin_id`` is given.
+        """
+        with self._cond:
+            now = time.monotonic()
+            keys = [admin_id or UNASSIGNED] if admin_id is not None else sorted(self._tenants)
+            report = {}
+            for key in keys:
+                tenant = self._tenants.get(key) or _Tenant(self.weights.get(key, 1))
+                report[key] = {
+                    "weight": tenant.weight,
+                    "queued": len(tenant.queue),
+                    "face_in_flight": tenant.face_in_flight,
+                    "exports_in_flight": tenant.slots_in_flight,
+                    "jobs": dict(tenant.jobs),
+                    "rejected": tenant.rejected,
+                    "cpu_seconds": round(tenant.cpu_seconds, 3),
+                    "cpu_seconds_last_minute": round(self._cpu_used(tenant, now), 3),
+                    "cpu_budget_per_minute": self.cpu_seconds_per_minute,
+                    "wall_seconds": round(tenant.wall_seconds, 3),
+                    "avg_queue_wait_ms": (
+                        round(tenant.queue_wait_seconds * 1000 / tenant.queued_jobs, 1) if tenant.queued_jobs else 0.0
+                    ),
+                }
+            return report
+
+
+_scheduler = TenantScheduler()
+
+
+def get_tenant_scheduler():
+    return _scheduler
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import json
+import os
 import sys
 import time
 from pathlib import Path
@@ -13,9 +15,25 @@ BACKEND_DIR = Path(__file__).resolve().parents[1]
 if str(BACKEND_DIR) not in sys.path:
     sys.path.insert(0, str(BACKEND_DIR))
 
+import admission_service
+import analytics_service
 import app as app_module
 import attendance_service
+import audit_service
 import auth_service
+import body_limit_service
+import cache_service
+import calibration_service
+import detector_service
+import enrollment_service
+import face_service
+import gallery_service
+import local_store_service
+import response_service
+import roster_service
+import schedule_service
+import stream_service
+import tenant_service
 
 
 class FakeResponse:
@@ -23,6 +41,41 @@ class FakeResponse:
         self.data = [] if data is None else data
 
 
+def _compare(actual, op, value):
+    if op == "eq":
+        return str(actual) == str(value)
+    if actual is None:
+        return False
+    if isinstance(actual, int):
+        value = int(value)
+    return {"lt": actual < value, "lte": actual <= value, "gte": actual >= value}[op]
+
+
+def _split_top_level(text):
+    parts, depth, current = [], 0, ""
+    for ch in text:
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += ch == "("
+        depth -= ch == ")"
+        current += ch
+    return parts + [current]
+
+
+def _match_or(row, filters, combine=any):
+    # Just enough of PostgREST's or=(...) / and(...) syntax for keyset cursors.
+    results = []
+    for term in _split_top_level(filters):
+        if term.startswith("and("):
+            results.append(_match_or(row, term[4:-1], all))
+        else:
+            field, op, value = term.split(".", 2)
+            results.append(_compare(row.get(field), op, value))
+    return combine(results)
+
+
 class FakeQuery:
     def __init__(self, table_name, tables):
         self.table_name = table_name
@@ -30,9 +83,11 @@ class FakeQuery:
         self._op = "select"
         self._eq = []
         self._in = []
-        self._order = None
-        self._order_desc = False
+        self._cmp = []
+        self._or = None
+        self._order = []
         self._limit = None
+        self._range = None
         self._payload = None
 
     def select(self, _fields):
@@ -47,15 +102,30 @@ class FakeQuery:
         self._in.append((field, set(values)))
         return self
 
+    def gte(self, field, value):
+        self._cmp.append((field, "gte", value))
+        return self
+
+    def lte(self, field, value):
+        self._cmp.append((field, "lte", value))
+        return self
+
+    def or_(self, filters):
+        self._or = filters
+        return self
+
     def order(self, field, desc=False, ascending=None):
-        self._order = field
-        self._order_desc = (not ascending) if ascending is not None else bool(desc)
+        self._order.append((field, (not ascending) if ascending is not None else bool(desc)))
         return self
 
     def limit(self, n):
         self._limit = n
         return self
 
+    def range(self, start, end):
+        self._range = (start, end)
+        return self
+
     def insert(self, payload):
         self._op = "insert"
         self._payload = payload
@@ -65,6 +135,12 @@ class FakeQuery:
         self._op = "delete"
         return self
 
+    def upsert(self, payload, on_conflict=None):
+        self._op = "upsert"
+        self._payload = payload
+        self._on_conflict = on_conflict
+        return self
+
     def execute(self):
         rows = list(self.tables.get(self.table_name, []))
 
@@ -74,20 +150,37 @@ class FakeQuery:
             for k, vals in self._in:
                 if row.get(k) not in vals:
                     return False
-            return True
+            if not all(_compare(row.get(k), op, v) for k, op, v in self._cmp):
+                return False
+            return self._or is None or _match_or(row, self._or)
 
         if self._op == "select":
             data = [dict(r) for r in rows if matches(r)]
-            if self._order:
-                data.sort(key=lambda x: x.get(self._order), reverse=self._order_desc)
+            for field, desc in reversed(self._order):
+                # Nulls sort last, as in PostgREST's default ascending order.
+                data.sort(key=lambda x: (x.get(field) is None, x.get(field) or 0), reverse=desc)
+            if self._range is not None:
+                data = data[self._range[0] : self._range[1] + 1]
             if self._limit is not None:
                 data = data[: self._limit]
             return FakeResponse(data=data)
 
         if self._op == "insert":
-            payload = dict(self._payload)
-            self.tables.setdefault(self.table_name, []).append(payload)
-            return FakeResponse(data=[payload])
+            payloads = self._payload if isinstance(self._payload, list) else [self._payload]
+            inserted = [dict(p) for p in payloads]
+            self.tables.setdefault(self.table_name, []).extend(inserted)
+            self.tables.setdefault("_inserts", []).append((self.table_name, len(inserted)))
+            return FakeResponse(data=inserted)
+
+        if self._op == "upsert":
+            payloads = self._payload if isinstance(self._payload, list) else [self._payload]
+            table = self.tables.setdefault(self.table_name, [])
+            for payload in payloads:
+                key = payload.get(self._on_conflict)
+                table[:] = [r for r in table if r.get(self._on_conflict) != key]
+                table.append(dict(payload))
+            self.tables.setdefault("_upserts", []).append((self.table_name, len(payloads)))
+            return FakeResponse(data=[dict(p) for p in payloads])
 
         if self._op == "delete":
             kept = [r for r in rows if not matches(r)]
@@ -124,12 +217,29 @@ def _auth_user(user_id="user-1"):
 
 
 @pytest.fixture(autouse=True)
-def _reset_state():
+def _reset_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(audit_service, "AUDIT_DIR", str(tmp_path / "audit"))
+    monkeypatch.setattr(gallery_service, "GALLERY_DIR", str(tmp_path / "gallery"))
+    monkeypatch.setattr(gallery_service, "_changes_offset", 0)
+    monkeypatch.setattr(gallery_service, "_owner_fd", None)
     app_module.app.dependency_overrides = {}
     app_module._ATTEMPT_LOG.clear()
+    face_service.get_replay_cache().clear()
+    cache_service.get_response_cache().clear()
+    schedule_service.reset_schedule()
+    calibration_service.reset_thresholds()
+    face_service.reset_student_admins()
+    roster_service.reset_today_builds()
+    # Student -> admin lookups must never reach a real project.
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: FakeSupabase())
     yield
     app_module.app.dependency_overrides = {}
     app_module._ATTEMPT_LOG.clear()
+    face_service.get_replay_cache().clear()
+    cache_service.get_response_cache().clear()
+    schedule_service.reset_schedule()
+    calibration_service.reset_thresholds()
+    audit_service.close_audit_log()
 
 
 @pytest.fixture()
@@ -139,7 +249,7 @@ def client():
 
 
 def test_mark_attendance_success_200(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 93.2, "Match found"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 93.2, "Match found", None))
     monkeypatch.setattr(
         app_module,
         "mark_student_attendance",
@@ -155,7 +265,7 @@ def test_mark_attendance_success_200(client, monkeypatch):
 
 
 def test_mark_attendance_face_mismatch_400(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (False, 0.0, "Face does not match"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (False, 0.0, "Face does not match", None))
     resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
     assert resp.status_code == 400
     assert resp.json() == {
@@ -169,7 +279,7 @@ def test_mark_attendance_multiple_faces_400(client, monkeypatch):
     monkeypatch.setattr(
         app_module,
         "verify_student_face",
-        lambda *_: (False, 0.0, "Found 2 faces. System requires exactly 1 face."),
+        lambda *_: (False, 0.0, "Found 2 faces. System requires exactly 1 face.", None),
     )
     resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
     assert resp.status_code == 400
@@ -181,7 +291,7 @@ def test_mark_attendance_multiple_faces_400(client, monkeypatch):
 
 
 def test_mark_attendance_no_face_400(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (False, 0.0, "No face encoding found."))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (False, 0.0, "No face encoding found.", None))
     resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
     assert resp.status_code == 400
     assert resp.json() == {
@@ -195,7 +305,7 @@ def test_mark_attendance_encoding_error_500(client, monkeypatch):
     monkeypatch.setattr(
         app_module,
         "verify_student_face",
-        lambda *_: (False, 0.0, "Invalid stored encoding format. Expected (128,), got (127,)"),
+        lambda *_: (False, 0.0, "Invalid stored encoding format. Expected (128,), got (127,)", None),
     )
     resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
     assert resp.status_code == 500
@@ -207,7 +317,7 @@ def test_mark_attendance_encoding_error_500(client, monkeypatch):
 
 
 def test_mark_attendance_duplicate_400(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 91.0, "Match found"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 91.0, "Match found", None))
     monkeypatch.setattr(
         app_module,
         "mark_student_attendance",
@@ -223,7 +333,7 @@ def test_mark_attendance_duplicate_400(client, monkeypatch):
 
 
 def test_mark_attendance_outside_time_window_403(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 91.0, "Match found"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 91.0, "Match found", None))
     monkeypatch.setattr(
         app_module,
         "mark_student_attendance",
@@ -239,7 +349,7 @@ def test_mark_attendance_outside_time_window_403(client, monkeypatch):
 
 
 def test_mark_attendance_rate_limit_429(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 92.0, "Match found"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 92.0, "Match found", None))
     monkeypatch.setattr(
         app_module,
         "mark_student_attendance",
@@ -259,7 +369,7 @@ def test_mark_attendance_rate_limit_429(client, monkeypatch):
 
 
 def test_mark_attendance_different_subject_same_day_200(client, monkeypatch):
-    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 90.0, "Match found"))
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (True, 90.0, "Match found", None))
     monkeypatch.setattr(
         app_module,
         "mark_student_attendance",
@@ -296,7 +406,7 @@ def test_mark_attendance_method_not_allowed_405(client):
 def test_mark_attendance_face_timeout_503(client, monkeypatch):
     def _slow(*_):
         time.sleep(2.1)
-        return True, 90.0, "Match found"
+        return True, 90.0, "Match found", None
 
     monkeypatch.setattr(app_module, "verify_student_face", _slow)
     resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
@@ -398,6 +508,11 @@ def test_export_empty_dataset_404(client, monkeypatch):
         "message": "No attendance records found.",
     }
 
+    # An unknown format is refused before anything is fetched.
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: pytest.fail("export format not validated first"))
+    resp = client.post("/api/v1/export", json={"format": "xml"})
+    assert resp.status_code == 400 and resp.json()["error_code"] == "INVALID_PAYLOAD"
+
 
 def test_attendance_service_duplicate_same_day(monkeypatch):
     today = time.strftime("%Y-%m-%d")
@@ -412,3 +527,1971 @@ def test_attendance_service_duplicate_same_day(monkeypatch):
     assert ok is False
     assert code == "DUPLICATE_ATTENDANCE"
     assert message == "Attendance already recorded for today."
+
+
+def test_health_reports_liveness_while_warming(client, monkeypatch):
+    monkeypatch.setattr(app_module, "FACE_WARMUP_ENABLED", True)
+    monkeypatch.setattr(
+        app_module,
+        "get_warmup_state",
+        lambda: {"status": "warming", "duration_ms": None, "error": None, "warmed_at": None},
+    )
+    resp = client.get("/api/v1/health")
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["live"] is True
+    assert body["ready"] is False
+    assert body["readiness"] == "warming"
+
+    ready = client.get("/api/v1/health/ready")
+    assert ready.status_code == 503
+    assert ready.json()["error_code"] == "SERVICE_WARMING"
+    assert ready.headers["Retry-After"] == "5"
+
+
+def test_health_ready_after_warmup(client, monkeypatch):
+    monkeypatch.setattr(app_module, "FACE_WARMUP_ENABLED", True)
+    monkeypatch.setattr(
+        app_module,
+        "get_warmup_state",
+        lambda: {"status": "ready", "duration_ms": 812.5, "error": None, "warmed_at": 1.0},
+    )
+    body = client.get("/api/v1/health").json()
+    assert body["ready"] is True
+    assert body["face_warmup_ms"] == 812.5
+    assert client.get("/api/v1/health/ready").status_code == 200
+
+
+def test_gallery_roundtrip_is_memory_mapped_and_grouped_by_admin(tmp_path, monkeypatch):
+    monkeypatch.setattr(gallery_service, "FETCH_PAGE_SIZE", 2)
+    fake = FakeSupabase(
+        tables={
+            "face_encodings": [
+                {"student_id": "stu-1", "encoding": [0.1] * 128},
+                {"student_id": "stu-2", "encoding": [0.2] * 128},
+                {"student_id": "stu-3", "encoding": [0.3] * 128},
+                {"student_id": "stu-bad", "encoding": [0.3] * 12},
+            ],
+            "students": [
+                {"id": "stu-1", "admin_id": "admin-a"},
+                {"id": "stu-2", "admin_id": "admin-b"},
+                {"id": "stu-3", "admin_id": "admin-a"},
+                {"id": "stu-bad", "admin_id": "admin-a"},
+            ],
+        }
+    )
+    gallery = gallery_service.load_gallery(client=fake, directory=str(tmp_path))
+    try:
+        assert len(gallery) == 3
+        assert "stu-bad" not in gallery
+        assert gallery.get("stu-2")[0] == pytest.approx(0.2)
+        ids, matrix = gallery_service.get_gallery().for_admin("admin-a")
+        assert sorted(ids) == ["stu-1", "stu-3"]
+        assert matrix.shape == (2, 128)
+        assert not matrix.flags.owndata
+
+        reopened = gallery_service.open_gallery(str(tmp_path))
+        assert reopened.student_ids == gallery.student_ids
+    finally:
+        gallery_service.set_gallery(None)
+
+    # Pages follow a stable key, whatever order the table returns rows in.
+    fake.tables["students"].reverse()
+    rows = gallery_service.fetch_all_rows(fake, "students", "id")
+    assert [row["id"] for row in rows] == ["stu-1", "stu-2", "stu-3", "stu-bad"]
+
+
+def test_gallery_boot_maps_snapshot_and_fetches_only_changes(tmp_path, monkeypatch):
+    import numpy as np
+
+    tables = {
+        "face_encodings": [
+            {"student_id": f"stu-{i}", "encoding": [i / 10] * 128, "updated_at": f"2026-03-01T0{i}:00:00+00:00"}
+            for i in range(1, 5)
+        ],
+        "students": [{"id": f"stu-{i}", "admin_id": "admin-a" if i % 2 else "admin-b"} for i in range(1, 7)],
+    }
+    fake = FakeSupabase(tables=tables)
+    directory = str(tmp_path)
+    first = gallery_service.load_gallery(client=fake, directory=directory)
+    generation = gallery_service._read_current(directory)
+    assert len(first) == 4 and first.watermark == "2026-03-01T04:00:00+00:00"
+
+    # Nothing changed: the snapshot is reused as-is, without a rewrite.
+    again = gallery_service.load_gallery(client=fake, directory=directory)
+    assert gallery_service._read_current(directory) == generation
+    assert isinstance(again.matrix, np.memmap)
+
+    encodings = tables["face_encodings"]
+    encodings[:] = [row for row in encodings if row["student_id"] != "stu-2"]  # deleted
+    with open(os.path.join(directory, gallery_service.CHANGES_FILE), "a") as fh:
+        fh.write("999999 stu-2\n")  # by another worker, before this one booted
+    encodings[0] = dict(encodings[0], encoding=[0.9] * 128, updated_at="2026-03-02T00:00:00+00:00")  # stu-1
+    encodings.append({"student_id": "stu-5", "encoding": [0.5] * 128, "updated_at": "2026-03-02T01:00:00+00:00"})
+
+    fetched, scans = [], []
+    original_fetch = gallery_service.fetch_all_rows
+
+    def counting_fetch(client, table, fields, filters=None):
+        rows = original_fetch(client, table, fields, filters)
+        if "encoding" in fields:
+            fetched.extend(rows)
+        elif fields == "student_id":
+            scans.append(table)
+        return rows
+
+    monkeypatch.setattr(gallery_service, "fetch_all_rows", counting_fetch)
+    refreshed = gallery_service.load_gallery(client=fake, directory=directory)
+    gallery_service.set_gallery(None)
+
+    assert sorted(r["student_id"] for r in fetched) == ["stu-1", "stu-4", "stu-5"]  # changes + overlap window
+    assert scans == []  # the id scan is left to the refresher
+    assert sorted(refreshed.ids()) == ["stu-1", "stu-3", "stu-4", "stu-5"]
+    assert refreshed.get("stu-1")[0] == pytest.approx(0.9)
+    assert sorted(refreshed.for_admin("admin-a")[0]) == ["stu-1", "stu-3", "stu-5"]
+    assert refreshed.watermark == "2026-03-02T01:00:00+00:00"
+    assert gallery_service._read_current(directory) != generation
+
+    # The refresher's first pass runs the id scan boot skipped.
+    passes = []
+    monkeypatch.setattr(gallery_service, "refresh_installed_gallery", lambda scan_ids: passes.append(scan_ids))
+
+    class TwoPasses:
+        def wait(self, _interval):
+            return len(passes) >= 2
+
+    gallery_service.run_refresher(interval=0, stop_event=TwoPasses())
+    assert passes == [True, False]
+
+
+def test_gallery_applies_changes_logged_by_other_workers(tmp_path):
+    directory = str(tmp_path / "gallery")
+    tables = {
+        "face_encodings": [{"student_id": "stu-2", "encoding": [0.2] * 128}],
+        "students": [{"id": "stu-2", "admin_id": "admin-a"}],
+    }
+    gallery_service.set_gallery(
+        gallery_service.build_gallery([{"student_id": "stu-1", "encoding": [0.1] * 128}], {"stu-1": "admin-a"})
+    )
+    try:
+        # This worker's own entries are skipped; it already applied them.
+        gallery_service.record_change("stu-9", directory)
+        assert gallery_service.apply_logged_changes(FakeSupabase(tables=tables), directory) == 0
+
+        with open(os.path.join(directory, gallery_service.CHANGES_FILE), "a") as fh:
+            fh.write("999999 stu-1\n999999 stu-2\n999999 stu-3")  # last line still being written
+        assert gallery_service.apply_logged_changes(FakeSupabase(tables=tables), directory) == 2
+        gallery = gallery_service.get_gallery()
+        assert "stu-1" not in gallery  # deleted elsewhere
+        assert gallery.get("stu-2")[0] == 0.2 and gallery.admin_of("stu-2") == "admin-a"
+        assert gallery_service.apply_logged_changes(FakeSupabase(tables=tables), directory) == 0
+    finally:
+        gallery_service.set_gallery(None)
+
+
+def test_gallery_refresh_writes_snapshots_only_from_the_owner(tmp_path, monkeypatch):
+    import fcntl
+
+    directory = str(tmp_path / "gallery")
+    tables = {
+        "face_encodings": [
+            {"student_id": f"stu-{i}", "encoding": [i / 10] * 128, "updated_at": f"2026-03-01T0{i}:00:00+00:00"}
+            for i in range(1, 4)
+        ],
+        "students": [{"id": f"stu-{i}", "admin_id": "admin-a"} for i in range(1, 5)],
+    }
+    fake = FakeSupabase(tables=tables)
+    gallery_service.load_gallery(client=fake, directory=directory)
+    generation = gallery_service._read_current(directory)
+
+    scans = []
+    original_fetch = gallery_service.fetch_all_rows
+
+    def counting_fetch(client, table, fields, filters=None):
+        if fields == "student_id":
+            scans.append(table)
+        return original_fetch(client, table, fields, filters)
+
+    monkeypatch.setattr(gallery_service, "fetch_all_rows", counting_fetch)
+    # Another worker owns the snapshots.
+    holder = os.open(os.path.join(directory, gallery_service.OWNER_FILE), os.O_RDWR | os.O_CREAT)
+    fcntl.flock(holder, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    try:
+        assert gallery_service.refresh_installed_gallery(fake, directory, scan_ids=False)
+        assert scans == []  # no changes, no id scan
+
+        tables["face_encodings"].append(
+            {"student_id": "stu-4", "encoding": [0.4] * 128, "updated_at": "2026-03-02T00:00:00+00:00"}
+        )
+        assert gallery_service.refresh_installed_gallery(fake, directory, scan_ids=False)
+        gallery = gallery_service.get_gallery()
+        assert scans == ["face_encodings"]
+        assert gallery.get("stu-4")[0] == pytest.approx(0.4) and gallery.pending_changes == 1
+        assert gallery_service._read_current(directory) == generation  # left to the owner
+    finally:
+        os.close(holder)
+        gallery_service.set_gallery(None)
+
+
+def test_gallery_reads_stay_consistent_under_concurrent_writes(monkeypatch):
+    import threading
+
+    import numpy as np
+
+    monkeypatch.setattr(gallery_service, "COMPACT_AFTER", 8)
+    base = gallery_service.build_gallery(
+        [{"student_id": f"stu-{i}", "encoding": [float(i)] * 128} for i in range(50)],
+        {f"stu-{i}": "admin-a" if i % 2 else "admin-b" for i in range(50)},
+    )
+    gallery_service.set_gallery(base)
+    errors, stop = [], threading.Event()
+
+    def reader():
+        try:
+            while not stop.is_set():
+                gallery = gallery_service.get_gallery()
+                for i in (1, 2, 60, 75):
+                    vector = gallery.get(f"stu-{i}")
+                    # A student's vector is always whole and always its own.
+                    assert vector is None or (vector.shape == (128,) and np.all(vector == i))
+                for admin_id in ("admin-a", "admin-b"):
+                    ids, matrix = gallery.for_admin(admin_id)
+                    assert len(ids) == matrix.shape[0]
+                    for sid, row in zip(ids, matrix):
+                        assert np.all(row == int(sid.split("-")[1]))
+        except Exception as exc:  # pragma: no cover - reported below
+            errors.append(exc)
+
+    def writer(offset):
+        try:
+            for round_ in range(40):
+                i = 50 + offset * 40 + round_
+                gallery_service.upsert_encoding(f"stu-{i}", "admin-a", np.full(128, float(i)))
+                if round_ < 20:
+                    gallery_service.remove_encoding(f"stu-{offset * 20 + round_}")
+        except Exception as exc:  # pragma: no cover
+            errors.append(exc)
+
+    readers = [threading.Thread(target=reader) for _ in range(6)]
+    writers = [threading.Thread(target=writer, args=(n,)) for n in range(2)]
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    try:
+        assert errors == []
+        final = gallery_service.get_gallery()
+        # Compaction kept the overlay small, and nothing was lost across it.
+        assert final.pending_changes < 8 * 2
+        assert len(final) == 50 - 40 + 80
+        assert "stu-39" not in final and "stu-40" in final
+        assert final.get("stu-129")[0] == 129.0
+        assert base.get("stu-1")[0] == 1.0 and "stu-60" not in base  # old snapshot untouched
+    finally:
+        gallery_service.set_gallery(None)
+
+
+def test_face_flows_keep_the_installed_gallery_current(monkeypatch):
+    import numpy as np
+
+    gallery_service.set_gallery(gallery_service.build_gallery([], {}))
+    tables = {"face_encodings": [], "students": [{"id": "stu-1", "admin_id": "admin-a"}]}
+    fake = FakeSupabase(tables=tables)
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(face_service, "decode_image_checked", lambda _image: (object(), None))
+    monkeypatch.setattr(face_service, "_encode_face", lambda *_args: (np.full(128, 0.25), (0, 1, 1, 0), None, None))
+    monkeypatch.setattr(face_service, "LIVENESS_MODE", "off")
+    try:
+        assert face_service.register_student_face("stu-1", "img", admin_id="admin-a")[0] is True
+        assert gallery_service.get_gallery().get("stu-1")[0] == 0.25
+        assert gallery_service.get_gallery().for_admin("admin-a")[0] == ["stu-1"]
+
+        # Verification is answered from the gallery, not Supabase.
+        tables["face_encodings"].clear()
+        verified, _confidence, _message, _liveness = face_service._verify_student_face("stu-1", "img")
+        assert verified
+
+        assert face_service.delete_student_face("stu-1")[0] is True
+        assert "stu-1" not in gallery_service.get_gallery()
+    finally:
+        gallery_service.set_gallery(None)
+
+
+def _jpeg_data_url(width, height):
+    import base64
+
+    import cv2
+    import numpy as np
+
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    frame[:, :, 2] = 255  # pure red in BGR
+    ok, buf = cv2.imencode(".jpg", frame)
+    assert ok
+    return "data:image/jpeg;base64," + base64.b64encode(buf.tobytes()).decode()
+
+
+def test_decode_image_reduces_large_jpeg_and_returns_rgb():
+    image, error = face_service.decode_image_checked(_jpeg_data_url(3400, 2000))
+    assert error is None
+    assert image.shape == (500, 850, 3)
+    assert image.flags.c_contiguous
+    assert image[10, 10, 0] > 240 and image[10, 10, 2] < 15
+
+
+def test_decode_image_rejects_bad_inputs_cheaply(monkeypatch):
+    assert face_service.decode_image_checked("data:text/html;base64,PGI+")[1].startswith("Invalid image")
+    assert face_service.decode_image_checked("bm90IGFuIGltYWdl")[1] == "Invalid image: unsupported format"
+    monkeypatch.setattr(face_service, "MAX_IMAGE_BYTES", 1024)
+    assert face_service.decode_image_checked("A" * 4096)[1] == "Image too large"
+
+
+def test_mark_attendance_oversize_image_413(client, monkeypatch):
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: (False, 0.0, "Image too large", None))
+    resp = client.post("/mark_attendance", json={"student_id": "stu-1", "image": "frame"})
+    assert resp.status_code == 413
+    assert resp.json()["error_code"] == "IMAGE_TOO_LARGE"
+
+
+def test_replay_cache_expires_and_stays_bounded():
+    now = [100.0]
+    cache = face_service.ReplayCache(ttl_seconds=10, max_students=2, clock=lambda: now[0])
+    cache.put("stu-1", 0b1010, (False, 41.0, "Face does not match"))
+    assert cache.get("stu-1", 0b1011) == (False, 41.0, "Face does not match")  # 1 bit away
+    assert cache.get("stu-1", 0xFFFF) is None
+    cache.put("stu-4", 0b1010, (True, 91.0, "Match found"))
+    assert cache.get("stu-4", 0b1010) is None  # accepted results are never reused
+    assert cache.get("stu-2", 0b1010) is None
+
+    cache.put("stu-2", 1, (False, 40.0, "Face does not match"))
+    cache.put("stu-3", 1, (False, 40.0, "Face does not match"))
+    assert cache.get("stu-1", 0b1010) is None  # evicted, oldest student
+
+    now[0] += 11
+    assert cache.get("stu-3", 1) is None
+
+
+def test_frame_hash_matches_near_identical_frames():
+    first = face_service.frame_hash(_jpeg_data_url(640, 480))
+    again = face_service.frame_hash(_jpeg_data_url(640, 480))
+    assert first is not None and first == again
+    assert face_service.frame_hash("not-an-image") is None
+
+
+def test_frame_hash_refuses_oversized_frames_from_the_header(monkeypatch):
+    # Same header probe as decode_image_checked: nothing is decoded past the limits.
+    monkeypatch.setattr(face_service, "MAX_IMAGE_PIXELS", 1000)
+    monkeypatch.setattr(face_service, "_get_cv2", lambda: pytest.fail("oversized frame was decoded"))
+    assert face_service.frame_hash(_jpeg_data_url(640, 480)) is None
+
+
+def test_replay_cache_runs_by_default_and_is_bypassed_when_liveness_is_enforced(monkeypatch):
+    calls = []
+
+    def verify(student_id, image, burst=None, admin_id=None):
+        calls.append(burst)
+        return False, 0.0, "Face does not match", {"live": bool(burst)}
+
+    monkeypatch.setattr(face_service, "_verify_student_face", verify)
+    monkeypatch.setattr(face_service, "frame_hash", lambda _: 0b1010)
+    # Default configuration (FACE_LIVENESS=report): the replayed frame is answered from the cache.
+    assert face_service.LIVENESS_MODE == "report" and face_service.replay_cache_enabled()
+    face_service.verify_student_face("stu-1", "frame")
+    assert face_service.verify_student_face("stu-1", "frame") == (False, 0.0, "Face does not match", {"live": False})
+    assert len(calls) == 1
+
+    face_service.get_replay_cache().clear()
+    monkeypatch.setattr(face_service, "LIVENESS_MODE", "enforce")
+    assert face_service.verify_student_face("stu-1", "frame")[3] == {"live": False}
+    assert face_service.verify_student_face("stu-1", "frame", ["f2"])[3] == {"live": True}
+    assert len(calls) == 3
+
+
+def test_mark_attendance_replay_skips_verification_but_not_rate_limit(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        app_module, "lookup_replayed_verification", lambda *_: (False, 0.0, "Face does not match", None)
+    )
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: calls.append(1))
+    monkeypatch.setattr(app_module, "replay_cache_enabled", lambda: True)
+    payload = {"student_id": "stu-replay", "image": "frame"}
+    for _ in range(app_module.RATE_LIMIT_ATTEMPTS):
+        resp = client.post("/mark_attendance", json=payload)
+        assert resp.status_code == 400
+        assert resp.json()["error_code"] == "FACE_MISMATCH"
+    assert client.post("/mark_attendance", json=payload).status_code == 429
+    assert calls == []
+
+
+def test_match_encodings_matches_pairwise_distances():
+    import numpy as np
+
+    rng = np.random.default_rng(7)
+    gallery = rng.normal(size=(50, 128))
+    probes = gallery[[3, 41]] + rng.normal(scale=0.01, size=(2, 128))
+    rows, distances = face_service.match_encodings(probes, gallery)
+    assert rows.tolist() == [3, 41]
+    expected = np.linalg.norm(gallery[[3, 41]] - probes, axis=1)
+    assert distances == pytest.approx(expected, abs=1e-6)
+
+    empty_rows, _ = face_service.match_encodings(probes, np.empty((0, 128)))
+    assert empty_rows.tolist() == [-1, -1]
+
+
+def test_mark_attendance_bulk_dedups_and_inserts_once(monkeypatch):
+    today = time.strftime("%Y-%m-%d")
+    tables = {"attendance": [{"id": "a1", "student_id": "stu-1", "admin_id": "admin-a", "date": today}]}
+    fake = FakeSupabase(tables=tables)
+    monkeypatch.setattr(attendance_service, "get_supabase_client", lambda: fake)
+
+    ok, results, _ = attendance_service.mark_attendance_bulk("admin-a", {"stu-1": 90.0, "stu-2": 88.5, "stu-3": 91.2})
+    assert ok is True
+    assert results["stu-1"] == (False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today.")
+    assert results["stu-2"][1] == "ATTENDANCE_MARKED"
+    assert results["stu-3"][1] == "ATTENDANCE_MARKED"
+    assert tables["_inserts"] == [("attendance", 2)]
+
+    ok, results, _ = attendance_service.mark_attendance_bulk("admin-a", {"stu-2": 90.0})
+    assert results["stu-2"][0] is False
+    assert len(tables["_inserts"]) == 1
+
+
+def test_mark_attendance_batch_endpoint(client, monkeypatch):
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    fake = FakeSupabase(tables={"admins": [{"id": "admin-a", "user_id": "user-1"}]})
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(
+        app_module,
+        "identify_faces",
+        lambda admin_id, images: ({"stu-1": 91.0, "stu-2": 85.0}, {"faces_detected": 3, "students_matched": 2}),
+    )
+    monkeypatch.setattr(
+        app_module,
+        "mark_attendance_bulk",
+        lambda admin_id, matches, subject: (
+            True,
+            {
+                "stu-1": (True, "ATTENDANCE_MARKED", "Attendance marked successfully."),
+                "stu-2": (False, "DUPLICATE_ATTENDANCE", "Attendance already recorded for today."),
+            },
+            "",
+        ),
+    )
+    resp = client.post("/api/v1/mark_attendance/batch", json={"images": ["frame-a", "frame-b"]})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["faces_detected"] == 3
+    assert body["marked_count"] == 1
+    assert body["duplicate_count"] == 1
+    assert body["confidence"] == 88.0
+
+    too_many = client.post("/api/v1/mark_attendance/batch", json={"images": ["f"] * 4})
+    assert too_many.status_code == 400
+
+
+def _fake_encode_file(name, img_bytes, admin_id=None):
+    if img_bytes == b"no-face":
+        return name, None, "Found 0 faces. System requires exactly 1 face.", 0.25
+    return name, [0.5] * 128, None, 0.5
+
+
+def test_enroll_images_batches_upserts_and_reports_each_file(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    monkeypatch.setattr(enrollment_service, "_encode_file", _fake_encode_file)
+    monkeypatch.setattr(enrollment_service, "UPSERT_BATCH_SIZE", 2)
+    scheduler = tenant_service.TenantScheduler(workers=1)
+    monkeypatch.setattr(enrollment_service, "get_tenant_scheduler", lambda: scheduler)
+    tables = {
+        "students": [
+            {"id": f"stu-{i}", "admin_id": "admin-a", "roll_number": f"R{i}"} for i in range(1, 5)
+        ]
+        + [{"id": "stu-x", "admin_id": "admin-b", "roll_number": "R9"}],
+    }
+    fake = FakeSupabase(tables=tables)
+    sources = [
+        ("R1.jpg", b"img", None),
+        ("r2.JPG", b"img", None),
+        ("R3.png", b"img", None),
+        ("R4.jpg", b"no-face", None),
+        ("R9.jpg", b"img", None),
+        ("R1.png", b"img", None),
+        ("R5.jpg", None, "Image too large"),
+    ]
+    mirrored = {}
+
+    class Store:
+        def put_encoding(self, student_id, encoding):
+            mirrored[student_id] = encoding
+
+    monkeypatch.setattr(enrollment_service, "get_local_store", lambda: Store())
+    gallery_service.set_gallery(gallery_service.build_gallery([], {}))
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            report = list(enrollment_service.enroll_images("admin-a", sources, client=fake, workers=2, executor=pool))
+        # Enrolled students verify against the new encodings without waiting for a refresh.
+        assert gallery_service.get_gallery().get("stu-3")[0] == pytest.approx(0.5)
+        assert gallery_service.get_gallery().admin_of("stu-3") == "admin-a"
+        assert sorted(mirrored) == ["stu-1", "stu-2", "stu-3"]
+        logged = (tmp_path / "gallery" / gallery_service.CHANGES_FILE).read_text().split()
+        assert sorted(logged[1::2]) == ["stu-1", "stu-2", "stu-3"]
+    finally:
+        gallery_service.set_gallery(None)
+
+    summary = report[-1]
+    assert summary == {"summary": True, "total": 7, "enrolled": 3, "failed": 4}
+    by_file = {entry["file"]: entry for entry in report[:-1]}
+    assert by_file["r2.JPG"]["student_id"] == "stu-2"
+    assert by_file["R9.jpg"]["error_code"] == "UNKNOWN_STUDENT"
+    assert by_file["R1.png"]["error_code"] == "DUPLICATE_FILE"
+    assert by_file["R4.jpg"]["success"] is False
+    assert sorted(r["student_id"] for r in tables["face_encodings"]) == ["stu-1", "stu-2", "stu-3"]
+    assert [n for _, n in tables["_upserts"]] == [2, 1]
+    # The pool's CPU is charged to the uploading admin, failed encodings included.
+    usage = scheduler.usage("admin-a")["admin-a"]
+    assert usage["cpu_seconds"] == pytest.approx(1.75)
+
+
+def test_bulk_enroll_endpoint_streams_ndjson(client, monkeypatch):
+    import io
+    import json
+    import zipfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    fake = FakeSupabase(
+        tables={
+            "admins": [{"id": "admin-a", "user_id": "user-1"}],
+            "students": [{"id": "stu-1", "admin_id": "admin-a", "roll_number": "R1"}],
+        }
+    )
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(enrollment_service, "_encode_file", _fake_encode_file)
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(
+        app_module,
+        "enroll_images",
+        lambda admin_id, sources, client: enrollment_service.enroll_images(
+            admin_id, sources, client=client, executor=pool
+        ),
+    )
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as archive:
+        archive.writestr("R1.jpg", b"img")
+        archive.writestr("R2.jpg", b"no-face")
+        archive.writestr("notes.txt", b"ignored")
+    resp = client.post(
+        "/api/v1/students/enroll/bulk",
+        files={"archive": ("intake.zip", buf.getvalue(), "application/zip")},
+    )
+    pool.shutdown()
+    assert resp.status_code == 200
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    by_file = {line["file"]: line for line in lines[:-1]}
+    assert by_file["R1.jpg"]["success"] is True
+    assert by_file["R2.jpg"]["error_code"] == "UNKNOWN_STUDENT"
+    assert lines[-1] == {"summary": True, "total": 2, "enrolled": 1, "failed": 1}
+
+    not_zip = client.post(
+        "/api/v1/students/enroll/bulk",
+        files={"archive": ("intake.zip", b"plain bytes", "application/zip")},
+    )
+    assert not_zip.status_code == 400
+
+
+def test_iter_zip_images_reports_damaged_entries_and_keeps_going():
+    import io
+    import zipfile
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as archive:
+        archive.writestr("R1.jpg", b"first-image")
+        archive.writestr("R2.jpg", b"second-image")
+    data = bytearray(buf.getvalue())
+    at = data.find(b"first-image")
+    data[at:at + 5] = b"XXXXX"  # CRC no longer matches
+
+    entries = list(enrollment_service.iter_zip_images(io.BytesIO(bytes(data))))
+    assert entries == [
+        ("R1.jpg", None, "Invalid image: corrupt archive entry"),
+        ("R2.jpg", b"second-image", None),
+    ]
+
+
+class _FakeFaceRecognition:
+    """Detects one face whose box follows a bright square in the frame."""
+
+    def __init__(self):
+        self.encoded = 0
+
+    def face_locations(self, image, model="hog"):
+        import numpy as np
+
+        ys, xs = np.nonzero(image[:, :, 0] > 200)
+        if not len(xs):
+            return []
+        return [(int(ys.min()), int(xs.max()), int(ys.max()), int(xs.min()))]
+
+    def face_encodings(self, image, locations):
+        import numpy as np
+
+        self.encoded += len(locations)
+        return [np.full(128, 0.1) for _ in locations]
+
+
+def test_stream_session_skips_static_frames_and_encodes_each_track_once(monkeypatch):
+    import numpy as np
+
+    fake_fr = _FakeFaceRecognition()
+    monkeypatch.setattr(stream_service, "get_face_recognition", lambda: fake_fr)
+    marks = []
+    monkeypatch.setattr(
+        stream_service,
+        "mark_student_attendance",
+        lambda student_id, confidence, subject: marks.append(student_id) or (True, "ATTENDANCE_MARKED", ""),
+    )
+    gallery = gallery_service.build_gallery(
+        [{"student_id": "stu-1", "encoding": [0.1] * 128}], {"stu-1": "admin-a"}
+    )
+    session = stream_service.StreamAttendanceSession("admin-a", gallery=gallery)
+    session.detector = SimpleNamespace(detect=fake_fr.face_locations)
+
+    for step in range(20):
+        frame = np.zeros((240, 320, 3), dtype=np.uint8)
+        x = 40 + (step // 5) * 6  # the face drifts a little every 5 frames
+        frame[60:140, x:x + 80] = 255
+        session.process_frame(frame)
+
+    summary = session.summary()
+    assert summary["frames_received"] == 20
+    assert summary["frames_processed"] < 20
+    assert fake_fr.encoded == 1
+    assert marks == ["stu-1"]
+    assert summary["students"][0]["student_id"] == "stu-1"
+
+
+def test_mjpeg_splitter_handles_frames_split_across_chunks():
+    import base64
+
+    jpeg = base64.b64decode(_jpeg_data_url(64, 48).split(",", 1)[1])
+    stream = b"--frame\r\n" + jpeg + b"\r\n--frame\r\n" + jpeg + b"\r\n"
+    chunks = [stream[i:i + 100] for i in range(0, len(stream), 100)]
+    frames = list(stream_service.iter_mjpeg_frames(chunks))
+    assert len(frames) == 2
+    assert frames[0].shape == (48, 64, 3)
+
+
+def test_stream_frames_respect_the_image_pixel_limits(tmp_path, monkeypatch):
+    import base64
+    import io
+
+    import cv2
+    import numpy as np
+    import pytest
+
+    jpeg = base64.b64decode(_jpeg_data_url(64, 48).split(",", 1)[1])
+    path = str(tmp_path / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for _ in range(3):
+        writer.write(np.zeros((48, 64, 3), dtype=np.uint8))
+    writer.release()
+    assert len(list(stream_service.iter_clip_frames(path))) == 3
+    with pytest.raises(stream_service.ClipTooLarge):
+        next(stream_service.iter_clip_frames(path, max_seconds=0.1))  # 3 frames at 10 fps
+    target = io.BytesIO()
+    assert stream_service.save_clip(io.BytesIO(b"x" * 10), target, max_bytes=10, chunk_size=4) == 10
+    with pytest.raises(stream_service.ClipTooLarge):
+        stream_service.save_clip(io.BytesIO(b"x" * 11), io.BytesIO(), max_bytes=10, chunk_size=4)
+
+    monkeypatch.setattr(face_service, "MAX_IMAGE_PIXELS", 1000)
+    splitter = stream_service.MjpegSplitter()
+    assert splitter.feed(jpeg + jpeg) == [] and splitter.rejected == 2
+    with pytest.raises(stream_service.FrameTooLarge):
+        next(stream_service.iter_clip_frames(path))
+
+
+def _textured_face(size=200, brightness=128):
+    import numpy as np
+
+    rng = np.random.default_rng(3)
+    noise = rng.integers(-60, 60, size=(size, size, 1))
+    return np.clip(brightness + noise, 0, 255).astype(np.uint8).repeat(3, axis=2)
+
+
+def test_quality_gate_rejects_small_dark_blurry_and_turned_faces():
+    import cv2
+
+    box = (0, 200, 200, 0)
+    assert face_service.assess_face_quality(_textured_face(), box) is None
+    assert face_service.assess_face_quality(_textured_face(), (0, 40, 40, 0)).startswith("Face too small")
+    assert face_service.assess_face_quality(_textured_face(brightness=20), box).startswith("Poor lighting")
+    blurred = cv2.GaussianBlur(_textured_face(), (31, 31), 12)
+    assert face_service.assess_face_quality(blurred, box).startswith("Face image too blurry")
+
+    frontal = {"left_eye": [(60, 80), (80, 80)], "right_eye": [(120, 80), (140, 80)], "nose_tip": [(100, 120)]}
+    turned = dict(frontal, nose_tip=[(135, 120)])
+    assert face_service.assess_face_quality(_textured_face(), box, frontal) is None
+    assert face_service.assess_face_quality(_textured_face(), box, turned).startswith("Face not facing camera")
+
+
+def _smooth_face(size=200):
+    import numpy as np
+
+    rng = np.random.default_rng(5)
+    yy, xx = np.mgrid[0:size, 0:size]
+    face = 100 + 50 * np.sin(xx / 30.0) * np.cos(yy / 25.0) + rng.normal(0, 4, (size, size))
+    return np.clip(face, 0, 255).astype(np.uint8)[..., None].repeat(3, axis=2)
+
+
+def test_liveness_flags_flat_and_screen_texture_and_needs_burst_motion():
+    import cv2
+    import numpy as np
+
+    box = (0, 200, 200, 0)
+    live = face_service.assess_liveness(_smooth_face(), box)
+    assert live["live"] is True and live["frames"] == 1
+    assert live["duration_ms"] < 50
+
+    printed = cv2.GaussianBlur(_smooth_face(), (15, 15), 6)
+    assert face_service.assess_liveness(printed, box)["reason"] == "flat texture"
+    stripes = 40 * np.sin(2 * np.pi * 0.37 * np.arange(200))[None, :, None]
+    screen = np.clip(_textured_face() + stripes, 0, 255).astype(np.uint8)
+    assert face_service.assess_liveness(screen, box)["reason"] == "screen pattern"
+
+    marks = {"left_eye": [(60, 80), (80, 80)], "right_eye": [(120, 80), (140, 80)], "nose_tip": [(100, 120)]}
+    frame = _smooth_face()
+    # The same still image three times: no blink, no movement.
+    still = face_service.assess_liveness(frame, box, marks, [(frame, marks), (frame, marks)])
+    assert (still["live"], still["reason"], still["blink"], still["motion"]) == (False, "no blink or motion", False, 0.0)
+
+    closed = frame.copy()
+    closed[70:91, 50:91] = 110
+    closed[70:91, 110:151] = 110
+    blink = face_service.assess_liveness(frame, box, marks, [(closed, marks), (frame, marks)])
+    assert blink["blink"] is True and blink["live"] is True
+
+    turned = dict(marks, nose_tip=[(103, 120)])
+    moved = face_service.assess_liveness(frame, box, marks, [(frame, turned)])
+    assert moved["motion"] == pytest.approx(0.05) and moved["live"] is True
+
+
+def test_verify_returns_liveness_alongside_the_match(client, monkeypatch):
+    liveness = {"live": True, "reason": None, "frames": 3, "blink": True}
+    seen = []
+
+    def verify(student_id, image, burst, phash=None, admin_id=None):
+        seen.append(burst)
+        return True, 91.0, "Match found", liveness
+
+    monkeypatch.setattr(app_module, "verify_student_face", verify)
+    resp = client.post("/verify_face", json={"student_id": "stu-1", "image": "frame", "burst": ["f2", "f3"]})
+    assert resp.status_code == 200
+    assert resp.json()["liveness"] == liveness
+    assert seen == [["f2", "f3"]]
+
+
+def test_quality_rejections_map_to_specific_error_codes(client, monkeypatch):
+    cases = {
+        "Face too small: move closer to the camera": "FACE_TOO_SMALL",
+        "Face image too blurry: hold still": "FACE_BLURRY",
+        "Poor lighting: face too dark": "POOR_LIGHTING",
+        "Face not facing camera: head turned": "FACE_POSE",
+        "Liveness check failed: flat texture": "LIVENESS_FAILED",
+    }
+    for message, error_code in cases.items():
+        monkeypatch.setattr(app_module, "verify_student_face", lambda *_, m=message: (False, 0.0, m, None))
+        resp = client.post("/verify_face", json={"student_id": "stu-1", "image": "frame"})
+        assert resp.status_code == 400
+        assert resp.json()["error_code"] == error_code
+
+    metrics = client.get("/api/v1/metrics").json()
+    assert "rejected_total" in metrics["face_quality"]
+
+
+def test_quality_refusals_followed_by_a_match_count_as_retries_avoided(monkeypatch):
+    monkeypatch.setattr(face_service, "replay_cache_enabled", lambda: False)
+    monkeypatch.setattr(face_service, "_quality_refused", face_service.OrderedDict())
+    outcomes = {
+        "blurry": (False, 0.0, "Face image too blurry: hold still", None),
+        "mismatch": (False, 30.0, "Face does not match", None),
+        "match": (True, 91.0, "Match found", None),
+    }
+    monkeypatch.setattr(face_service, "_verify_student_face", lambda student_id, image, *_: outcomes[image])
+    before = face_service.get_quality_stats()["retries_avoided"]
+
+    for student_id, attempts in {
+        "stu-1": ["blurry", "blurry", "match", "match"],  # one avoided, however many refusals it took
+        "stu-2": ["mismatch", "match"],  # not the gate's doing
+        "stu-3": ["blurry", "mismatch", "match"],  # the retry after the refusal still failed
+    }.items():
+        for image in attempts:
+            face_service.verify_student_face(student_id, image)
+    assert face_service.get_quality_stats()["retries_avoided"] == before + 1
+
+    monkeypatch.setattr(face_service, "QUALITY_RETRY_WINDOW_SECONDS", -1)
+    face_service.verify_student_face("stu-4", "blurry")
+    face_service.verify_student_face("stu-4", "match")
+    assert face_service.get_quality_stats()["retries_avoided"] == before + 1
+
+
+def test_detector_selection_falls_back_and_honours_admin_overrides(monkeypatch, tmp_path):
+    monkeypatch.setattr(detector_service, "_DETECTORS", {})
+    monkeypatch.setattr(detector_service, "_ADMIN_DETECTORS", {})
+    monkeypatch.setattr(detector_service, "YUNET_MODEL_PATH", str(tmp_path / "missing.onnx"))
+
+    assert detector_service.get_detector("hog").name == "hog"
+    assert detector_service.get_detector("yunet").name == "hog"  # model missing -> fallback
+    assert detector_service.get_detector("auto").name == "hog"
+    with pytest.raises(RuntimeError, match="missing.onnx|FaceDetectorYN"):
+        detector_service.YuNetDetector()
+
+    detector_service.set_admin_detector("admin-a", "cnn")
+    assert detector_service.get_admin_detector("admin-a").name == "cnn"
+    used = []
+    monkeypatch.setattr(face_service, "decode_image_checked", lambda _image: (object(), None))
+    monkeypatch.setattr(
+        face_service, "_encode_face", lambda _image, detector=None: used.append(detector.name) or (None, None, None, "x")
+    )
+    face_service._verify_student_face("stu-1", "img", None, "admin-a")
+    face_service._verify_student_face("stu-2", "img", None, "admin-b")
+    assert used == ["cnn", detector_service.get_detector().name]  # verification uses the enrolment detector
+    assert detector_service.get_admin_detector("admin-b").name == detector_service.get_detector().name
+    with pytest.raises(ValueError):
+        detector_service.set_admin_detector("admin-a", "magic")
+
+
+def test_detector_benchmark_recommends_fastest_with_comparable_recall():
+    results = {
+        "hog": {"mean_ms": 48.0, "p95_ms": 60.0, "detection_rate": 0.90, "faces": 90},
+        "yunet": {"mean_ms": 9.0, "p95_ms": 12.0, "detection_rate": 0.91, "faces": 92},
+        "cnn": {"mean_ms": 900.0, "p95_ms": 990.0, "detection_rate": 0.97, "faces": 98},
+    }
+    assert detector_service.recommend(results) == "cnn"
+    assert detector_service.recommend(results, tolerance=0.1) == "yunet"
+    assert detector_service.recommend({"yunet": {"error": "missing"}}) is None
+
+
+def test_write_behind_buffer_dedups_locally_and_flushes_in_bulk(tmp_path):
+    tables = {}
+    fake = FakeSupabase(tables=tables)
+    path = str(tmp_path / "buffer.db")
+    buffer = attendance_service.AttendanceWriteBuffer(path=path, client_factory=lambda: fake, flush_max_rows=2)
+    today = time.strftime("%Y-%m-%d")
+
+    row = {"student_id": "stu-1", "admin_id": "admin-a", "date": today, "status": "present"}
+    assert buffer.enqueue(dict(row, subject="Math")) is True
+    assert buffer.enqueue(dict(row, subject="Math")) is False
+    assert buffer.enqueue(dict(row, subject="Physics")) is True
+    assert buffer.enqueue(dict(row)) is False  # no subject: any row that day counts
+    assert buffer.enqueue_many([dict(row, student_id="stu-2"), dict(row, student_id="stu-3")]) == [True, True]
+    assert buffer.pending_count() == 4
+    assert tables.get("attendance") is None  # nothing sent until a flush
+
+    assert buffer.flush() == 4
+    assert tables["_inserts"] == [("attendance", 2), ("attendance", 2)]
+    assert buffer.pending_count() == 0
+    assert buffer.contains("stu-1", today, "Math")  # still deduplicated after flushing
+    buffer._conn.close()
+
+
+def test_write_behind_buffer_replays_unflushed_rows_after_restart(tmp_path):
+    tables = {}
+    path = str(tmp_path / "buffer.db")
+    today = time.strftime("%Y-%m-%d")
+
+    def down():
+        raise RuntimeError("supabase unreachable")
+
+    first = attendance_service.AttendanceWriteBuffer(path=path, client_factory=down)
+    first.enqueue({"student_id": "stu-1", "admin_id": "admin-a", "date": today})
+    assert first.flush() == 0
+    first._conn.close()  # simulated crash: no clean shutdown flush
+
+    second = attendance_service.AttendanceWriteBuffer(path=path, client_factory=lambda: FakeSupabase(tables=tables))
+    assert second.pending_count() == 1
+    assert second.flush() == 1
+    assert tables["attendance"][0]["student_id"] == "stu-1"
+    second.close()
+
+
+def test_app_startup_opens_the_write_buffer(monkeypatch):
+    opened = []
+    monkeypatch.setattr(app_module, "get_write_buffer", lambda: opened.append(1))
+    with TestClient(app_module.app):
+        assert opened == [1]
+
+
+def test_mark_student_attendance_acknowledges_from_write_buffer(tmp_path, monkeypatch):
+    tables = {"students": [{"id": "stu-1", "admin_id": "admin-a"}]}
+    fake = FakeSupabase(tables=tables)
+    monkeypatch.setattr(attendance_service, "get_supabase_client", lambda: fake)
+    buffer = attendance_service.AttendanceWriteBuffer(path=str(tmp_path / "b.db"), client_factory=lambda: fake)
+    monkeypatch.setattr(attendance_service, "get_write_buffer", lambda: buffer)
+
+    assert attendance_service.mark_student_attendance("stu-1", 90.0)[1] == "ATTENDANCE_MARKED"
+    assert "attendance" not in tables
+    assert attendance_service.mark_student_attendance("stu-1", 90.0)[1] == "DUPLICATE_ATTENDANCE"
+    buffer.close()
+    assert len(tables["attendance"]) == 1
+
+
+def test_local_store_serves_offline_and_reconciles_dirty_rows(tmp_path):
+    import numpy as np
+
+    stored = [0.1] * 128
+    tables = {
+        "students": [{"id": "stu-1", "admin_id": "admin-a", "name": "A", "roll_number": "1"}],
+        "face_encodings": [{"student_id": "stu-1", "encoding": stored}, {"student_id": "stu-2", "encoding": stored}],
+    }
+    online = {"up": True}
+
+    def client_factory():
+        if not online["up"]:
+            raise RuntimeError("supabase unreachable")
+        return FakeSupabase(tables=tables)
+
+    store = local_store_service.LocalStore(path=str(tmp_path / "local.db"), client_factory=client_factory)
+    assert store.sync() is True
+    assert store.get_student("stu-1")["admin_id"] == "admin-a"
+    assert store.get_encoding("stu-1").tolist() == stored
+
+    online["up"] = False
+    store.put_encoding("stu-3", np.full(128, 0.2), dirty=True)
+    store.delete_encoding("stu-2", dirty=True)
+    assert store.sync() is False
+    assert store.status()["dirty_encodings"] == 2
+    assert store.get_encoding("stu-2") is None  # tombstoned locally
+
+    online["up"] = True
+    assert store.sync() is True
+    assert store.dirty_count() == 0
+    assert sorted(r["student_id"] for r in tables["face_encodings"]) == ["stu-1", "stu-3"]
+    assert store.get_encoding("stu-3").tolist() == [0.2] * 128
+    store.close()
+
+
+def test_local_store_offline_fallback_is_scoped_and_honours_tombstones(tmp_path, monkeypatch):
+    import numpy as np
+
+    tables = {
+        "students": [{"id": "stu-1", "admin_id": "admin-a"}, {"id": "stu-9", "admin_id": "admin-b"}],
+        "face_encodings": [{"student_id": sid, "encoding": [0.1] * 128} for sid in ("stu-1", "stu-9")],
+    }
+    store = local_store_service.LocalStore(
+        path=str(tmp_path / "local.db"), client_factory=lambda: FakeSupabase(tables=tables), admin_id="admin-a"
+    )
+    assert store.sync() is True
+    assert store.get_student("stu-9") is None and store.get_encoding("stu-9") is None
+    assert store.lookup_encoding("stu-9") == (False, None)
+
+    failure = {"error": ConnectionError("supabase unreachable")}
+
+    def table(_name):
+        raise failure["error"]
+
+    monkeypatch.setattr(face_service, "get_local_store", lambda: store)
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: SimpleNamespace(table=table))
+    monkeypatch.setattr(face_service, "decode_image_checked", lambda _image: (object(), None))
+    monkeypatch.setattr(face_service, "get_face_encoding", lambda *_args: (np.full(128, 0.2), None))
+    monkeypatch.setattr(face_service, "_encode_face", lambda *_args: (np.full(128, 0.1), (0, 1, 1, 0), None, None))
+    monkeypatch.setattr(face_service, "LIVENESS_MODE", "off")
+
+    assert face_service.register_student_face("stu-2", "img", admin_id="admin-a")[0] is True
+    assert face_service.register_student_face("stu-8", "img", admin_id="admin-b")[0] is False  # not this kiosk's
+    failure["error"] = ValueError("duplicate key")  # Supabase answered: not an outage
+    assert face_service.register_student_face("stu-3", "img", admin_id="admin-a")[0] is False
+    assert store.dirty_count() == 1
+
+    failure["error"] = ConnectionError("supabase unreachable")
+    assert face_service.delete_student_face("stu-1", "admin-a")[0] is True
+    # The tombstone answers, rather than falling through to Supabase.
+    assert face_service._verify_student_face("stu-1", "img")[2] == "Face not registered for this student"
+    store.close()
+
+
+def test_local_store_marks_without_remote_reads_and_drops_flush_conflicts(tmp_path, monkeypatch):
+    today = time.strftime("%Y-%m-%d")
+    tables = {
+        "students": [{"id": "stu-1", "admin_id": "admin-a"}, {"id": "stu-2", "admin_id": "admin-a"}],
+        "attendance": [],
+    }
+    fake = FakeSupabase(tables=tables)
+    store = local_store_service.LocalStore(path=str(tmp_path / "local.db"), client_factory=lambda: fake)
+    store.sync()
+    buffer = attendance_service.AttendanceWriteBuffer(path=str(tmp_path / "b.db"), client_factory=lambda: fake)
+    monkeypatch.setattr(attendance_service, "get_local_store", lambda: store)
+    monkeypatch.setattr(attendance_service, "get_write_buffer", lambda: buffer)
+
+    def unreachable(_table):
+        raise RuntimeError("supabase unreachable")
+
+    monkeypatch.setattr(attendance_service, "get_supabase_client", lambda: SimpleNamespace(table=unreachable))
+    assert attendance_service.mark_student_attendance("stu-1", 90.0, "Math")[1] == "ATTENDANCE_MARKED"
+    assert attendance_service.mark_student_attendance("stu-2", 90.0, "Math")[1] == "ATTENDANCE_MARKED"
+
+    # Meanwhile another kiosk recorded stu-1 for Math.
+    tables["attendance"].append({"student_id": "stu-1", "date": today, "subject": "Math"})
+    assert buffer.flush() == 1
+    assert buffer.conflicts_dropped == 1
+    assert sorted(r["student_id"] for r in tables["attendance"]) == ["stu-1", "stu-2"]
+
+    # Remote marks are seeded into the buffer for local duplicate checks.
+    tables["attendance"].append({"student_id": "stu-9", "date": today, "subject": "Math"})
+    assert buffer.sync_remote_today() == 1
+    assert buffer.contains("stu-9", today, "Math")
+    buffer.close()
+    store.close()
+
+
+def test_attendance_history_pages_by_cursor_with_filters_and_etag(client, monkeypatch):
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    rows = [
+        {
+            "id": i,
+            "admin_id": "admin-a",
+            "student_id": f"stu-{i % 3}",
+            "date": f"2026-03-{10 + i // 4:02d}",
+            "subject": "Math" if i % 2 else "Physics",
+            "status": "present",
+        }
+        for i in range(1, 21)
+    ]
+    rows.append(dict(rows[0], id=99, admin_id="admin-b"))
+    fake = FakeSupabase(tables={"attendance": rows, "admins": [{"id": "admin-a", "user_id": "user-1"}]})
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 6, "fields": "status"}
+        if cursor:
+            params["cursor"] = cursor
+        body = client.get("/api/v1/attendance", params=params).json()
+        seen.extend(body["records"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            break
+    expected = sorted(range(1, 21), key=lambda i: (rows[i - 1]["date"], i), reverse=True)
+    assert [r["id"] for r in seen] == expected
+
+    params = {"student_id": "stu-1", "subject": "Math", "date_from": "2026-03-11", "date_to": "2026-03-13"}
+    filtered = client.get("/api/v1/attendance", params=params)
+    records = filtered.json()["records"]
+    assert records and {(r["student_id"], r["subject"]) for r in records} == {("stu-1", "Math")}
+    assert all("2026-03-11" <= r["date"] <= "2026-03-13" for r in records)
+
+    again = client.get("/api/v1/attendance", params=params, headers={"If-None-Match": filtered.headers["etag"]})
+    assert again.status_code == 304
+
+    assert client.get("/api/v1/attendance", params={"cursor": "bm90LWEtY3Vyc29y"}).json()["error_code"] == "INVALID_CURSOR"
+    assert client.get("/api/v1/attendance", params={"fields": "password"}).status_code == 400
+
+
+def test_statistics_and_exports_are_cached_until_the_admin_data_version_changes(client, monkeypatch):
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    tables = {
+        "admins": [{"id": "admin-a", "user_id": "user-1"}],
+        "students": [{"id": "stu-1", "admin_id": "admin-a", "name": "A", "roll_number": "1"}],
+        "attendance": [{"id": 1, "student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-10", "confidence": 90}],
+    }
+    fake = FakeSupabase(tables=tables)
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(attendance_service, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(attendance_service, "get_write_buffer", lambda: None)
+
+    first = client.get("/api/v1/statistics")
+    assert first.json()["total_attendance_records"] == 1
+    etag = first.headers["etag"]
+
+    tables["attendance"].append({"id": 2, "student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-11"})
+    assert client.get("/api/v1/statistics").json()["total_attendance_records"] == 1  # served from cache
+    assert client.get("/api/v1/statistics", headers={"If-None-Match": etag}).status_code == 304
+
+    csv_resp = client.get("/api/v1/export/csv")
+    assert csv_resp.headers["content-type"].startswith("text/csv")
+    assert client.get("/api/v1/export/csv", headers={"If-None-Match": csv_resp.headers["etag"]}).status_code == 304
+
+    assert attendance_service.mark_student_attendance("stu-1", 95.0, "Math")[0] is True
+    fresh = client.get("/api/v1/statistics", headers={"If-None-Match": etag})
+    assert fresh.status_code == 200
+    assert fresh.json()["total_attendance_records"] == 3
+    assert fresh.headers["etag"] != etag
+    assert cache_service.get_response_cache().hits == 3
+
+
+def test_response_cache_etags_match_across_workers_and_versions():
+    # Two caches stand in for two workers; a version bump doesn't change the tag of an unchanged body.
+    first, second = cache_service.ResponseCache(), cache_service.ResponseCache()
+    tag = first.put(cache_service.ResponseCache.key("admin-a", "statistics"), b"{}", "application/json").etag
+    cache_service.bump_data_version("admin-a")
+    assert second.put(cache_service.ResponseCache.key("admin-a", "statistics"), b"{}", "application/json").etag == tag
+    assert first.put(("admin-a", "export", (), 0), b"{}", "text/csv").etag != tag
+    assert first.put(("admin-a", "statistics", (), 0), b"{ }", "application/json").etag != tag
+
+
+def test_compression_is_negotiated_and_skips_small_bodies(client, monkeypatch):
+    assert response_service.choose_encoding("gzip, br;q=0.5", ["zstd", "br", "gzip"]) == "gzip"
+    assert response_service.choose_encoding("*", ["zstd", "br", "gzip"]) == "zstd"
+    assert response_service.choose_encoding("gzip;q=0, identity", ["gzip"]) is None
+
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    tables = {
+        "admins": [{"id": "admin-a", "user_id": "user-1"}],
+        "students": [{"id": "stu-1", "admin_id": "admin-a", "name": "Asha", "roll_number": "CS-1"}],
+        "attendance": [
+            {
+                "id": i,
+                "student_id": "stu-1",
+                "admin_id": "admin-a",
+                "date": f"2026-03-{1 + i % 28:02d}",
+                "status": "present",
+                "confidence": 91.5,
+            }
+            for i in range(200)
+        ],
+    }
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: FakeSupabase(tables=tables))
+
+    plain = client.get("/api/v1/export/csv", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    for encoding in response_service.available_encodings():
+        resp = client.get("/api/v1/export/csv", headers={"Accept-Encoding": encoding})
+        assert resp.headers["content-encoding"] == encoding
+        assert "Accept-Encoding" in resp.headers["vary"]
+        assert int(resp.headers["content-length"]) < len(plain.content) / 3
+        assert resp.content == plain.content  # transparently decoded by the client
+
+    small = client.get("/api/v1/health", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    assert small.json()["live"] is True
+
+
+def test_compression_streams_chunked_responses():
+    import asyncio
+    import zlib
+
+    async def streaming_app(scope, receive, send):
+        headers = [(b"content-type", b"application/x-ndjson")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for i in range(3):
+            await send({"type": "http.response.body", "body": b'{"n": %d}\n' % i, "more_body": i < 2})
+
+    sent = []
+
+    async def capture(message):
+        sent.append(message)
+
+    scope = {"type": "http", "headers": [(b"accept-encoding", b"gzip")]}
+    middleware = response_service.CompressionMiddleware(streaming_app)
+    asyncio.run(middleware(scope, None, capture))
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and b"content-length" not in headers
+    decoder = zlib.decompressobj(31)
+    # Every chunk decodes on its own as it arrives.
+    assert decoder.decompress(sent[1]["body"]) == b'{"n": 0}\n'
+    rest = b"".join(decoder.decompress(m["body"]) for m in sent[2:])
+    assert rest == b'{"n": 1}\n{"n": 2}\n'
+
+
+def test_compression_of_large_bodies_runs_off_the_event_loop(monkeypatch):
+    import asyncio
+    import threading
+    import zlib
+
+    threads = []
+    original = response_service._Gzip.compress
+
+    def compress(self, data):
+        threads.append(threading.get_ident())
+        return original(self, data)
+
+    monkeypatch.setattr(response_service._Gzip, "compress", compress)
+    big, small = b'{"n": 1}\n' * 2000, b'{"n": 2}\n' * 200
+
+    async def streaming_app(scope, receive, send):
+        headers = [(b"content-type", b"application/x-ndjson")]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": big, "more_body": True})
+        await send({"type": "http.response.body", "body": small, "more_body": False})
+
+    sent = []
+
+    async def capture(message):
+        sent.append(message)
+
+    async def run():
+        middleware = response_service.CompressionMiddleware(streaming_app, thread_size=len(big))
+        await middleware({"type": "http", "headers": [(b"accept-encoding", b"gzip")]}, None, capture)
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+    assert threads[0] != loop_thread and threads[1] == loop_thread
+    assert zlib.decompress(b"".join(m["body"] for m in sent[1:]), 31) == big + small
+
+
+def test_analytics_rates_streaks_and_at_risk_students(client, monkeypatch):
+    rows = [
+        # stu-1: present all four days; stu-2 misses 03-11; stu-3 only the first day.
+        *({"student_id": "stu-1", "date": d, "subject": "Math"} for d in ("2026-03-10", "2026-03-11", "2026-03-12")),
+        {"student_id": "stu-1", "date": "2026-03-13", "subject": "Physics"},
+        {"student_id": "stu-1", "date": "2026-03-13", "subject": "Physics"},  # duplicate mark
+        *({"student_id": "stu-2", "date": d, "subject": "Math"} for d in ("2026-03-10", "2026-03-12")),
+        {"student_id": "stu-2", "date": "2026-03-13", "subject": None},
+        {"student_id": "stu-3", "date": "2026-03-10", "subject": "Math"},
+        {"student_id": "gone", "date": "2026-03-10", "subject": "Math"},  # deleted student
+    ]
+    frame = analytics_service.AttendanceFrame.from_rows(rows, ["stu-1", "stu-2", "stu-3"])
+    result = analytics_service.compute_analytics(frame, at_risk_percent=60)
+
+    by_student = {entry["student_id"]: entry for entry in result["per_student"]}
+    assert result["total_days"] == 4
+    assert [e["student_id"] for e in result["per_student"]] == ["stu-1", "stu-2", "stu-3"]
+    assert by_student["stu-1"] == {
+        "student_id": "stu-1",
+        "name": "N/A",
+        "roll_number": "N/A",
+        "days_present": 4,
+        "attendance_rate": 100.0,
+        "current_streak": 4,
+        "longest_streak": 4,
+    }
+    assert (by_student["stu-2"]["current_streak"], by_student["stu-2"]["longest_streak"]) == (2, 2)
+    assert by_student["stu-3"]["current_streak"] == 0
+    assert [e["student_id"] for e in result["at_risk_students"]] == ["stu-3"]
+    assert [d["present"] for d in result["per_day"]] == [3, 1, 2, 2]
+    assert result["overall_attendance_rate"] == round(8 * 100 / 12, 2)
+    math = next(s for s in result["per_subject"] if s["subject"] == "Math")
+    assert (math["sessions"], math["marks"], math["attendance_rate"]) == (3, 6, round(6 * 100 / 9, 2))
+
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    tables = {
+        "admins": [{"id": "admin-a", "user_id": "user-1"}],
+        "students": [{"id": sid, "admin_id": "admin-a", "name": sid, "roll_number": sid} for sid in by_student],
+        "attendance": [dict(row, admin_id="admin-a") for row in rows],
+    }
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: FakeSupabase(tables=tables))
+    queries = []
+
+    def fetch(client, table, fields, filters=None):
+        queries.append((table, filters))
+        return gallery_service.fetch_all_rows(client, table, fields, filters)
+
+    monkeypatch.setattr(analytics_service, "fetch_all_rows", fetch)
+    resp = client.get("/api/v1/analytics", params={"date_from": "2026-03-11", "at_risk_below": 50})
+    body = resp.json()
+    assert resp.status_code == 200 and body["total_days"] == 3
+    assert [e["student_id"] for e in body["at_risk_students"]] == ["stu-3"]
+    # The range is filtered in the query, not after fetching every row.
+    assert ("attendance", [("admin_id", "admin-a"), ("date", "gte", "2026-03-11")]) in queries
+
+
+def test_analytics_frame_drops_rows_with_malformed_dates():
+    rows = [
+        {"student_id": "stu-1", "date": "2026-03-10"},
+        {"student_id": "stu-1", "date": "10/03/2026"},
+        {"student_id": "stu-2", "date": "2026-03-11"},
+        {"student_id": "stu-2", "date": None},
+        {"student_id": "stu-2", "date": "not a date"},
+    ]
+    frame = analytics_service.AttendanceFrame.from_rows(rows, ["stu-1", "stu-2"])
+    assert len(frame) == 2
+    assert frame.days.astype(str).tolist() == ["2026-03-10", "2026-03-11"]
+    assert frame.presence().tolist() == [[True, False], [False, True]]
+
+
+def test_admission_control_prioritises_checkins_and_sheds_on_queue_time():
+    import asyncio
+
+    assert admission_service.classify("POST", "/api/v1/mark_attendance") == "checkin"
+    assert admission_service.classify("GET", "/api/v1/export/pdf") == "export"
+    assert admission_service.classify("GET", "/api/v1/statistics") == "admin"
+    assert admission_service.classify("GET", "/api/v1/health/ready") is None
+
+    async def scenario():
+        controller = admission_service.AdmissionController(
+            limits={"checkin": 1, "admin": 1, "export": 1},
+            max_wait={"checkin": 1.0, "admin": 1.0, "export": 0.05},
+        )
+        checkin_started = await controller.acquire("checkin")
+        export_started = await controller.acquire("export")
+
+        queued_checkin = asyncio.ensure_future(controller.acquire("checkin"))
+        queued_export = asyncio.ensure_future(controller.acquire("export"))
+        await asyncio.sleep(0)
+        # The export slot frees up, but a check-in is still waiting: exports hold back.
+        controller.release("export", export_started)
+        with pytest.raises(admission_service.Overloaded) as shed:
+            await queued_export
+        assert shed.value.retry_after >= 1
+
+        controller.release("checkin", checkin_started)
+        controller.release("checkin", await queued_checkin)
+        assert await controller.acquire("export")  # nothing queued ahead any more
+        return controller.stats()["classes"]
+
+    classes = asyncio.run(scenario())
+    assert classes["export"]["shed"] == 1 and classes["export"]["in_flight"] == 1
+    assert (classes["checkin"]["admitted"], classes["checkin"]["in_flight"]) == (2, 0)
+
+
+def test_admission_middleware_answers_503_with_retry_after(client, monkeypatch):
+    class Saturated(admission_service.AdmissionController):
+        async def acquire(self, name):
+            raise admission_service.Overloaded(7)
+
+    monkeypatch.setattr(admission_service, "_controller", Saturated())
+    resp = client.get("/api/v1/statistics")
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "7"
+    assert resp.json()["error_code"] == "SERVICE_OVERLOADED"
+    assert client.get("/api/v1/health").status_code == 200  # exempt
+
+
+def test_tenant_scheduler_round_robins_by_weight_and_enforces_cpu_budget():
+    import threading
+
+    scheduler = tenant_service.TenantScheduler(
+        workers=1, face_concurrency=1, cpu_seconds_per_minute=0, weights={"admin-a": 2}
+    )
+    started, gate, order = threading.Event(), threading.Event(), []
+    try:
+        scheduler.submit("admin-c", lambda: (started.set(), gate.wait(5)))
+        assert started.wait(5)
+        # admin-a floods the queue first; admin-b still gets every third slot.
+        futures = [scheduler.submit("admin-a", order.append, "a") for _ in range(6)]
+        futures += [scheduler.submit("admin-b", order.append, "b") for _ in range(3)]
+        gate.set()
+        for future in futures:
+            future.result(timeout=5)
+        assert order == ["a", "a", "b", "a", "a", "b", "a", "a", "b"]
+        assert scheduler.usage("admin-a")["admin-a"]["jobs"] == {"face": 6}
+    finally:
+        scheduler.close()
+
+    def burn():
+        deadline = time.thread_time() + 0.05
+        while time.thread_time() < deadline:
+            pass
+
+    scheduler = tenant_service.TenantScheduler(workers=2, cpu_seconds_per_minute=0.01)
+    try:
+        scheduler.submit("admin-a", burn).result(timeout=5)
+        with pytest.raises(tenant_service.QuotaExceeded) as excinfo:
+            scheduler.submit("admin-a", burn)
+        assert excinfo.value.reason == "cpu" and 1 <= excinfo.value.retry_after <= 60
+        with pytest.raises(tenant_service.QuotaExceeded):
+            scheduler.acquire_slot("admin-a")
+        # Other tenants and check-ins are unaffected.
+        scheduler.submit("admin-b", burn).result(timeout=5)
+        scheduler.submit("admin-a", burn, kind="checkin", enforce_quota=False).result(timeout=5)
+        usage = scheduler.usage()
+        assert usage["admin-a"]["rejected"] == 2
+        assert usage["admin-a"]["cpu_seconds_last_minute"] >= 0.1
+        assert usage["admin-b"]["rejected"] == 0
+    finally:
+        scheduler.close()
+
+
+def test_admin_over_quota_gets_429_with_retry_after(client, monkeypatch):
+    tables = {
+        "admins": [{"id": "admin-a", "user_id": "user-1"}],
+        "students": [{"id": "stu-1", "admin_id": "admin-a"}],
+    }
+    fake = FakeSupabase(tables=tables)
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(app_module, "register_student_face", lambda *_: (True, "ok"))
+    scheduler = tenant_service.TenantScheduler(workers=2, export_concurrency=1)
+    monkeypatch.setattr(app_module, "get_tenant_scheduler", lambda: scheduler)
+    try:
+        resp = client.post("/api/v1/register_face", json={"student_id": "stu-1", "image": "frame"})
+        assert resp.status_code == 200
+
+        held = scheduler.acquire_slot("admin-a")
+        resp = client.get("/api/v1/export/csv")
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "5"
+        assert resp.json()["error_code"] == "TENANT_QUOTA_EXCEEDED"
+        scheduler.release_slot(held)
+
+        usage = client.get("/api/v1/usage").json()
+        assert usage["jobs"] == {"register": 1, "export": 1}
+        assert usage["rejected"] == 1
+
+        # The unauthenticated metrics only carry totals, never tenant ids.
+        tenants = client.get("/api/v1/metrics").json()["tenants"]
+        assert tenants["tenants"] == 1 and tenants["rejected"] == 1
+        assert "admin-a" not in json.dumps(tenants)
+    finally:
+        scheduler.close()
+
+
+def test_releasing_streaming_response_releases_when_the_client_is_gone():
+    import asyncio
+
+    released = []
+
+    def body():
+        yield b"never sent"
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(_message):
+        raise OSError("client went away")
+
+    response = response_service.ReleasingStreamingResponse(body(), lambda: released.append(True))
+    with pytest.raises(Exception):
+        asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+    assert released == [True]
+
+
+def test_roster_bitsets_give_absentees_and_register_without_refetching(tmp_path, monkeypatch):
+    from datetime import date
+
+    monkeypatch.delenv("ATTENDANCE_LECTURE_DAYS", raising=False)
+    monkeypatch.setenv("ATTENDANCE_HOLIDAYS", "2026-03-05")
+    tables = {
+        "students": [
+            {"id": f"stu-{i}", "admin_id": "admin-a", "name": f"S{i}", "roll_number": str(i)} for i in (1, 2, 3)
+        ],
+        "attendance": [
+            {"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-02"},
+            {"student_id": "stu-2", "admin_id": "admin-a", "date": "2026-03-02"},
+            {"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-03"},
+            {"student_id": "stu-3", "admin_id": "admin-a", "date": "2026-03-07"},  # a Saturday make-up class
+            {"student_id": "stu-9", "admin_id": "admin-b", "date": "2026-03-02"},
+        ],
+    }
+    store = roster_service.RosterStore(path=str(tmp_path / "roster.db"))
+    week = (date(2026, 3, 2), date(2026, 3, 8))
+    fake = FakeSupabase(tables=tables)
+    roster = roster_service.load_roster(fake, "admin-a", *week, store=store, today=date(2026, 3, 9))
+
+    assert roster.days == ["2026-03-02", "2026-03-03", "2026-03-04", "2026-03-06", "2026-03-07"]
+    assert [s["student_id"] for s in roster.absentees("2026-03-02")] == ["stu-3"]
+    assert [(row["student_id"], row["marks"]) for row in roster.register()] == [
+        ("stu-1", "PPAAA"),
+        ("stu-2", "PAAAA"),
+        ("stu-3", "AAAAP"),
+    ]
+    assert len(roster.absent_records()) == 11
+
+    # Built days are served from the bitsets alone.
+    def unreachable(_table):
+        raise RuntimeError("supabase unreachable")
+
+    again = roster_service.load_roster(
+        SimpleNamespace(table=unreachable), "admin-a", *week, store=store, today=date(2026, 3, 9)
+    )
+    assert again.register() == roster.register()
+
+    # A student added later is neither present nor absent on earlier days.
+    tables["students"].append({"id": "stu-4", "admin_id": "admin-a", "name": "S4", "roll_number": "4"})
+    today = roster_service.load_roster(
+        FakeSupabase(tables=tables), "admin-a", date(2026, 3, 6), date(2026, 3, 9), store=store, today=date(2026, 3, 9)
+    )
+    assert [(row["student_id"], row["marks"]) for row in today.register()][-1] == ("stu-4", "--A")
+    store.close()
+
+
+def test_roster_backfill_respects_enrolment_and_rebuilds_unsettled_days(tmp_path, monkeypatch):
+    from datetime import date, datetime
+
+    monkeypatch.setenv("ATTENDANCE_LECTURE_DAYS", "mon,tue,wed,thu,fri,sat,sun")
+    monkeypatch.delenv("ATTENDANCE_HOLIDAYS", raising=False)
+    tables = {
+        "students": [
+            {"id": "stu-1", "admin_id": "admin-a", "created_at": "2026-02-01T09:00:00+00:00"},
+            {"id": "stu-2", "admin_id": "admin-a", "created_at": "2026-03-04T10:00:00+00:00"},
+        ],
+        "attendance": [{"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-02"}],
+    }
+    store = roster_service.RosterStore(path=str(tmp_path / "roster.db"))
+    span = (date(2026, 3, 2), date(2026, 3, 5))
+
+    # Built at noon on the 5th, while the 5th was still today.
+    clock = {"now": datetime(2026, 3, 5, 12).timestamp()}
+    monkeypatch.setattr(roster_service, "time", SimpleNamespace(time=lambda: clock["now"]))
+    roster = roster_service.load_roster(FakeSupabase(tables=tables), "admin-a", *span, store=store, today=span[1])
+    assert [(row["student_id"], row["marks"]) for row in roster.register()] == [("stu-1", "PAAA"), ("stu-2", "--AA")]
+
+    # A late mark for the 5th is picked up once the day is read again later.
+    tables["attendance"].append({"student_id": "stu-2", "admin_id": "admin-a", "date": "2026-03-05"})
+    clock["now"] = datetime(2026, 3, 9, 8).timestamp()
+    later = roster_service.load_roster(
+        FakeSupabase(tables=tables), "admin-a", *span, store=store, today=date(2026, 3, 9)
+    )
+    assert [row["marks"] for row in later.register()] == ["PAAA", "--AP"]
+    store.close()
+
+
+def test_roster_settles_in_the_timetable_timezone_and_reuses_today(tmp_path, monkeypatch):
+    import json
+    from datetime import date, datetime, timezone
+    from zoneinfo import ZoneInfo
+
+    monkeypatch.delenv("ATTENDANCE_HOLIDAYS", raising=False)
+    path = tmp_path / "schedule.json"
+    path.write_text(
+        json.dumps({"admins": {"admin-a": {"timezone": "Pacific/Honolulu", "lecture_days": "mon,tue,wed,thu,fri"}}})
+    )
+    monkeypatch.setattr(schedule_service, "SCHEDULE_PATH", str(path))
+    honolulu = ZoneInfo("Pacific/Honolulu")
+    assert roster_service._settles_at("2026-03-05", honolulu) == (
+        datetime(2026, 3, 6, tzinfo=honolulu).timestamp() + roster_service.ROSTER_SETTLE_SECONDS
+    )
+    tables = {
+        "students": [{"id": "stu-1", "admin_id": "admin-a"}, {"id": "stu-2", "admin_id": "admin-a"}],
+        "attendance": [{"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-05"}],
+    }
+    store = roster_service.RosterStore(path=str(tmp_path / "roster.db"))
+    clock = {"now": datetime(2026, 3, 6, 5, tzinfo=timezone.utc).timestamp()}  # 19:00 on the 5th in Honolulu
+    monkeypatch.setattr(roster_service, "time", SimpleNamespace(time=lambda: clock["now"]))
+
+    def load(day, client=None):
+        return roster_service.load_roster(
+            client or FakeSupabase(tables=tables), "admin-a", date(2026, 3, 5), day, store=store, today=day
+        )
+
+    assert [row["marks"] for row in load(date(2026, 3, 5)).register()] == ["P", "A"]
+    # Past midnight UTC but still the 5th at the school: that build isn't final.
+    tables["attendance"].append({"student_id": "stu-2", "admin_id": "admin-a", "date": "2026-03-05"})
+    clock["now"] = datetime(2026, 3, 6, 12, tzinfo=timezone.utc).timestamp()
+    assert [row["marks"] for row in load(date(2026, 3, 6)).register()] == ["PA", "PA"]
+
+    # Today is served from the last build until a mark bumps the data version...
+    def unreachable(_table):
+        raise RuntimeError("supabase unreachable")
+
+    tables["attendance"].append({"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-03-06"})
+    assert [row["marks"] for row in load(date(2026, 3, 6), SimpleNamespace(table=unreachable)).register()] == [
+        "PA",
+        "PA",
+    ]
+    cache_service.bump_data_version("admin-a")
+    assert [row["marks"] for row in load(date(2026, 3, 6)).register()] == ["PP", "PA"]
+
+    # ...or the build is older than ROSTER_TODAY_TTL_SECONDS.
+    tables["attendance"].append({"student_id": "stu-2", "admin_id": "admin-a", "date": "2026-03-06"})
+    clock["now"] += roster_service.ROSTER_TODAY_TTL_SECONDS
+    assert [row["marks"] for row in load(date(2026, 3, 6)).register()] == ["PP", "PP"]
+    store.close()
+
+
+def test_absentee_endpoint_and_exports_with_absent_rows(client, monkeypatch, tmp_path):
+    from datetime import date, timedelta
+
+    monkeypatch.setenv("ATTENDANCE_LECTURE_DAYS", "mon,tue,wed,thu,fri,sat,sun")
+    monkeypatch.setattr(roster_service, "_roster_store", roster_service.RosterStore(path=str(tmp_path / "r.db")))
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    tables = {
+        "admins": [{"id": "admin-a", "user_id": "user-1"}],
+        "students": [
+            {"id": "stu-1", "admin_id": "admin-a", "name": "Asha", "roll_number": "1"},
+            {"id": "stu-2", "admin_id": "admin-a", "name": "Ben", "roll_number": "2"},
+        ],
+        "attendance": [
+            {"id": 1, "student_id": "stu-1", "admin_id": "admin-a", "date": yesterday, "status": "present"},
+        ],
+    }
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: FakeSupabase(tables=tables))
+
+    body = client.get(f"/api/v1/absentees?date={yesterday}").json()
+    assert (body["session"], body["present_count"], body["absent_count"]) == (True, 1, 1)
+    assert body["absentees"] == [{"student_id": "stu-2", "name": "Ben", "roll_number": "2"}]
+
+    register = client.get(f"/api/v1/register?month={yesterday[:7]}").json()
+    marks = {row["student_id"]: row["marks"] for row in register["students"]}
+    assert register["days"][-1] == yesterday or register["days"][-1] == date.today().isoformat()
+    assert marks["stu-1"][register["days"].index(yesterday)] == "P"
+    assert marks["stu-2"] == "A" * len(register["days"])
+
+    plain = client.get("/api/v1/export/csv").text
+    with_absent = client.get("/api/v1/export/csv?include_absent=true").text
+    assert "absent" not in plain
+    assert f"Ben,2,{yesterday},absent" in with_absent
+    roster_service._roster_store.close()
+
+
+def test_timetable_index_handles_overlaps_overnight_timezones_and_holidays():
+    from datetime import date, datetime, timezone
+
+    schedule = schedule_service.Schedule(
+        {
+            "timezone": "Asia/Kolkata",
+            "holidays": ["2026-10-21"],
+            "admins": {
+                "admin-a": {
+                    "subjects": {
+                        "Maths": [{"days": "mon,wed", "start": "09:00", "end": "10:30"}],
+                        "Lab": [{"days": "mon", "start": "10:00", "end": "12:00"}],
+                        "Night": [{"days": "sun", "start": "23:00", "end": "01:00"}],
+                    }
+                },
+                "admin-b": {
+                    "timezone": "UTC",
+                    "subjects": {"Art": [{"days": "mon", "start": "09:00", "end": "10:00"}]},
+                },
+            },
+        }
+    )
+
+    def at(admin_id, hour, minute=0, day=19, subject=None):
+        # 2026-10-19 is a Monday; times are UTC, Kolkata is UTC+5:30.
+        return schedule.resolve(admin_id, subject, datetime(2026, 10, day, hour, minute, tzinfo=timezone.utc))
+
+    assert at("admin-a", 3, 45) == (True, "Maths", date(2026, 10, 19))  # 09:15 IST
+    assert at("admin-a", 4, 45) == (True, "Lab", date(2026, 10, 19))  # 10:15 IST, Lab began last
+    assert at("admin-a", 4, 45, subject="Maths") == (True, "Maths", date(2026, 10, 19))
+    assert at("admin-a", 5, 15, subject="Maths")[0] is False  # Maths is over, only Lab runs
+    assert at("admin-a", 7, 0) == (False, None, None)
+    assert at("admin-a", 3, 45, day=21)[0] is False  # Wednesday Maths on a holiday
+    # Sunday 23:00 IST to Monday 01:00 IST wraps the week and belongs to Sunday.
+    assert at("admin-a", 19, 0, day=18) == (True, "Night", date(2026, 10, 18))
+    assert at("admin-b", 9, 30) == (True, "Art", date(2026, 10, 19))
+    # Admins without a timetable keep the ATTENDANCE_START_HOUR/END_HOUR window.
+    assert at("admin-c", 3, 0) == (True, None, date(2026, 10, 19))
+
+    # Lecture days come from each admin's own sessions and holidays.
+    lecture = schedule.timetable("admin-a").is_lecture_day
+    assert [lecture(date(2026, 10, day)) for day in (18, 19, 20, 21)] == [True, True, False, False]
+    assert schedule.timetable("admin-b").is_lecture_day(date(2026, 10, 19))
+    assert not schedule.timetable("admin-b").is_lecture_day(date(2026, 10, 18))
+    assert schedule.timetable("admin-c").is_lecture_day(date(2026, 10, 20))  # ATTENDANCE_LECTURE_DAYS default
+    assert not schedule.timetable("admin-c").is_lecture_day(date(2026, 10, 21))
+
+
+def test_mark_student_attendance_takes_subject_from_hot_reloaded_schedule(tmp_path, monkeypatch):
+    import json
+
+    path = tmp_path / "schedule.json"
+    monkeypatch.setattr(schedule_service, "SCHEDULE_PATH", str(path))
+    monkeypatch.setattr(schedule_service, "SCHEDULE_RELOAD_SECONDS", 0)
+    tables = {"students": [{"id": "stu-1", "admin_id": "admin-a"}, {"id": "stu-2", "admin_id": "admin-a"}]}
+    fake = FakeSupabase(tables=tables)
+    monkeypatch.setattr(attendance_service, "get_supabase_client", lambda: fake)
+    monkeypatch.setattr(attendance_service, "get_write_buffer", lambda: None)
+
+    def write(subjects):
+        path.write_text(json.dumps({"admins": {"admin-a": {"timezone": "UTC", "subjects": subjects}}}))
+
+    write({"Maths": [{"start": "00:00", "end": "24:00"}]})
+    assert attendance_service.mark_student_attendance("stu-1", 90.0)[1] == "ATTENDANCE_MARKED"
+    write({"Physics": [{"start": "00:00", "end": "24:00"}]})
+    assert attendance_service.mark_student_attendance("stu-1", 90.0)[1] == "ATTENDANCE_MARKED"
+    assert attendance_service.mark_student_attendance("stu-1", 90.0)[1] == "DUPLICATE_ATTENDANCE"
+    assert [row["subject"] for row in tables["attendance"]] == ["Maths", "Physics"]
+
+    ok, results, _ = attendance_service.mark_attendance_bulk("admin-a", {"stu-1": 91.0, "stu-2": 92.0})
+    assert ok and results["stu-2"][1] == "ATTENDANCE_MARKED" and results["stu-1"][1] == "DUPLICATE_ATTENDANCE"
+
+    path.write_text("{not json")
+    assert attendance_service.mark_student_attendance("stu-2", 90.0, "Physics")[1] == "DUPLICATE_ATTENDANCE"
+    write({})
+    assert attendance_service.mark_student_attendance("stu-2", 90.0)[1] == "OUTSIDE_TIME_WINDOW"
+
+
+def test_audit_log_batches_rotates_and_computes_far_frr(tmp_path):
+    from datetime import date, timedelta
+
+    directory = str(tmp_path / "audit")
+    audit_log = audit_service.AuditLog(directory, flush_max_rows=1000, max_buffered=6, keep_days=30)
+    old = tmp_path / "audit" / f"audit-{(date.today() - timedelta(days=40)).isoformat()}.jsonl"
+    old.write_text("{}\n")
+
+    scores = [(0.30, True), (0.40, True), (0.58, True), (0.50, False), (0.70, False)]
+    ids = [audit_log.record("verify", student_id=f"stu-{i}", distance=d) for i, (d, _) in enumerate(scores)]
+    audit_log.record("export", admin_id="admin-a", format="csv", subject=None)
+    assert audit_log.pending_count() == 6 and [p.name for p in (tmp_path / "audit").iterdir()] == [old.name]
+    audit_log.record("delete", student_id="stu-9")  # over max_buffered: the oldest event is dropped
+    assert audit_log.stats()["dropped"] == 1
+    assert audit_log.flush() == 6
+    assert not old.exists()
+
+    for event_id, (_, genuine) in zip(ids, scores):
+        audit_log.record("label", ref=event_id, genuine=genuine)
+    audit_log.record("label", ref=ids[3], genuine=False)
+    audit_log.flush()
+
+    today = date.today()
+    events = list(audit_service.read_events(today - timedelta(days=1), today + timedelta(days=1), directory))
+    assert [e["event"] for e in events[:6]] == ["verify"] * 4 + ["export", "delete"]
+    assert "subject" not in events[4]
+    distances, genuine = audit_service.load_scores(today - timedelta(days=1), today + timedelta(days=1), directory)
+    assert sorted(distances.tolist()) == [0.4, 0.5, 0.58, 0.7]  # stu-0 was dropped
+
+    curve = audit_service.far_frr(distances, genuine, thresholds=[0.45, 0.55, 0.6])
+    assert (curve["genuine"], curve["impostor"]) == (2, 2)
+    assert curve["far"] == [0.0, 0.5, 0.5]
+    assert curve["frr"] == [0.5, 0.5, 0.0]
+    assert curve["eer"] == {"threshold": 0.55, "rate": 0.5}
+
+
+def test_face_and_export_endpoints_write_audit_events(client, monkeypatch):
+    from datetime import date, timedelta
+
+    fake = FakeSupabase(
+        tables={
+            "admins": [{"id": "admin-a", "user_id": "user-1"}],
+            "students": [{"id": "stu-1", "admin_id": "admin-a", "name": "Asha", "roll_number": "1"}],
+            "attendance": [{"student_id": "stu-1", "admin_id": "admin-a", "date": "2026-01-05", "status": "present"}],
+        }
+    )
+    monkeypatch.setattr(app_module, "get_supabase_client", lambda: fake)
+    app_module.app.dependency_overrides[app_module.require_admin] = lambda: _auth_user("user-1")
+    results = iter(
+        [
+            (False, 41.0, "Face does not match", None),
+            (True, 72.5, "Match found", {"live": True}),
+            (False, 0.0, "Found 0 faces", None),
+        ]
+    )
+    monkeypatch.setattr(app_module, "verify_student_face", lambda *_: next(results))
+    monkeypatch.setattr(app_module, "delete_student_face", lambda *_: (True, "deleted"))
+
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "a"}).status_code == 400
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "b"}).status_code == 200
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "c"}).status_code == 400
+    assert client.post("/api/v1/delete_face", json={"student_id": "stu-1"}).status_code == 200
+    assert client.get("/api/v1/export/csv").status_code == 200
+    stats = client.get("/api/v1/metrics").json()["audit_log"]
+    assert stats["pending"] + stats["written"] == 5
+
+    audit_service.get_audit_log().flush()
+    today = date.today()
+    events = list(audit_service.read_events(today - timedelta(days=1), today + timedelta(days=1)))
+    verify = [e for e in events if e["event"] == "verify"]
+    assert [e.get("distance") for e in verify] == [0.59, 0.275, None]
+    assert [e.get("error_code") for e in verify] == ["FACE_MISMATCH", None, "NO_FACE_DETECTED"]
+    assert verify[1]["match"] is True and verify[1]["live"] is True and verify[1]["threshold"] == 0.55
+    assert all("duration_ms" in e for e in verify)
+    assert [e["event"] for e in events[3:]] == ["delete", "export"]
+    assert events[4]["admin_id"] == "admin-a" and events[4]["format"] == "csv"
+
+
+def test_calibration_bins_pairs_in_chunks_and_recommends_a_threshold(tmp_path, monkeypatch):
+    from datetime import date, timedelta
+
+    import numpy as np
+
+    rng = np.random.default_rng(7)
+    encodings = rng.normal(0.0, 0.035, (40, 128))
+    counts, nearest = calibration_service.impostor_histogram(encodings, chunk_rows=7)
+    full = np.sqrt(((encodings[:, None, :] - encodings[None, :, :]) ** 2).sum(axis=2))
+    pairs = full[np.triu_indices(40, k=1)]
+    assert counts.sum() == len(pairs) == 780
+    assert np.array_equal(counts, np.bincount((pairs / calibration_service.BIN_WIDTH).astype(int), minlength=2000))
+    np.fill_diagonal(full, np.inf)
+    assert np.allclose(nearest, full.min(axis=1))
+
+    # Genuine samples: accepted checks, plus a rejection retried successfully.
+    directory = str(tmp_path / "audit")
+    audit_log = audit_service.AuditLog(directory)
+    audit_log.record("verify", student_id="stu-0", match=False, distance=0.41)
+    audit_log.record("verify", student_id="stu-0", match=True, distance=0.27)
+    audit_log.record("verify", student_id="stu-1", match=False, distance=0.52)
+    forged = audit_log.record("verify", student_id="stu-2", match=True, distance=0.2)
+    audit_log.record("verify", student_id="stu-3", match=True, distance=0.1, replayed=True)
+    audit_log.record("verify", student_id="other", match=True, distance=0.3)
+    audit_log.record("label", ref=forged, genuine=False)
+    audit_log.flush()
+    today = date.today()
+    ids = [f"stu-{i}" for i in range(40)]
+    genuine, impostor = calibration_service.genuine_samples(
+        ids, today - timedelta(days=1), today + timedelta(days=1), directory
+    )
+    assert sorted(genuine.tolist()) == [0.27, 0.41] and impostor.tolist() == [0.2]
+
+    fake = FakeSupabase(
+        tables={
+            "students": [{"id": sid, "admin_id": "admin-a"} for sid in ids],
+            "face_encodings": [{"student_id": sid, "encoding": enc.tolist()} for sid, enc in zip(ids, encodings)],
+        }
+    )
+    monkeypatch.setattr(calibration_service, "MIN_STUDENTS", 10)
+    report = calibration_service.calibrate_admin(fake, "admin-a", directory=directory, current=(0.55, 72.0))
+    assert report["students"] == 40 and report["genuine_samples"] == 2
+    # 780 pairs at a 0.1% target leave no room for any pair: just under the closest one.
+    assert calibration_service.recommend_threshold(counts) == round(float(np.floor(pairs.min() * 1000) / 1000), 3)
+    # The labelled impostor at 0.2 would be accepted at any threshold, so the floor applies.
+    assert report["threshold"] == calibration_service.min_threshold() == 0.28
+    assert report["recommended"]["far"] <= calibration_service.TARGET_FAR
+    assert report["current"]["threshold"] == 0.28 and report["current"]["frr"] == 0.5
+
+    path = str(tmp_path / "thresholds.json")
+    assert calibration_service.write_thresholds([report, {"admin_id": "admin-b", "threshold": None}], path) == 1
+    monkeypatch.setattr(calibration_service, "THRESHOLDS_PATH", path)
+    assert calibration_service.get_admin_threshold("admin-a") == report["threshold"]
+    assert calibration_service.get_admin_threshold("admin-b") is None
+
+
+def test_verification_uses_the_admins_calibrated_threshold(tmp_path, monkeypatch):
+    import json
+
+    import numpy as np
+
+    stored = np.full(128, 0.25)
+    gallery_service.set_gallery(
+        gallery_service.build_gallery(
+            [{"student_id": sid, "encoding": stored.tolist()} for sid in ("stu-1", "stu-2")],
+            {"stu-1": "admin-a", "stu-2": "admin-b"},
+        )
+    )
+    # 0.35 away: confidence 65, under the default MIN_CONFIDENCE of 72.
+    probe = stored + 0.35 / np.sqrt(128)
+    monkeypatch.setattr(face_service, "decode_image_checked", lambda _image: (object(), None))
+    monkeypatch.setattr(face_service, "_encode_face", lambda *_args: (probe, (0, 1, 1, 0), None, None))
+    monkeypatch.setattr(face_service, "LIVENESS_MODE", "off")
+    path = tmp_path / "thresholds.json"
+    monkeypatch.setattr(calibration_service, "THRESHOLDS_PATH", str(path))
+    try:
+        rejected = face_service._verify_student_face("stu-1", "img", None, "admin-a")
+        assert rejected[:3] == (False, 65.0, "Face does not match")
+
+        path.write_text(json.dumps({"admins": {"admin-a": {"threshold": 0.4}}}))
+        calibration_service.reset_thresholds()
+        assert face_service.match_rule("admin-a") == (0.4, 60.0)
+        assert face_service._verify_student_face("stu-1", "img", None, "admin-a")[:3] == (True, 65.0, "Match found")
+        assert not face_service._verify_student_face("stu-2", "img", None, "admin-b")[0]
+        assert not face_service._verify_student_face("stu-1", "img")[0]  # no admin: the defaults
+    finally:
+        gallery_service.set_gallery(None)
+
+
+def test_checkins_resolve_the_admin_without_a_gallery(client, tmp_path, monkeypatch):
+    import json
+
+    assert gallery_service.get_gallery() is None
+    path = tmp_path / "thresholds.json"
+    path.write_text(json.dumps({"admins": {"admin-a": {"threshold": 0.4}}}))
+    monkeypatch.setattr(calibration_service, "THRESHOLDS_PATH", str(path))
+    fake = FakeSupabase(tables={"students": [{"id": "stu-1", "admin_id": "admin-a"}]})
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: fake)
+    seen = []
+
+    def verify(student_id, image, burst=None, phash=None, admin_id=None):
+        seen.append(admin_id)
+        return True, 65.0, "Match found", None
+
+    monkeypatch.setattr(app_module, "verify_student_face", verify)
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "img"}).status_code == 200
+    assert seen == ["admin-a"]
+    assert face_service.match_rule(seen[0]) == (0.4, 60.0)
+
+    # The lookup is cached: a second check-in doesn't query Supabase again.
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: pytest.fail("admin lookup not cached"))
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "img"}).status_code == 200
+    assert seen == ["admin-a", "admin-a"]
+
+
+def test_checkins_from_two_admins_are_interleaved(client, monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    students = [{"id": f"a-{n}", "admin_id": "admin-a"} for n in range(4)]
+    students += [{"id": f"b-{n}", "admin_id": "admin-b"} for n in range(2)]
+    fake = FakeSupabase(tables={"students": students})
+    monkeypatch.setattr(face_service, "get_supabase_client", lambda: fake)
+    scheduler = tenant_service.TenantScheduler(workers=1, cpu_seconds_per_minute=0)
+    monkeypatch.setattr(app_module, "get_tenant_scheduler", lambda: scheduler)
+    order = []
+
+    def verify(student_id, image, burst=None, phash=None, admin_id=None):
+        order.append(student_id)
+        return True, 90.0, "Match found", None
+
+    monkeypatch.setattr(app_module, "verify_student_face", verify)
+    started, gate = threading.Event(), threading.Event()
+    try:
+        scheduler.submit("admin-c", lambda: (started.set(), gate.wait(5)))
+        assert started.wait(5)
+        with ThreadPoolExecutor(max_workers=len(students)) as pool:
+            # admin-a's kiosk queues all its check-ins before admin-b's arrive.
+            responses = []
+            for queued, student in enumerate(students, start=1):
+                responses.append(
+                    pool.submit(client.post, "/api/v1/verify_face", json={"student_id": student["id"], "image": "i"})
+                )
+                deadline = time.monotonic() + 5
+                while scheduler.totals()["queued"] < queued and time.monotonic() < deadline:
+                    time.sleep(0.005)
+            gate.set()
+            assert all(response.result(timeout=5).status_code == 200 for response in responses)
+        assert order == ["a-0", "b-0", "a-1", "b-1", "a-2", "a-3"]
+        assert scheduler.usage("admin-b")["admin-b"]["jobs"] == {"checkin": 2}
+        assert tenant_service.UNASSIGNED not in scheduler.usage()
+    finally:
+        gate.set()
+        scheduler.close()
+
+
+def test_body_limits_answer_413_before_and_while_reading(client, monkeypatch):
+    limiter = body_limit_service.BodyLimiter({"/api/v1/verify_face": 1000})
+    monkeypatch.setattr(body_limit_service, "_limiter", limiter)
+    calls = []
+
+    def verify(*args):
+        calls.append(args)
+        return True, 90.0, "Match found", None
+
+    monkeypatch.setattr(app_module, "verify_student_face", verify)
+
+    resp = client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "A" * 2000})
+    assert resp.status_code == 413
+    assert resp.json() == {
+        "success": False,
+        "error_code": "PAYLOAD_TOO_LARGE",
+        "message": "Request body exceeds the allowed size.",
+    }
+    assert limiter.stats() == {"rejected_early": 1, "rejected_streaming": 0}
+
+    def chunked():
+        yield b'{"student_id": "stu-1", "image": "'
+        for _ in range(10):
+            yield b"A" * 200
+        yield b'"}'
+
+    resp = client.post("/api/v1/verify_face", content=chunked(), headers={"content-type": "application/json"})
+    assert resp.status_code == 413 and resp.json()["error_code"] == "PAYLOAD_TOO_LARGE"
+    assert limiter.rejected_streaming == 1
+    assert calls == []
+
+    assert client.post("/api/v1/verify_face", json={"student_id": "stu-1", "image": "A" * 100}).status_code == 200
+
+    # Built-in per-route limits.
+    image = body_limit_service._images(1)
+    defaults = body_limit_service.BodyLimiter({})
+    assert defaults.limit_for("/api/v1/register_face") == image
+    assert defaults.limit_for("/api/v1/mark-attendance") == body_limit_service._images(3)
+    assert defaults.limit_for("/api/v1/mark_attendance/batch") == body_limit_service._images(3)
+    assert defaults.limit_for("/api/v1/mark_attendance/stream") == body_limit_service.UPLOAD_LIMIT
+    assert defaults.limit_for("/api/v1/statistics") == body_limit_service.DEFAULT_LIMIT
+    assert body_limit_service.BodyLimiter({"default": 0}).limit_for("/api/v1/statistics") is None
+
+
+def test_decode_refuses_oversized_dimensions_from_the_header(monkeypatch):
+    import cv2
+    import numpy as np
+
+    ok, wide = cv2.imencode(".png", np.zeros((1, 9000, 3), dtype=np.uint8))
+    assert ok
+    assert face_service.decode_image_bytes(wide.tobytes()) == (None, "Image too large")
+
+    ok, bmp = cv2.imencode(".bmp", np.zeros((4, 4, 3), dtype=np.uint8))
+    forged = bytearray(bmp.tobytes())
+    forged[18:22] = (60000).to_bytes(4, "little")
+    forged[22:26] = (-60000).to_bytes(4, "little", signed=True)
+    decoded = []
+    monkeypatch.setattr(face_service, "_get_cv2", lambda: decoded.append(1) or cv2)
+    assert face_service.decode_image_bytes(bytes(forged)) == (None, "Image too large")
+    assert decoded == []  # refused before OpenCV saw it
+
+    ok, webp = cv2.imencode(".webp", np.zeros((40, 30, 3), dtype=np.uint8))
+    image, error = face_service.decode_image_bytes(webp.tobytes())
+    assert error is None and image.shape == (40, 30, 3)